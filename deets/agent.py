@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+"""An ssh-agent style daemon which caches the keys of unlocked vaults, so
+that repeated invocations of ``deets`` do not need to prompt for the master
+password, or to re-run the (deliberately slow) key derivation function.
+
+The agent only ever holds the data key with which the entries of a vault
+are encrypted (see ``encryption.MasterKey``, and the ``keys`` module) - it
+is never given the master password, so it cannot reveal it.
+
+The agent listens on a Unix domain socket (``$DEETSAGENT``, or
+``~/.deets-agent`` by default), which is only accessible by the current
+user. Requests and responses are JSON objects, one per line. Each request
+contains an ``"op"`` field, which is one of:
+
+ - ``"unlock"``: Store the key for a vault, for ``ttl`` seconds.
+ - ``"lookup"``: Retrieve the key for a vault.
+ - ``"lock"``:   Forget one or all vaults.
+ - ``"ping"``:   Check that the agent is running.
+
+Keys are sent as a base64 ``"key"``, along with the ``"salt"`` (base64) and
+``"kdf"`` parameters it was derived with, if it was derived from a password
+(only the case for version 2 vaults).
+
+Vaults are discarded once they expire. An agent started in the background
+(see ``spawn``) exits once it no longer holds any vaults.
+"""
+
+
+import                  os
+import os.path       as op
+import base64        as b64
+import                  sys
+import                  json
+import                  time
+import                  socket
+import                  threading
+import                  subprocess as sp
+import                  socketserver
+
+from typing import Union, Dict, Any
+
+from . import defaults
+
+
+DEFAULT_TTL = defaults.DEFAULT_TTL
+"""Default number of seconds for which an unlocked vault is cached. """
+
+
+POLL_INTERVAL = 1
+"""Number of seconds between checks for expired vaults. """
+
+
+SPAWN_TIMEOUT = 10
+"""Number of seconds to wait for a background agent to start. """
+
+
+def socket_path() -> str:
+    """Return the path to the agent socket. """
+    return os.environ.get('DEETSAGENT', op.expanduser('~/.deets-agent'))
+
+
+class Vault:
+    """Cached information about one unlocked vault. """
+
+    def __init__(self, key : Dict[str, Any], ttl : float):
+        self.key    = key
+        self.expiry = time.time() + ttl
+
+
+class AgentServer(socketserver.ThreadingUnixStreamServer):
+    """Agent server. Holds a ``Vault`` for each unlocked vault file, which are
+    discarded after they expire. If ``transient`` is ``True``, the server
+    is shut down once it no longer holds any vaults.
+    """
+
+    daemon_threads = True
+
+
+    def __init__(self, path : str, transient : bool = False):
+        self.vaults    = {}
+        self.lock      = threading.Lock()
+        self.transient = transient
+        self.unlocked  = False
+        super().__init__(path, AgentHandler)
+
+
+    def get_vault(self, vault : str) -> Union[Vault, None]:
+        with self.lock:
+            entry = self.vaults.get(vault)
+            if entry is not None and entry.expiry < time.time():
+                self.vaults.pop(vault)
+                entry = None
+            return entry
+
+
+    def service_actions(self):
+        """Called by ``serve_forever`` every ``POLL_INTERVAL`` seconds.
+        Discards expired vaults, and shuts down a transient server once it
+        has no vaults left.
+        """
+        now = time.time()
+        with self.lock:
+            for vault, entry in list(self.vaults.items()):
+                if entry.expiry < now:
+                    self.vaults.pop(vault)
+            empty = len(self.vaults) == 0
+
+        # A transient server is started in order to unlock
+        # a vault, so is not stopped before the first unlock.
+        # shutdown blocks until serve_forever returns, so
+        # must be called from a different thread.
+        if self.transient and self.unlocked and empty:
+            self.transient = False
+            threading.Thread(target=self.shutdown, daemon=True).start()
+
+
+    def dispatch(self, request : Dict[str, Any]) -> Dict[str, Any]:
+
+        op    = request['op']
+        vault = request.get('vault')
+
+        if op == 'ping':
+            return {}
+
+        if op == 'unlock':
+            with self.lock:
+                key = {'key'  : request['key'],
+                       'salt' : request.get('salt'),
+                       'kdf'  : request.get('kdf')}
+                self.vaults[vault] = Vault(key,
+                                           request.get('ttl', DEFAULT_TTL))
+                self.unlocked      = True
+            return {}
+
+        if op == 'lock':
+            with self.lock:
+                if vault is None: self.vaults.clear()
+                else:             self.vaults.pop(vault, None)
+            return {}
+
+        entry = self.get_vault(vault)
+        if entry is None:
+            return {'error' : 'locked'}
+
+        if op == 'lookup':
+            return dict(entry.key)
+
+        return {'error' : f'unknown operation: {op}'}
+
+
+class AgentHandler(socketserver.StreamRequestHandler):
+    """Handles requests from one client connection. """
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.server.dispatch(json.loads(line))
+            except Exception as e:
+                response = {'error' : str(e)}
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            self.wfile.flush()
+
+
+def create_server(path      : str  = None,
+                  transient : bool = False) -> AgentServer:
+    """Create an ``AgentServer`` listening on ``path``. A stale socket file
+    at ``path`` is removed.
+    """
+    if path is None:
+        path = socket_path()
+    if op.exists(path):
+        if is_running(path):
+            raise RuntimeError(f'An agent is already running at {path}')
+        os.remove(path)
+    umask = os.umask(0o177)
+    try:
+        return AgentServer(path, transient)
+    finally:
+        os.umask(umask)
+
+
+def serve(path : str = None, transient : bool = False):
+    """Run an agent in the foreground. """
+    server = create_server(path, transient)
+    try:
+        server.serve_forever(POLL_INTERVAL)
+    finally:
+        server.server_close()
+        os.remove(server.server_address)
+
+
+def spawn(path : str = None):
+    """Start an agent in the background, unless one is already running, and
+    wait until it is accepting connections.
+
+    The agent is run in a new interpreter (rather than by forking this
+    process), so that it does not inherit the master password, or anything
+    else that this process has decrypted.
+    """
+
+    if path is None:
+        path = socket_path()
+    if is_running(path):
+        return
+
+    pkgdir = op.dirname(op.dirname(op.abspath(__file__)))
+    env    = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [pkgdir] + [p for p in [env.get('PYTHONPATH')] if p])
+    proc = sp.Popen([sys.executable, '-m', 'deets.agent', path],
+                    stdin=sp.DEVNULL, stdout=sp.DEVNULL, stderr=sp.DEVNULL,
+                    env=env, start_new_session=True)
+
+    deadline = time.time() + SPAWN_TIMEOUT
+    while not is_running(path):
+        if proc.poll() is not None or time.time() > deadline:
+            raise RuntimeError(f'Could not start an agent at {path}')
+        time.sleep(0.01)
+
+
+def request(op : str, path : str = None, **kwargs) -> Dict[str, Any]:
+    """Send a request to the agent, and return its response. Raises an
+    ``OSError`` if the agent is not running.
+    """
+    if path is None:
+        path = socket_path()
+    kwargs['op'] = op
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(json.dumps(kwargs).encode() + b'\n')
+        with sock.makefile('rb') as f:
+            return json.loads(f.readline())
+
+
+def is_running(path : str = None) -> bool:
+    """Return ``True`` if an agent is listening at ``path``. """
+    try:
+        request('ping', path)
+        return True
+    except OSError:
+        return False
+
+
+def unlock(vault : str, key : 'encryption.MasterKey', ttl : float = None):
+    """Store the data ``key`` for ``vault`` in the agent. """
+    if ttl is None:
+        ttl = DEFAULT_TTL
+    salt = key.salt
+    if salt is not None:
+        salt = b64.b64encode(salt).decode()
+    request('unlock', vault=vault, ttl=ttl, salt=salt, kdf=key.kdf,
+            key=b64.b64encode(key.to_bytes()).decode())
+
+
+def lock(vault : str = None):
+    """Remove ``vault`` (or all vaults) from the agent. """
+    try:
+        request('lock', vault=vault)
+    except OSError:
+        pass
+
+
+def lookup(vault : str) -> Union['encryption.MasterKey', None]:
+    """Return the data key for ``vault`` from the agent, or ``None`` if the
+    agent is not running, or does not hold the vault.
+    """
+    try:
+        response = request('lookup', vault=vault)
+    except OSError:
+        return None
+    if 'key' not in response:
+        return None
+
+    # Imported here, so that commands which only talk
+    # to the agent don't need to import cryptography
+    from . import encryption
+    salt = response.get('salt')
+    if salt is not None:
+        salt = b64.b64decode(salt)
+    return encryption.MasterKey.from_bytes(b64.b64decode(response['key']),
+                                           salt, response.get('kdf'))
+
+
+if __name__ == '__main__':
+    # Entry point for agents started by spawn
+    serve(sys.argv[1], transient=True)
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+"""Background saving of a ``Database``, used by the ``repl`` command so that
+changes are saved shortly after they are made, without blocking the prompt
+while the database is encrypted and written.
+"""
+
+
+import time
+import threading
+
+from typing import Union
+
+from . import db as deetsdb
+
+
+DEFAULT_DELAY = 2.0
+"""Default number of seconds to wait after a change before saving. """
+
+
+class AutoSaver:
+    """Write-behind saver for a ``Database``.
+
+    ``notify`` should be called (from the thread which modifies the
+    database) after the database may have been changed. If it has been
+    changed, a snapshot of the database is taken, and is saved by a
+    background thread once ``delay`` seconds have passed without any further
+    changes. Changes made in quick succession are saved together.
+
+    ``close`` must be called to save any pending changes, and to stop the
+    background thread.
+    """
+
+
+    def __init__(self,
+                 db       : deetsdb.Database,
+                 filename : deetsdb.pathtype,
+                 delay    : float = None):
+        if delay is None:
+            delay = DEFAULT_DELAY
+
+        self.__db       = db
+        self.__filename = filename
+        self.__delay    = delay
+        self.__cond     = threading.Condition()
+        self.__pending  = None
+        self.__last     = None
+        self.__result   = None
+        self.__merged   = False
+        self.__failed   = None
+        self.__deadline = 0
+        self.__saving   = False
+        self.__flushing = False
+        self.__closed   = False
+        self.__error    = None
+        self.__thread   = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+
+    @property
+    def error(self) -> Union[Exception, None]:
+        """The error raised by the most recent failed save, if any. """
+        return self.__error
+
+
+    def notify(self):
+        """Take a snapshot of the database if it has changed, and schedule it
+        to be saved.
+        """
+        db = self.__db
+
+        with self.__cond:
+            self.__apply()
+
+            if not db.changed:
+                return
+
+            snap = db.snapshot()
+
+            # combine with any unsaved snapshot
+            if self.__pending is not None:
+                snap.journal = self.__pending.journal + snap.journal
+
+            db.changed      = False
+            self.__pending  = snap
+            self.__deadline = time.monotonic() + self.__delay
+            self.__cond.notify_all()
+
+
+    def flush(self):
+        """Save any pending changes immediately, and wait until they have
+        been saved.
+        """
+        with self.__cond:
+            self.__flushing = True
+            self.__cond.notify_all()
+            while self.__pending is not None or self.__saving:
+                self.__cond.wait()
+            self.__flushing = False
+
+
+    def close(self):
+        """Save any pending changes, and stop the background thread. Changes
+        which could not be saved are left in the database's ``journal``.
+        """
+        self.notify()
+        self.flush()
+        with self.__cond:
+            self.__closed = True
+            self.__cond.notify_all()
+        self.__thread.join()
+        with self.__cond:
+            self.__apply()
+
+
+    def __apply(self):
+        """Called from the thread which modifies the database, with the
+        condition held. Applies the outcome of the most recent saves to the
+        database (which is not thread-safe, so is never modified by the
+        background thread).
+        """
+        db     = self.__db
+        result = self.__result
+
+        # If the last save was merged with changes made
+        # by another process, the database is rebased
+        # onto it, along with any unsaved snapshot (which
+        # is then replaced by a new snapshot), so that
+        # it includes those changes.
+        if result is not None and self.__merged:
+            if self.__pending is not None:
+                db.journal     = self.__pending.journal + db.journal
+                self.__pending = None
+            db.rebase(result)
+
+        # Otherwise pass the log size, manifest, file stamp,
+        # and (if this is a new database) the new data key
+        # and key slots back to the database, so they are
+        # used for subsequent snapshots.
+        elif result is not None:
+            db.log_size = result.log_size
+            db.manifest = result.manifest
+            db.stamp    = result.stamp
+            if db.key is None and db.password == result.password and \
+               db.kdf == result.kdf:
+                changed     = db.changed
+                db.key      = result.key
+                db.keyslots = result.keyslots
+                db.changed  = changed
+            if db.keyslots == result.keyslots:
+                db.keys_changed = False
+
+        # Restore changes which could not be saved, so
+        # they are saved along with the next snapshot.
+        # The database is rebased onto the snapshot, as
+        # it may have been rebased (and so lost those
+        # changes) while the snapshot was being saved.
+        failed = self.__failed
+        if failed is not None:
+            db.rebase(failed)
+            db.journal    = failed.journal + db.journal
+            db.changed    = True
+            self.__failed = None
+
+        self.__result = None
+        self.__merged = False
+
+
+    def __run(self):
+        """Runs in the background thread - waits for snapshots, and saves
+        them. The database itself is not accessed - the outcome of each save
+        is passed back to it by ``notify``.
+        """
+        while True:
+            with self.__cond:
+                while self.__pending is None and not self.__closed:
+                    self.__cond.wait()
+                if self.__pending is None:
+                    return
+
+                # wait for changes to stop
+                while not self.__flushing:
+                    remaining = self.__deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.__cond.wait(remaining)
+
+                snap           = self.__pending
+                self.__pending = None
+                self.__saving  = True
+                last           = self.__last
+
+                # A previous save which was merged, but not yet
+                # passed back to the database, contains changes
+                # made by another process which the snapshot
+                # does not.
+                base = None
+                if self.__merged:
+                    base = self.__result
+
+            try:
+                # The log size, manifest, file stamp, and (if
+                # this is a new database) the data key and key
+                # slots may have been updated by a save which
+                # completed after the snapshot was taken.
+                if base is not None:
+                    snap.rebase(base)
+                elif last is not None:
+                    snap.log_size = last.log_size
+                    snap.manifest = last.manifest
+                    snap.stamp    = last.stamp
+                    if snap.key is None and last.key is not None and \
+                       snap.password == last.password and \
+                       snap.kdf == last.kdf:
+                        snap.key      = last.key
+                        snap.keyslots = last.keyslots
+                    if snap.keyslots == last.keyslots:
+                        snap.keys_changed = False
+
+                merged       = deetsdb.save_database(snap, self.__filename)
+                merged       = merged or base is not None
+                self.__error = None
+            except Exception as e:
+                self.__error = e
+
+            with self.__cond:
+                self.__saving = False
+
+                if self.__error is None:
+                    self.__last   = snap
+                    self.__result = snap
+                    self.__merged = merged
+
+                # Otherwise the unsaved changes are saved
+                # along with the next snapshot (see __apply)
+                elif self.__pending is not None:
+                    pending         = self.__pending
+                    pending.rebase(snap)
+                    pending.journal = snap.journal + pending.journal
+                else:
+                    self.__failed = snap
+                self.__cond.notify_all()
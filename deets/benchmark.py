@@ -0,0 +1,997 @@
+#!/usr/bin/env python
+"""Benchmarks for the main phases of loading, querying and saving a
+``Database``, run against synthetic vaults of different sizes. Run with::
+
+    python -m deets.benchmark run -s 10 1000 100000 -o results.json
+
+and compare the results from two commits with::
+
+    python -m deets.benchmark compare before.json after.json
+
+Startup time can be checked against a budget with::
+
+    python -m deets.benchmark startup --budget 75
+
+The following phases are timed for each vault size:
+
+ - ``kdf``:     Deriving the master key from the master password
+ - ``encrypt``: Sealing every entry (``db.seal_entry``)
+ - ``save``:    Writing a new database file (``db.save_database``), which
+                includes sealing every entry
+ - ``parse``:   Loading the database file (``db.load_database``), without
+                deriving the master key
+ - ``decrypt``: Unsealing every entry (``db.unseal_entry``)
+ - ``index``:   Building a name index of every entry
+                (``index.NameIndex.update``)
+ - ``lookup``:  Looking up a number of random accounts
+                (``Database.lookup_keys``) once all entries are decrypted
+ - ``render``:  Rendering a table of every entry (``ui.print_columns``), as
+                done by the ``list`` command
+
+Wall-clock time is recorded for each phase, along with the peak resident
+set size of the process after the phase. Peak memory allocated during each
+phase is also recorded if ``--memory`` is used - this slows everything
+down considerably.
+
+The ``startup`` command measures the time taken to import ``deets.main``
+(via ``python -X importtime``), which is all that is needed for e.g.
+``deets --help``, and checks that none of the ``SLOW_MODULES`` are imported.
+It exits with a non-zero status if the check fails, or if the import time
+exceeds the budget, so can be used as a regression test.
+
+The ``stress`` command is a multi-process stress test of concurrent access
+to one vault (see ``db.save_database``)::
+
+    python -m deets.benchmark stress -p 8 -n 50
+
+Each writer process repeatedly loads the vault, adds an account of its own
+and (sometimes) changes an account shared by all writers, then saves it -
+retrying if its changes conflict with those of another writer. Reader processes
+repeatedly load the vault, and check that it can be read. Once all
+processes have finished, the vault is checked to contain every account
+added by every writer, and the number of changes made to the shared
+account. The command exits with a non-zero status if any check fails.
+
+The ``formats`` command compares the file size, and the time taken to
+save, load, and open (load and decrypt every entry) vaults saved with each
+encoding (see ``db.load_database``) and compression method (see
+``deets.compression``)::
+
+    python -m deets.benchmark formats -s 1000 100000
+
+The ``serve`` command measures the throughput and latency of ``deets serve``
+(see ``deets.server``), with many concurrent clients::
+
+    python -m deets.benchmark serve -s 10000 -c 1000 -n 20
+
+The server is run in a separate process. Each client opens one connection,
+and requests random accounts over it. Every response is checked against the
+vault, and one account is changed repeatedly while the clients are running,
+to check that the server picks up changes made by other processes.
+
+The ``export`` command compares the time taken, and the peak memory
+allocated, to export every account to an encrypted JSON Lines file, and to
+read it back, when the file is encrypted in segments (see ``deets.stream``),
+and when it is encrypted as a single Fernet token::
+
+    python -m deets.benchmark export -s 1000 100000
+
+The ``password`` command measures the time taken to change the master
+password of a vault and save it, and checks that the vault was not
+re-written, only its key slots (see ``deets.keys``)::
+
+    python -m deets.benchmark password -s 1000 100000
+
+Vaults are generated by ``generate_database``. Each account has one unique
+name, and (by default) one name chosen from a shared vocabulary of names,
+according to a Zipf distribution, so that some names are shared by many
+accounts, and most by only a few. Nothing is sent over the network, and all
+files are created in a temporary directory.
+"""
+
+
+import os.path as op
+import            os
+import            contextlib
+import            tracemalloc
+import            subprocess
+import            multiprocessing
+import            resource
+import            platform
+import            tempfile
+import            argparse
+import            random
+import            string
+import            json
+import            time
+import            sys
+import            io
+
+from typing import Dict, Any, List, Tuple
+
+from . import bulk
+from . import compression
+from . import encryption
+from . import index
+from . import stream
+from . import ui
+from . import db as deetsdb
+
+
+PASSWORD = 'benchmark'
+"""Master password of generated vaults. """
+
+
+DEFAULT_SIZES = [10, 100, 1000, 10000, 100000]
+"""Default vault sizes to benchmark. """
+
+
+DEFAULT_STARTUP_BUDGET = 75
+"""Default budget, in milliseconds, for importing ``deets.main``. """
+
+
+SLOW_MODULES = ['cryptography', 'readline', 'socket', 'deets.commands',
+                'deets.encryption', 'deets.db', 'deets.agent']
+"""Modules which must not be imported when ``deets.main`` is imported -
+they should only be imported when needed by a command.
+"""
+
+
+def generate_database(size  : int,
+                      names : int   = 2,
+                      vocab : int   = 100,
+                      zipf  : float = 1.0,
+                      notes : float = 0.2,
+                      seed  : int   = 0) -> deetsdb.Database:
+    """Generate a ``Database`` containing ``size`` random accounts.
+
+    :arg size:  Number of accounts
+    :arg names: Number of names per account - one unique name, and
+                ``names - 1`` names from a shared vocabulary.
+    :arg vocab: Size of the shared vocabulary
+    :arg zipf:  Exponent of the Zipf distribution that shared names are
+                drawn from. ``0`` gives a uniform distribution; larger
+                values cause a small number of names to be shared by most
+                accounts.
+    :arg notes: Proportion of accounts which have notes
+    :arg seed:  Seed for the random number generator
+    """
+    rng     = random.Random(seed)
+    shared  = [f'{rng.choice(string.ascii_lowercase)}tag{i}'
+               for i in range(vocab)]
+    weights = [1 / (i + 1) ** zipf for i in range(vocab)]
+    chars   = string.ascii_letters + string.digits
+
+    def records():
+        for i in range(size):
+            unique    = ''.join(rng.choices(string.ascii_lowercase, k=6))
+            acctnames = [f'{unique}{i}']
+            if names > 1:
+                acctnames += rng.choices(shared, weights, k=names - 1)
+            username  = f'user{i}@example.com'
+            password  = ''.join(rng.choices(chars, k=20))
+            if rng.random() < notes: acctnotes = f'Notes for account {i}'
+            else:                    acctnotes = None
+            yield acctnames, username, password, acctnotes
+
+    db = deetsdb.Database(PASSWORD)
+    db.update(records())
+    return db
+
+
+class PhaseTimer:
+    """Records the time and memory used by a sequence of phases. Use as a
+    context manager, e.g.::
+
+        timer = PhaseTimer()
+        with timer('parse'):
+            ...
+        print(timer.results)
+    """
+
+
+    def __init__(self, memory : bool = False):
+        self.memory  = memory
+        self.results = {}
+
+
+    @contextlib.contextmanager
+    def __call__(self, phase : str, count : int = None):
+        """Time a phase. If ``count`` is provided, the time per operation
+        is also recorded.
+        """
+        if self.memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            result  = {'seconds' : elapsed, 'maxrss' : maxrss()}
+            if count is not None:
+                result['count']          = count
+                result['per_op_seconds'] = elapsed / max(count, 1)
+            if self.memory:
+                result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            self.results[phase] = result
+
+
+def maxrss() -> int:
+    """Return the peak resident set size of this process, in bytes. """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': return rss
+    else:                        return rss * 1024
+
+
+def benchmark(db       : deetsdb.Database,
+              lookups  : int  = 1000,
+              memory   : bool = False,
+              seed     : int  = 0) -> Dict[str, Dict[str, Any]]:
+    """Run all benchmark phases on ``db``, returning the results for each
+    phase. ``db`` is modified.
+    """
+    rng   = random.Random(seed)
+    timer = PhaseTimer(memory)
+    salt  = encryption.generate_salt()
+    kdf   = db.kdf
+
+    with timer('kdf'):
+        derived = encryption.derive_key(PASSWORD.encode(), salt, kdf)
+
+    # The key is only derived once - when the
+    # database is loaded, the derived key is used
+    encryption.set_key_deriver(lambda *a: derived)
+
+    try:
+        db.key  = encryption.MasterKey(PASSWORD, salt, kdf)
+        records = list(db.unsealed())
+
+        with timer('encrypt', len(records)):
+            for names, credentials, notes in records:
+                deetsdb.seal_entry(db.key, names, credentials, notes,
+                                   encoding=db.encoding)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = op.join(tmpdir, 'vault')
+
+            with timer('save', len(records)):
+                deetsdb.save_database(db, filename)
+
+            with timer('parse', len(records)):
+                loaded = deetsdb.load_database(filename, PASSWORD)
+
+            tokens = [token for _, token in loaded.sealed()]
+            with timer('decrypt', len(tokens)):
+                entries = [deetsdb.unseal_entry(loaded.key, token)
+                           for token in tokens]
+
+            with timer('index', len(entries)):
+                idx = index.NameIndex()
+                idx.update(e[0] for e in entries)
+
+            # Look up random accounts, by all of
+            # their names, and by their first name
+            keys    = list(loaded.keys())
+            queries = []
+            for key in rng.choices(keys, k=lookups):
+                queries.append(key)
+                queries.append(key[:1])
+            with timer('lookup', len(queries)):
+                for query in queries:
+                    loaded.lookup_keys(*query)
+
+            with timer('render', len(keys)):
+                render(loaded, keys)
+
+            del loaded, tokens, entries, idx
+    finally:
+        encryption.set_key_deriver(None)
+
+    return timer.results
+
+
+def render(db : deetsdb.Database, keys : List[deetsdb.AccountKey]):
+    """Render a table of the given accounts in the same way as the
+    ``list`` command, discarding the output.
+    """
+    stream = ui.STREAM
+    ui.set_stream(io.StringIO())
+    try:
+        accounts  = [f'[{" ".join(k)}]'       for k in keys]
+        usernames = [db[k][0]                 for k in keys]
+        notes     = [db.get_notes(k) or 'n/a' for k in keys]
+        ui.print_columns(['Account', 'Username', 'Notes'],
+                         [accounts, usernames, notes])
+    finally:
+        ui.set_stream(stream)
+
+
+def metadata() -> Dict[str, Any]:
+    """Return information about the environment the benchmarks are run in.
+    """
+    meta = {
+        'timestamp' : time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python'    : platform.python_version(),
+        'platform'  : platform.platform(),
+        'machine'   : platform.machine(),
+    }
+    try:
+        meta['commit'] = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=op.dirname(op.abspath(__file__)),
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return meta
+
+
+def run(args : argparse.Namespace) -> Dict[str, Any]:
+    """Run the benchmarks for each vault size. """
+
+    config = {
+        'names'      : args.names,
+        'vocab'      : args.vocab,
+        'zipf'       : args.zipf,
+        'notes'      : args.notes,
+        'lookups'    : args.lookups,
+        'iterations' : args.iterations,
+        'encoding'   : args.encoding,
+        'seed'       : args.seed,
+    }
+    results = {'meta' : metadata(), 'config' : config, 'results' : []}
+
+    for size in args.sizes:
+        ui.printmsg(f'Benchmarking {size} entries ...', ui.INFO)
+        db = generate_database(size,
+                               names=args.names,
+                               vocab=args.vocab,
+                               zipf=args.zipf,
+                               notes=args.notes,
+                               seed=args.seed)
+        if args.iterations is not None:
+            db.kdf = dict(db.kdf, iterations=args.iterations)
+        db.encoding = args.encoding
+
+        phases = benchmark(db, args.lookups, args.memory, args.seed)
+        results['results'].append({'size' : size, 'phases' : phases})
+        print_results(size, phases)
+
+    return results
+
+
+def print_results(size : int, phases : Dict[str, Dict[str, Any]]):
+    """Print a table of results for one vault size. """
+    titles = ['Phase', 'Seconds', 'Per entry/op (us)', 'Peak RSS (MB)']
+    rows   = [[], [], [], []]
+    for phase, result in phases.items():
+        per = result.get('per_op_seconds')
+        rows[0].append(phase)
+        rows[1].append(f'{result["seconds"]:0.4f}')
+        rows[2].append('' if per is None else f'{per * 1e6:0.2f}')
+        rows[3].append(f'{result["maxrss"] / 1048576:0.1f}')
+    ui.printmsg(f'\n{size} entries', ui.EMPHASIS)
+    ui.print_columns(titles, rows)
+
+
+def compare(before : Dict[str, Any], after : Dict[str, Any]):
+    """Print the ratio of the time taken for each phase and vault size in
+    ``after`` relative to ``before``.
+    """
+    before = {r['size'] : r['phases'] for r in before['results']}
+    after  = {r['size'] : r['phases'] for r in after['results']}
+    sizes  = [s for s in after if s in before]
+    phases = [p for s in sizes for p in after[s]]
+    phases = list(dict.fromkeys(phases))
+
+    titles = ['Phase'] + [str(s) for s in sizes]
+    cols   = [phases]
+    for size in sizes:
+        col = []
+        for phase in phases:
+            old = before[size].get(phase, {}).get('seconds')
+            new = after[ size].get(phase, {}).get('seconds')
+            if not old or new is None: col.append('')
+            else:                      col.append(f'{new / old:0.2f}x')
+        cols.append(col)
+
+    ui.printmsg('Time relative to baseline, by number of entries',
+                ui.EMPHASIS)
+    ui.print_columns(titles, cols)
+
+
+def import_time(module : str) -> Tuple[float, List[str]]:
+    """Import ``module`` in a new Python process, with ``-X importtime``.
+    Returns the cumulative time taken to import it, in seconds, and the
+    names of all modules that were imported.
+    """
+    pkgdir = op.dirname(op.dirname(op.abspath(__file__)))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=pkgdir, capture_output=True, text=True, check=True)
+
+    # Lines are of the form:
+    # "import time: <self us> | <cumulative us> | <indent><module>"
+    elapsed = None
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        name   = fields[2].strip()
+        if not fields[1].strip().isdigit():
+            continue
+        modules.append(name)
+        if name == module:
+            elapsed = int(fields[1]) / 1e6
+    return elapsed, modules
+
+
+def startup(args : argparse.Namespace) -> bool:
+    """Check the time taken to import ``deets.main`` against a budget.
+    Returns ``True`` if the check passes.
+    """
+    times = []
+    for _ in range(args.repeat):
+        elapsed, modules = import_time('deets.main')
+        times.append(elapsed)
+
+    elapsed = sorted(times)[len(times) // 2]
+    slow    = [m for m in modules
+               if any(m == s or m.startswith(f'{s}.') for s in SLOW_MODULES)]
+    passed  = len(slow) == 0 and elapsed * 1000 <= args.budget
+
+    ui.printmsg('deets.main import time (median of ', ui.INFO,
+                f'{args.repeat}',                      ui.EMPHASIS,
+                '): ',                                 ui.INFO,
+                f'{elapsed * 1000:0.1f} ms',           ui.EMPHASIS,
+                f' (budget: {args.budget:0.0f} ms)',   ui.INFO)
+    if len(slow) > 0:
+        ui.printmsg('Modules imported at startup which should be '
+                    'imported lazily: ', ui.ERROR,
+                    ', '.join(slow),     ui.EMPHASIS)
+    if passed: ui.printmsg('PASS', ui.IMPORTANT)
+    else:      ui.printmsg('FAIL', ui.ERROR)
+    return passed
+
+
+def stress_writer(path : str, worker : int, count : int) -> Dict[str, int]:
+    """Writer process for ``stress``. Returns the number of saves which
+    changed the shared account, which were merged with changes made by other
+    processes, and which conflicted.
+    """
+    # compact frequently, so that merges
+    # with compacted files are exercised
+    deetsdb.LOG_COMPACT_THRESHOLD = 10
+    rng    = random.Random(worker)
+    counts = {'shared' : 0, 'merged' : 0, 'conflicts' : 0}
+    for i in range(count):
+        share = rng.random() < 0.2
+        while True:
+            db = deetsdb.load_database(path, PASSWORD)
+            db[(f'worker{worker}', f'item{i}')] = (f'user{i}', f'pass{i}')
+
+            # Identical changes are not conflicts, so each
+            # writer makes a different change to the shared
+            # account, so that lost updates are detected
+            if share:
+                total = int(db[('shared',)][1])
+                db[('shared',)] = (f'worker{worker}', str(total + 1))
+
+            time.sleep(rng.random() * 0.005)
+            try:
+                if deetsdb.save_database(db, path):
+                    counts['merged'] += 1
+                break
+            except deetsdb.ConflictError:
+                counts['conflicts'] += 1
+        counts['shared'] += share
+    return counts
+
+
+def stress_reader(path : str, stop : multiprocessing.Event) -> int:
+    """Reader process for ``stress``. Returns the number of loads. """
+    loads = 0
+    while not stop.is_set():
+        db = deetsdb.load_database(path, PASSWORD)
+        db[deetsdb.sanitise_key(['shared'])]
+        loads += 1
+    return loads
+
+
+def stress(args : argparse.Namespace) -> bool:
+    """Run a multi-process stress test of concurrent access to one vault.
+    Returns ``True`` if the test passes.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path        = op.join(tmpdir, 'vault')
+        db          = deetsdb.Database(PASSWORD)
+        db.kdf      = {'algorithm' : 'pbkdf2-sha256', 'iterations' : 1000}
+        db.encoding = args.encoding
+        db[('shared',)] = ('shared', '0')
+        if args.sharded:
+            os.mkdir(path)
+        deetsdb.save_database(db, path)
+
+        ctx     = multiprocessing.get_context('spawn')
+        stop    = ctx.Manager().Event()
+        start   = time.perf_counter()
+        with ctx.Pool(args.processes + args.readers) as pool:
+            readers = [pool.apply_async(stress_reader, (path, stop))
+                       for _ in range(args.readers)]
+            writers = [pool.apply_async(stress_writer, (path, w, args.count))
+                       for w in range(args.processes)]
+            counts  = [w.get() for w in writers]
+            stop.set()
+            loads   = sum(r.get() for r in readers)
+        elapsed = time.perf_counter() - start
+
+        db       = deetsdb.load_database(path, PASSWORD)
+        expected = {deetsdb.sanitise_key((f'worker{w}', f'item{i}'))
+                    for w in range(args.processes)
+                    for i in range(args.count)}
+        missing  = expected.difference(db.keys())
+        total    = int(db[('shared',)][1])
+
+    saves     = args.processes * args.count
+    shared    = sum(c['shared']    for c in counts)
+    merged    = sum(c['merged']    for c in counts)
+    conflicts = sum(c['conflicts'] for c in counts)
+    passed    = len(missing) == 0 and total == shared
+
+    ui.printmsg(f'{args.processes} writers x {args.count} saves, '
+                f'{args.readers} readers: {elapsed:0.2f} seconds', ui.INFO)
+    ui.printmsg(f'Saves: {saves}, merged: {merged}, conflicts (retried): '
+                f'{conflicts}, reader loads: {loads}', ui.INFO)
+    if len(missing) > 0:
+        ui.printmsg(f'{len(missing)} accounts missing from vault', ui.ERROR)
+    if total != shared:
+        ui.printmsg(f'Shared account changed {total} times (expected '
+                    f'{shared})', ui.ERROR)
+    if passed: ui.printmsg('PASS', ui.IMPORTANT)
+    else:      ui.printmsg('FAIL', ui.ERROR)
+    return passed
+
+
+def formats_benchmark(args : argparse.Namespace):
+    """Compare vaults saved with each encoding and compression method. """
+
+    formats = [(encoding, method)
+               for encoding in deetsdb.ENCODINGS
+               for method   in [None] + compression.METHODS]
+    titles  = ['Entries', 'Encoding', 'Compression', 'File size (KB)',
+               'Bytes/entry', 'Save (s)', 'Load (s)', 'Open (s)']
+    rows    = [[] for _ in titles]
+
+    for size in args.sizes:
+        db     = generate_database(size, seed=args.seed)
+        db.kdf = {'algorithm' : 'pbkdf2-sha256', 'iterations' : 1000}
+
+        for encoding, method in formats:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                filename         = op.join(tmpdir, 'vault')
+                snap             = db.snapshot()
+                snap.encoding    = encoding
+                snap.compression = method
+
+                start = time.perf_counter()
+                deetsdb.save_database(snap, filename)
+                save  = time.perf_counter() - start
+
+                # Every entry is decrypted by Database.keys
+                start  = time.perf_counter()
+                loaded = deetsdb.load_database(filename, PASSWORD)
+                load   = time.perf_counter() - start
+                nkeys  = len(loaded.keys())
+                opened = time.perf_counter() - start
+                fsize  = op.getsize(filename)
+
+            row = [size, encoding, method or 'none', f'{fsize / 1024:0.1f}',
+                   f'{fsize / nkeys:0.1f}', f'{save:0.3f}', f'{load:0.3f}',
+                   f'{opened:0.3f}']
+            for col, val in zip(rows, row):
+                col.append(str(val))
+
+    ui.print_columns(titles, rows, pager=False)
+
+
+def export_benchmark(args : argparse.Namespace):
+    """Compare encrypted exports encrypted in segments (``deets.stream``)
+    against exports encrypted as a single Fernet token.
+    """
+
+    kdf    = {'algorithm' : 'pbkdf2-sha256', 'iterations' : 1000}
+    titles = ['Entries', 'Method', 'File size (KB)', 'Export (s)',
+              'Export peak (KB)', 'Import (s)', 'Import peak (KB)']
+    rows   = [[] for _ in titles]
+
+    def measure(func):
+        tracemalloc.start()
+        base  = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        peak    = tracemalloc.get_traced_memory()[1] - base
+        tracemalloc.stop()
+        return elapsed, peak
+
+    def export_stream(filename, records):
+        with open(filename, 'wb') as raw, \
+             stream.EncryptingWriter(raw, PASSWORD, kdf) as enc, \
+             io.TextIOWrapper(enc, newline='') as f:
+            bulk.write_records(f, 'jsonl', records)
+
+    def import_stream(filename):
+        with open(filename, 'rb') as raw:
+            reader = stream.DecryptingReader(raw, PASSWORD)
+            with io.TextIOWrapper(io.BufferedReader(reader),
+                                  newline='') as f:
+                return sum(1 for _ in bulk.read_records(f, 'jsonl'))
+
+    def export_whole(filename, records):
+        key = encryption.MasterKey(PASSWORD, kdf=kdf)
+        buf = io.StringIO(newline='')
+        bulk.write_records(buf, 'jsonl', records)
+        token = key.encrypt('export', buf.getvalue().encode())
+        with open(filename, 'wb') as f:
+            f.write(key.salt)
+            f.write(token)
+
+    def import_whole(filename):
+        with open(filename, 'rb') as f:
+            data = f.read()
+        key  = encryption.MasterKey(PASSWORD, data[:16], kdf)
+        text = key.decrypt('export', data[16:]).decode()
+        return sum(1 for _ in bulk.read_records(io.StringIO(text), 'jsonl'))
+
+    methods = {'stream' : (export_stream, import_stream),
+               'whole'  : (export_whole,  import_whole)}
+
+    for size in args.sizes:
+        db      = generate_database(size, seed=args.seed)
+        records = [(acct, *db[acct], db.get_notes(acct))
+                   for acct in sorted(db.keys())]
+
+        for method, (exportf, importf) in methods.items():
+            with tempfile.TemporaryDirectory() as tmpdir:
+                filename       = op.join(tmpdir, 'export.jsonl')
+                etime, epeak   = measure(lambda: exportf(filename, records))
+                count          = []
+                itime, ipeak   = measure(
+                    lambda: count.append(importf(filename)))
+                fsize          = op.getsize(filename)
+
+            if count[0] != size:
+                raise RuntimeError(f'{method}: expected {size} accounts, '
+                                   f'read {count[0]}')
+
+            row = [size, method, f'{fsize / 1024:0.1f}', f'{etime:0.3f}',
+                   f'{epeak / 1024:0.1f}', f'{itime:0.3f}',
+                   f'{ipeak / 1024:0.1f}']
+            for col, val in zip(rows, row):
+                col.append(str(val))
+
+    ui.print_columns(titles, rows, pager=False)
+
+
+def password_benchmark(args : argparse.Namespace) -> bool:
+    """Time changing the master password of vaults of different sizes and
+    encodings. Returns ``False`` if any vault file was re-written, or could
+    not be loaded with the new password.
+    """
+
+    kdf     = {'algorithm' : 'pbkdf2-sha256', 'iterations' : 1000}
+    titles  = ['Entries', 'Vault', 'File size (KB)', 'Change (s)',
+               'Re-written']
+    rows    = [[] for _ in titles]
+    vaults  = [(encoding, sharded)
+               for sharded  in (False, True)
+               for encoding in deetsdb.ENCODINGS]
+    ok      = True
+
+    def files(path):
+        if op.isdir(path):
+            return {f : os.stat(op.join(path, f)).st_ino
+                    for f in os.listdir(path) if f.startswith('shard-')}
+        return os.stat(path).st_ino
+
+    for size in args.sizes:
+        db     = generate_database(size, seed=args.seed)
+        db.kdf = kdf
+
+        for encoding, sharded in vaults:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                filename      = op.join(tmpdir, 'vault')
+                snap          = db.snapshot()
+                snap.encoding = encoding
+                if sharded: os.mkdir(filename)
+                deetsdb.save_database(snap, filename)
+                loaded = deetsdb.load_database(filename, PASSWORD)
+                before = files(filename)
+
+                start = time.perf_counter()
+                loaded.password = 'changed'
+                deetsdb.save_database(loaded, filename)
+                elapsed = time.perf_counter() - start
+
+                rewritten = files(filename) != before
+                loaded    = deetsdb.load_database(filename, 'changed')
+                if rewritten or len(loaded.keys()) != size:
+                    ok = False
+
+                if sharded: fsize = sum(op.getsize(op.join(filename, f))
+                                        for f in os.listdir(filename))
+                else:       fsize = op.getsize(filename)
+
+            if sharded: vault = f'{encoding} (sharded)'
+            else:       vault = encoding
+            row = [size, vault, f'{fsize / 1024:0.1f}', f'{elapsed:0.4f}',
+                   'yes' if rewritten else 'no']
+            for col, val in zip(rows, row):
+                col.append(str(val))
+
+    ui.print_columns(titles, rows, pager=False)
+    print('PASS' if ok else 'FAIL')
+    return ok
+
+
+def serve_process(path : str, sockpath : str):
+    """Server process for ``serve_benchmark``. """
+    from . import server
+    db = deetsdb.load_database(path, PASSWORD)
+    server.serve(db, path, sockpath, poll=0.1)
+
+
+async def serve_client(sockpath : str,
+                       token    : str,
+                       accounts : List[deetsdb.AccountKey],
+                       count    : int,
+                       rng      : random.Random) -> List[float]:
+    """Client for ``serve_benchmark``. Requests ``count`` random accounts
+    over one connection, and returns the latency of each request.
+    """
+    import asyncio
+    import urllib.parse as urlparse
+    reader, writer = await asyncio.open_unix_connection(sockpath)
+    latencies      = []
+    try:
+        for _ in range(count):
+            key     = rng.choice(accounts)
+            request = (f'GET /v1/accounts/{urlparse.quote(" ".join(key))} '
+                       'HTTP/1.1\r\nHost: localhost\r\n'
+                       f'Authorization: Bearer {token}\r\n\r\n')
+            start = time.perf_counter()
+            writer.write(request.encode())
+            head   = await reader.readuntil(b'\r\n\r\n')
+            length = int(head.split(b'Content-Length: ')[1].split(b'\r\n')[0])
+            body   = json.loads(await reader.readexactly(length))
+            latencies.append(time.perf_counter() - start)
+            if tuple(body['names']) != key:
+                raise RuntimeError(f'Wrong account returned for {key}: '
+                                   f'{body}')
+    finally:
+        writer.close()
+    return latencies
+
+
+def serve_benchmark(args : argparse.Namespace) -> bool:
+    """Benchmark ``deets serve`` with many concurrent clients. Returns
+    ``True`` if every response was correct.
+    """
+    import asyncio
+    from . import server
+
+    server.raise_file_limit()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path     = op.join(tmpdir, 'vault')
+        sockpath = op.join(tmpdir, 'serve.sock')
+        db       = generate_database(args.size)
+        db.kdf   = {'algorithm' : 'pbkdf2-sha256', 'iterations' : 1000}
+        db[('changing',)] = ('changing', '0')
+        deetsdb.save_database(db, path)
+        accounts = list(db.keys())
+        token    = server.add_client(path, 'benchmark')
+
+        ctx  = multiprocessing.get_context('spawn')
+        proc = ctx.Process(target=serve_process, args=(path, sockpath))
+        proc.start()
+        try:
+            while not op.exists(sockpath):
+                time.sleep(0.05)
+
+            async def run_clients():
+                loop    = asyncio.get_running_loop()
+                clients = [serve_client(sockpath, token, accounts, args.count,
+                                        random.Random(i))
+                           for i in range(args.clients)]
+
+                # Change one account while the clients are running
+                def writer():
+                    wdb = deetsdb.load_database(path, PASSWORD)
+                    for i in range(1, 11):
+                        wdb[('changing',)] = ('changing', str(i))
+                        deetsdb.save_database(wdb, path)
+                        time.sleep(0.05)
+
+                start     = time.perf_counter()
+                write     = loop.run_in_executor(None, writer)
+                latencies = await asyncio.gather(*clients)
+                elapsed   = time.perf_counter() - start
+                await write
+                return elapsed, [l for ls in latencies for l in ls]
+
+            elapsed, latencies = asyncio.run(run_clients())
+
+            # The server polls every 0.1 seconds
+            time.sleep(0.5)
+            changed = server.fetch('changing', token, sockpath)['password']
+        finally:
+            proc.terminate()
+            proc.join()
+
+    latencies = sorted(latencies)
+    nreqs     = len(latencies)
+    passed    = changed == '10'
+    ui.printmsg(f'{args.size} accounts, {args.clients} clients x '
+                f'{args.count} requests: {elapsed:0.2f} seconds '
+                f'({nreqs / elapsed:0.0f} requests/second)', ui.INFO)
+    ui.printmsg(f'Latency (ms): median {latencies[nreqs // 2] * 1000:0.2f}, '
+                f'99th percentile '
+                f'{latencies[int(nreqs * 0.99)] * 1000:0.2f}', ui.INFO)
+    if not passed:
+        ui.printmsg(f'Changed account not reloaded (password: {changed}, '
+                    'expected: 10)', ui.ERROR)
+    if passed: ui.printmsg('PASS', ui.IMPORTANT)
+    else:      ui.printmsg('FAIL', ui.ERROR)
+    return passed
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        'deets.benchmark', description='deets performance benchmarks')
+    sub = parser.add_subparsers(title='Commands', dest='command')
+
+    runp = sub.add_parser('run', help='Run benchmarks')
+    runp.add_argument('-s', '--sizes', type=int, nargs='+',
+                      default=DEFAULT_SIZES,
+                      help='Vault sizes (number of entries)')
+    runp.add_argument('-o', '--output', help='Save results to this JSON file')
+    runp.add_argument('-n', '--names', type=int, default=2,
+                      help='Names per account (default: 2)')
+    runp.add_argument('-v', '--vocab', type=int, default=100,
+                      help='Number of shared names (default: 100)')
+    runp.add_argument('-z', '--zipf', type=float, default=1.0,
+                      help='Zipf exponent of the shared name distribution '
+                           '(default: 1.0, 0 for uniform)')
+    runp.add_argument('--notes', type=float, default=0.2,
+                      help='Proportion of accounts with notes '
+                           '(default: 0.2)')
+    runp.add_argument('-l', '--lookups', type=int, default=1000,
+                      help='Number of random accounts to look up '
+                           '(default: 1000)')
+    runp.add_argument('-i', '--iterations', type=int,
+                      help='KDF iterations (default: '
+                           f'{encryption.DEFAULT_KDF["iterations"]})')
+    runp.add_argument('-m', '--memory', action='store_true',
+                      help='Record peak memory allocated in each phase')
+    runp.add_argument('-e', '--encoding', choices=deetsdb.ENCODINGS,
+                      default='json',
+                      help='Database file encoding (default: json)')
+    runp.add_argument('--seed', type=int, default=0,
+                      help='Random seed (default: 0)')
+
+    cmpp = sub.add_parser('compare', help='Compare two sets of results')
+    cmpp.add_argument('before', help='Baseline results file')
+    cmpp.add_argument('after',  help='Results file to compare')
+
+    startp = sub.add_parser('startup', help='Check startup import time')
+    startp.add_argument('-b', '--budget', type=float,
+                        default=DEFAULT_STARTUP_BUDGET,
+                        help='Import time budget in milliseconds (default: '
+                             f'{DEFAULT_STARTUP_BUDGET})')
+    startp.add_argument('-r', '--repeat', type=int, default=5,
+                        help='Number of times to measure (default: 5)')
+
+    stressp = sub.add_parser('stress',
+                             help='Stress test concurrent access to a vault')
+    stressp.add_argument('-p', '--processes', type=int, default=8,
+                         help='Number of writer processes (default: 8)')
+    stressp.add_argument('-r', '--readers', type=int, default=2,
+                         help='Number of reader processes (default: 2)')
+    stressp.add_argument('-n', '--count', type=int, default=50,
+                         help='Number of saves by each writer (default: 50)')
+    stressp.add_argument('-s', '--sharded', action='store_true',
+                         help='Use a sharded vault directory')
+    stressp.add_argument('-e', '--encoding', choices=deetsdb.ENCODINGS,
+                         default='json',
+                         help='Database file encoding (default: json)')
+
+    compp = sub.add_parser('formats',
+                           help='Compare vault encodings and compression '
+                                'methods')
+    compp.add_argument('-s', '--sizes', type=int, nargs='+',
+                       default=[1000, 100000],
+                       help='Vault sizes (default: 1000 100000)')
+    compp.add_argument('--seed', type=int, default=0,
+                       help='Random seed (default: 0)')
+
+    exportp = sub.add_parser('export',
+                             help='Compare encrypted export methods')
+    exportp.add_argument('-s', '--sizes', type=int, nargs='+',
+                         default=[1000, 100000],
+                         help='Vault sizes (default: 1000 100000)')
+    exportp.add_argument('--seed', type=int, default=0,
+                         help='Random seed (default: 0)')
+
+    passp = sub.add_parser('password',
+                           help='Time changing the master password')
+    passp.add_argument('-s', '--sizes', type=int, nargs='+',
+                       default=[1000, 100000],
+                       help='Vault sizes (default: 1000 100000)')
+    passp.add_argument('--seed', type=int, default=0,
+                       help='Random seed (default: 0)')
+
+    servep = sub.add_parser('serve',
+                            help='Benchmark deets serve with concurrent '
+                                 'clients')
+    servep.add_argument('-s', '--size', type=int, default=10000,
+                        help='Vault size (default: 10000)')
+    servep.add_argument('-c', '--clients', type=int, default=1000,
+                        help='Number of concurrent clients (default: 1000)')
+    servep.add_argument('-n', '--count', type=int, default=20,
+                        help='Number of requests by each client '
+                             '(default: 20)')
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        sys.exit(0)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.command == 'compare':
+        with open(args.before, 'rt') as f: before = json.load(f)
+        with open(args.after,  'rt') as f: after  = json.load(f)
+        compare(before, after)
+        return
+
+    if args.command == 'startup':
+        if not startup(args):
+            sys.exit(1)
+        return
+
+    if args.command == 'stress':
+        if not stress(args):
+            sys.exit(1)
+        return
+
+    if args.command == 'formats':
+        formats_benchmark(args)
+        return
+
+    if args.command == 'export':
+        export_benchmark(args)
+        return
+
+    if args.command == 'password':
+        if not password_benchmark(args):
+            sys.exit(1)
+        return
+
+    if args.command == 'serve':
+        if not serve_benchmark(args):
+            sys.exit(1)
+        return
+
+    results = run(args)
+    if args.output is not None:
+        with open(args.output, 'wt') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""Reading and writing of plain-text account records, used by the
+``import`` and ``export`` commands. Two formats are supported:
+
+ - ``csv``:   A header row, followed by one row per account. The ``names``
+              column contains space-separated account names.
+ - ``jsonl``: One JSON object per line, each with ``names`` (a list of
+              names, or a space-separated string), ``username``,
+              ``password``, and optionally ``notes`` fields.
+
+Records are ``(names, username, password, notes)`` tuples, as accepted by
+``db.Database.update``.
+"""
+
+
+import os.path as op
+import csv
+import json
+
+from typing import Iterator, Iterable, Dict, Any, TextIO
+
+from . import db as deetsdb
+
+
+FORMATS = {
+    '.csv'    : 'csv',
+    '.jsonl'  : 'jsonl',
+    '.ndjson' : 'jsonl',
+}
+"""Supported formats, indexed by file suffix. """
+
+
+FIELDS = ('names', 'username', 'password', 'notes')
+"""Fields of a record, in the order that they are written. """
+
+
+class RecordError(ValueError):
+    """Raised by ``read_records`` for an invalid record. """
+
+
+def guess_format(filename : deetsdb.pathtype) -> str:
+    """Return the format for ``filename``, based on its suffix. """
+    suffix = op.splitext(str(filename))[1].lower()
+    if suffix not in FORMATS:
+        raise ValueError(f'Cannot determine format of {filename} - '
+                         f'expected one of {", ".join(FORMATS)}')
+    return FORMATS[suffix]
+
+
+def read_records(f : TextIO, fmt : str) -> Iterator[deetsdb.recordtype]:
+    """Read records from the open file ``f``. Records are yielded as they
+    are read, so the whole file is never held in memory. Raises a
+    ``RecordError`` for any record which is invalid.
+    """
+    if fmt == 'csv':
+        rows = csv.DictReader(f)
+    elif fmt == 'jsonl':
+        rows = (json.loads(line) for line in f if line.strip() != '')
+    else:
+        raise ValueError(f'Unknown format: {fmt}')
+
+    try:
+        for lineno, row in enumerate(rows, 1):
+            yield _parse_record(row, lineno)
+    except (csv.Error, json.JSONDecodeError) as e:
+        raise RecordError(str(e)) from e
+
+
+def _parse_record(row : Dict[str, Any], lineno : int) -> deetsdb.recordtype:
+    """Convert a row read by ``read_records`` into a record. """
+
+    if not isinstance(row, dict):
+        raise RecordError(f'Record {lineno}: expected a JSON object')
+
+    names    = row.get('names')
+    username = row.get('username') or ''
+    password = row.get('password') or ''
+    notes    = row.get('notes')    or None
+
+    if isinstance(names, str):
+        names = names.split()
+    if not isinstance(names, list) or \
+       not all(isinstance(n, str) for n in names):
+        raise RecordError(f'Record {lineno}: account names must be a list '
+                          'of strings, or a string')
+    if not all(isinstance(v, str) for v in (username, password)) or \
+       not isinstance(notes, (str, type(None))):
+        raise RecordError(f'Record {lineno}: username, password and notes '
+                          'must be strings')
+    if not names or password == '':
+        raise RecordError(f'Record {lineno}: account names and '
+                          'password are required')
+    return names, username, password, notes
+
+
+def write_records(f       : TextIO,
+                  fmt     : str,
+                  records : Iterable[deetsdb.recordtype]) -> int:
+    """Write records to the open file ``f``. Returns the number of records
+    written.
+    """
+    if fmt == 'csv':
+        writer = csv.writer(f)
+        writer.writerow(FIELDS)
+        def write(names, username, password, notes):
+            writer.writerow((' '.join(names), username, password, notes))
+    elif fmt == 'jsonl':
+        def write(names, username, password, notes):
+            record = dict(zip(FIELDS, (list(names), username, password)))
+            if notes is not None:
+                record['notes'] = notes
+            f.write(json.dumps(record) + '\n')
+    else:
+        raise ValueError(f'Unknown format: {fmt}')
+
+    count = 0
+    for record in records:
+        write(*record)
+        count += 1
+    return count
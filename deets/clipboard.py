@@ -1,21 +1,444 @@
 #!/usr/bin/env python
+"""Copying passwords to the system clipboard.
 
+Several clipboard backends are supported - ``xsel``, ``xclip`` and
+``wl-copy`` on Linux, ``pbcopy`` on macOS, and the OSC 52 terminal escape
+sequence, which asks the terminal emulator to set the clipboard, without
+running any external programs (this also works over ssh, with terminals
+which support it). The backend is chosen the first time it is needed (see
+``get_backend``), and the choice is cached. The ``$DEETSCLIPBOARD``
+environment variable may be set to the name of a backend to override the
+choice, or to ``none`` to disable the clipboard.
 
+If ``copy`` is given a ``clear_after`` delay, the clipboard is restored to
+its previous contents (or cleared, if they cannot be read) after that many
+seconds, unless something else has been copied in the meantime. This is
+done by a small background process (``python -m deets.clipboard``), so
+does not block the command, and happens even if ``deets`` has exited. The
+background process also reads and sets the clipboard, so that ``deets``
+itself only starts one process.
+Long-running commands (e.g. ``repl``) can instead call ``start_session``,
+so that the clipboard is restored by a timer thread, without starting a
+new process for every copy - any restore which is still pending when
+``end_session`` is called is handed over to a background process.
+"""
+
+
+import os
 import sys
-import shlex
+import time
+import shutil
+import base64 as b64
 import subprocess as sp
 
+from typing import List, Union
+
+from . import trace
+
+
+class Backend:
+    """Base class for clipboard backends. """
+
+    name = None
+    """Name used to select this backend via ``$DEETSCLIPBOARD``. """
+
+    inprocess = False
+    """Set to ``True`` for backends whose contents only exist within this
+    process - the clipboard is then cleared by a timer thread rather than by
+    a background process.
+    """
+
+    def available(self) -> bool:
+        """Return ``True`` if this backend can be used. """
+        raise NotImplementedError()
+
+    def copy(self, text : str):
+        """Set the clipboard contents. """
+        raise NotImplementedError()
+
+    def paste(self) -> Union[str, None]:
+        """Return the clipboard contents, or ``None`` if they cannot be
+        read.
+        """
+        return None
+
+    def clear(self):
+        """Clear the clipboard. """
+        self.copy('')
+
+
+class CommandBackend(Backend):
+    """Backend which runs external commands to copy/paste/clear. """
+
+    copycmd  = None
+    pastecmd = None
+    clearcmd = None
+    envvar   = None
+    """Environment variable which must be set (e.g. ``$DISPLAY``) for the
+    backend to be usable.
+    """
+
+    def available(self) -> bool:
+        if self.envvar is not None and not os.environ.get(self.envvar):
+            return False
+        return shutil.which(self.copycmd[0]) is not None
+
+    def copy(self, text : str):
+        # Output is discarded rather than captured,
+        # as e.g. xsel forks a process which keeps
+        # running to serve the clipboard contents
+        sp.run(self.copycmd, input=text, text=True,
+               stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+
+    def paste(self) -> Union[str, None]:
+        if self.pastecmd is None:
+            return None
+        try:
+            result = sp.run(self.pastecmd, capture_output=True, text=True,
+                            timeout=5)
+        except (OSError, sp.TimeoutExpired):
+            return None
+        if result.returncode != 0:
+            return None
+        return result.stdout
+
+    def clear(self):
+        if self.clearcmd is None:
+            self.copy('')
+        else:
+            sp.run(self.clearcmd, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+
+
+class XselBackend(CommandBackend):
+    name     = 'xsel'
+    envvar   = 'DISPLAY'
+    copycmd  = ['xsel', '--clipboard', '--input']
+    pastecmd = ['xsel', '--clipboard', '--output']
+    clearcmd = ['xsel', '--clipboard', '--clear']
+
+
+class XclipBackend(CommandBackend):
+    name     = 'xclip'
+    envvar   = 'DISPLAY'
+    copycmd  = ['xclip', '-selection', 'clipboard', '-in']
+    pastecmd = ['xclip', '-selection', 'clipboard', '-out']
+
+
+class WlCopyBackend(CommandBackend):
+    name     = 'wl-copy'
+    envvar   = 'WAYLAND_DISPLAY'
+    copycmd  = ['wl-copy']
+    pastecmd = ['wl-paste', '--no-newline']
+    clearcmd = ['wl-copy', '--clear']
+
+
+class PbcopyBackend(CommandBackend):
+    name     = 'pbcopy'
+    copycmd  = ['pbcopy']
+    pastecmd = ['pbpaste']
+
+    def available(self) -> bool:
+        return sys.platform == 'darwin' and super().available()
+
+
+class OSC52Backend(Backend):
+    """Sets the clipboard by writing an OSC 52 escape sequence to the
+    terminal. The clipboard cannot be read.
+    """
+    name = 'osc52'
+
+    def available(self) -> bool:
+        try:
+            os.close(os.open('/dev/tty', os.O_WRONLY))
+            return True
+        except OSError:
+            return False
+
+    def __write(self, data : str):
+        with open('/dev/tty', 'wt') as tty:
+            tty.write(f'\033]52;c;{data}\a')
+
+    def copy(self, text : str):
+        self.__write(b64.b64encode(text.encode()).decode())
+
+    def clear(self):
+        # Terminals clear the clipboard
+        # when given invalid base64 data
+        self.__write('!')
+
+
+class FakeBackend(Backend):
+    """In-memory clipboard, for testing. Every value which is copied is
+    appended to ``history``.
+    """
+    name      = 'fake'
+    inprocess = True
+
+    def __init__(self):
+        self.contents = None
+        self.history  = []
+
+    def available(self) -> bool:
+        return True
+
+    def copy(self, text : str):
+        self.contents = text
+        self.history.append(text)
+
+    def paste(self) -> Union[str, None]:
+        return self.contents
+
+    def clear(self):
+        self.contents = None
+
+
+BACKENDS = [PbcopyBackend, WlCopyBackend, XselBackend, XclipBackend,
+            OSC52Backend, FakeBackend]
+"""All backends, in order of preference. The ``FakeBackend`` is only used
+if selected via ``$DEETSCLIPBOARD``.
+"""
+
+
+_backend = None
+"""The backend chosen by ``get_backend``, or set via ``set_backend``. """
+
+
+_timer = None
+"""Timer used to restore the clipboard in this process - see ``copy``. """
+
+
+_pending = None
+"""``(backend, text, previous, deadline)`` for the restore scheduled by
+``_timer``.
+"""
+
+
+_session = False
+"""Set by ``start_session`` and ``end_session``. """
+
+
+def set_backend(backend : Union[Backend, None]):
+    """Use ``backend`` for all subsequent copies. Pass ``None`` to choose a
+    backend automatically on the next copy.
+    """
+    global _backend
+    _backend = backend
+
+
+def get_backend() -> Union[Backend, None]:
+    """Return the clipboard backend, choosing one if this has not already
+    been done. Returns ``None`` if no backend is available.
+    """
+    global _backend
+    if _backend is not None:
+        return _backend
+
+    name = os.environ.get('DEETSCLIPBOARD')
+    if name == 'none':
+        return None
+
+    with trace.span('clipboard.probe'):
+        for cls in BACKENDS:
+            if name is None and cls is FakeBackend:
+                continue
+            if name is not None and cls.name != name:
+                continue
+            backend = cls()
+            if backend.available():
+                _backend = backend
+                break
+    return _backend
+
+
+def start_session():
+    """Called by long-running commands. Until ``end_session`` is called, the
+    clipboard is restored by a timer thread in this process, rather than by
+    a background process.
+    """
+    global _session
+    _session = True
+
+
+def end_session():
+    """Called when a long-running command finishes. If the clipboard is still
+    to be restored, this is handed over to a background process.
+    """
+    global _session, _timer, _pending
+    _session = False
+
+    # in-process backends are still
+    # restored by the timer thread
+    pending = _pending
+    if pending is None or pending[0].inprocess:
+        return
+
+    _timer.cancel()
+    _timer   = None
+    _pending = None
+
+    backend, text, previous, deadline = pending
+    remaining = deadline - time.monotonic()
+    if remaining > 0: _spawn_restore(backend, text, previous, remaining)
+    else:             restore(backend, text, previous)
+
+
+def copy(text : str, clear_after : float = None) -> bool:
+    """Copy ``text`` to the clipboard. Returns ``False`` if there is no
+    clipboard backend available.
+
+    Also returns ``False`` if the clipboard is to be restored, and the
+    background process which does so could not set it.
+
+    :arg text:        Text to copy
+    :arg clear_after: If provided, the clipboard is restored to its previous
+                      contents after this many seconds.
+    """
+    backend = get_backend()
+    if backend is None:
+        return False
+
+    clear     = clear_after is not None and clear_after > 0
+    inprocess = backend.inprocess or _session
+    pending   = _pending
+
+    # The background process which restores
+    # the clipboard also reads and sets it,
+    # rather than us running a command for
+    # each, and then starting the process.
+    if clear and not inprocess:
+        with trace.span('clipboard.copy', backend=backend.name):
+            return _spawn_restore(backend, text, None, clear_after, True)
+
+    with trace.span('clipboard.copy', backend=backend.name):
+        # If an earlier copy is still to be restored, the
+        # clipboard (most likely) still contains it, so
+        # its previous contents are restored instead
+        # (saving a paste, which may run a command).
+        if not clear:
+            previous = None
+        elif pending is not None and pending[0] is backend:
+            previous = pending[2]
+        else:
+            previous = backend.paste()
+        backend.copy(text)
+
+    if not clear:
+        return True
+
+    _schedule_restore(backend, text, previous, clear_after)
+    return True
+
+
+def restore(backend : Backend, text : str, previous : Union[str, None]):
+    """Restore the clipboard to ``previous``, or clear it if ``previous`` is
+    ``None``. Nothing is done if the clipboard can be read, and no longer
+    contains ``text``.
+    """
+    current = backend.paste()
+    if current is not None and current != text:
+        return
+    if previous is None or previous == text: backend.clear()
+    else:                                    backend.copy(previous)
+
+
+def _schedule_restore(backend  : Backend,
+                      text     : str,
+                      previous : Union[str, None],
+                      delay    : float):
+    """Start a timer thread which calls ``restore`` after ``delay`` seconds,
+    replacing any existing timer.
+    """
+    global _timer, _pending
+    import threading
+
+    def run():
+        global _pending
+        if _pending is pending:
+            _pending = None
+        restore(backend, text, previous)
+
+    if _timer is not None:
+        _timer.cancel()
+    pending       = (backend, text, previous, time.monotonic() + delay)
+    _pending      = pending
+    _timer        = threading.Timer(delay, run)
+    _timer.daemon = True
+    _timer.start()
+
+
+def _spawn_restore(backend  : Backend,
+                   text     : str,
+                   previous : Union[str, None],
+                   delay    : float,
+                   copy     : bool = False) -> bool:
+    """Start a background process which calls ``restore`` after ``delay``
+    seconds. The clipboard contents are passed to it via its standard
+    input, so that they do not appear in its command line.
+
+    If ``copy`` is ``True``, the process first reads the clipboard (which is
+    then restored instead of ``previous``), and copies ``text`` to it. This
+    function waits until it has done so, and returns ``False`` if it
+    failed. Otherwise ``True`` is returned immediately.
+    """
+    import json
+    request = json.dumps({'backend'  : backend.name,
+                          'text'     : text,
+                          'previous' : previous,
+                          'delay'    : delay,
+                          'copy'     : copy})
+    pkgdir  = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env     = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [pkgdir] + [p for p in [env.get('PYTHONPATH')] if p])
+
+    # The process is started in a new session,
+    # so it is not killed along with the terminal
+    # or process group that deets is running in
+    proc = sp.Popen([sys.executable, '-m', 'deets.clipboard'],
+                    stdin=sp.PIPE,
+                    stdout=sp.PIPE if copy else sp.DEVNULL,
+                    stderr=sp.DEVNULL,
+                    env=env, text=True, start_new_session=True)
+    proc.stdin.write(request)
+    proc.stdin.close()
+
+    if not copy:
+        return True
+    with proc.stdout:
+        return proc.stdout.readline() == 'copied\n'
+
+
+def main(argv : List[str] = None):
+    """Entry point for the background process started by
+    ``_spawn_restore``.
+    """
+    import json
+    import signal
+
+    # don't die if the user presses
+    # CTRL+C while deets is running
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    request = json.loads(sys.stdin.read())
+    sys.stdin.close()
 
-def copy(text : str):
-    plat = sys.platform.lower()
-    if   plat == 'linux':  _copy_linux(text)
-    elif plat == 'darwin': _copy_macos(text)
+    backend = [cls for cls in BACKENDS if cls.name == request['backend']]
+    if len(backend) == 0:
+        return
+    backend  = backend[0]()
+    text     = request['text']
+    previous = request['previous']
 
+    # tell deets that the clipboard has been set
+    if request.get('copy', False):
+        previous = backend.paste()
+        backend.copy(text)
+        sys.stdout.write('copied\n')
+        sys.stdout.close()
 
-def _copy_macos(text : str):
-    # TODO
-    pass
+    time.sleep(request['delay'])
+    restore(backend, text, previous)
 
 
-def _copy_linux(text : str):
-    sp.run(shlex.split('xsel -b -i'), text=True, input=text)
+if __name__ == '__main__':
+    main()
@@ -2,13 +2,29 @@
 #
 
 
+import io
+import os
+import os.path as op
+import re
+import sys
+import stat
+import json
 import argparse
 
+import deets.agent      as agent
+import deets.autosave   as autosave
+import deets.bulk       as bulk
 import deets.clipboard  as clipboard
 import deets.encryption as encryption
+import deets.keys       as keys
+import deets.passwords  as passwords
+import deets.shards     as shards
+import deets.stream     as stream
 import deets.db         as deetsdb
 import deets.ui         as ui
 
+from typing import List, Dict
+
 
 def select_account(db, args):
 
@@ -18,34 +34,121 @@ def select_account(db, args):
         names = deetsdb.sanitise_key(names)
 
     while True:
-        keys = db.lookup_keys(*names)
+        keys  = db.lookup_keys(*names)
+        fuzzy = len(keys) == 0
+        if fuzzy:
+            ui.printmsg(f'No entries match [{" ".join(names)}]', ui.WARNING)
+            if search_accounts(db):
+                keys = db.search(*names, unseal=True)
         if len(keys) > 0:
             break
 
-        ui.printmsg(f'No entries match [{" ".join(names)}]', ui.WARNING)
         names = ui.prompt_input('Account name(s): ', ui.PROMPT).split()
 
-    if len(keys) == 1:
+    # Exact matches - list the most specific
+    # (i.e. fewest names) accounts first
+    if not fuzzy:
+        keys = sorted(keys, key=lambda k: (len(k), k))
+
+    if len(keys) == 1 and not fuzzy:
         key = keys[0]
     else:
-        ui.printmsg('Multiple accounts match [', ui.WARNING,
-                    ' '.join(names),             ui.IMPORTANT,
-                    ']',                         ui.WARNING)
+        if fuzzy:
+            ui.printmsg('Closest matches:', ui.INFO)
+        else:
+            ui.printmsg('Multiple accounts match [', ui.WARNING,
+                        ' '.join(names),             ui.IMPORTANT,
+                        ']',                         ui.WARNING)
         lbls = [' '.join(k) for k in keys]
         key  = ui.prompt_select('Select an account: ', keys, lbls)
 
     return key
 
 
+def search_accounts(db : deetsdb.Database) -> bool:
+    """Called by ``select_account`` when no accounts match the given names.
+    Asks the user whether to search for similar names, if doing so requires
+    entries to be decrypted (which, for a large database, is slow). Returns
+    ``True`` if the search should be performed.
+    """
+    if db.num_sealed == 0:
+        return True
+    confirm = ui.prompt_input('Search all accounts for similar names? '
+                              '[N/y]: ', ui.PROMPT).lower()
+    return confirm == 'y'
+
+
+def resolve_account(db : deetsdb.Database, names : str) -> deetsdb.AccountKey:
+    """Non-interactive counterpart to ``select_account``. Returns the account
+    which matches ``names`` (a string containing one or more space-separated
+    names). An account whose names are exactly ``names`` is preferred over
+    accounts which have additional names. Raises a ``LookupError`` if no
+    account, or more than one account, matches.
+    """
+    return db.resolve(*names.split())
+
+
+def resolve_accounts(
+        db      : deetsdb.Database,
+        queries : List[str]
+) -> Dict[str, deetsdb.AccountKey]:
+    """Calls ``resolve_account`` for each query, and returns a dict of
+    ``{query : account}`` mappings. If any queries cannot be resolved, all
+    errors are printed, and the program exits.
+    """
+    accounts = {}
+    errors   = []
+    for query in queries:
+        try:
+            accounts[query] = resolve_account(db, query)
+        except LookupError as e:
+            errors.append(str(e))
+
+    if len(errors) > 0:
+        for error in errors:
+            ui.printmsg(error, ui.ERROR)
+        sys.exit(1)
+    return accounts
+
+
+def copy_password(password : str, args : argparse.Namespace) -> str:
+    """Copy ``password`` to the clipboard. Returns the password if
+    ``--print`` was used, otherwise a message to display in its place.
+    """
+    copied = clipboard.copy(password, args.clear)
+
+    if args.print:
+        return password
+    if not copied:
+        return 'not copied - no clipboard available (use --print)'
+    if args.clear > 0:
+        return f'copied to clipboard (cleared in {args.clear:0.0f} seconds)'
+    return 'copied to clipboard'
+
+
+def password_policy(args : argparse.Namespace) -> passwords.PasswordPolicy:
+    """Create a ``PasswordPolicy`` from the ``--length``, ``--class``,
+    ``--min``, ``--max`` and ``--exclude`` options. Exits with an error if
+    the options are invalid.
+    """
+    try:
+        return passwords.PasswordPolicy(
+            length=args.length,
+            classes=args.char_class,
+            minimums=passwords.parse_counts(args.min),
+            maximums=passwords.parse_counts(args.max),
+            exclude=args.exclude)
+    except ValueError as e:
+        ui.printmsg(f'Invalid password options: {e}', ui.ERROR)
+        sys.exit(1)
+
+
 def list_entries(db : deetsdb.Database, args : argparse.Namespace):
 
     if args.names is None or len(args.names) == 0:
         accounts = list(db.keys())
     else:
-        accounts = []
-        for name in args.names:
-            accounts.extend(db.lookup_keys(name))
-        accounts = sorted(set(accounts))
+        accounts = db.lookup_any(*args.names)
 
     usernames = [db[acct][0]                 for acct in accounts]
     passwords = [db[acct][1]                 for acct in accounts]
@@ -68,14 +171,15 @@ def list_entries(db : deetsdb.Database, args : argparse.Namespace):
 
 
 def get_entry(db : deetsdb.Database, args : argparse.Namespace):
+
+    if args.json:
+        return get_entries_json(db, args)
+
     account            = select_account(db, args)
     username, password = db[account]
     notes              = db.get_notes(account) or 'n/a'
     account            = ' '.join(account)
-    clipboard.copy(password)
-
-    if not args.print:
-        password = 'copied to clipboard'
+    password = copy_password(password, args)
 
     print()
     ui.printmsg('Account:  ', ui.INFO, account,  ui.EMPHASIS)
@@ -85,6 +189,76 @@ def get_entry(db : deetsdb.Database, args : argparse.Namespace):
     print()
 
 
+def get_entries_json(db : deetsdb.Database, args : argparse.Namespace):
+
+    if len(args.names) == 0:
+        ui.printmsg('At least one account must be specified', ui.ERROR)
+        sys.exit(1)
+
+    accounts = resolve_accounts(db, args.names)
+    entries  = {}
+    for query, account in accounts.items():
+        username, password = db[account]
+        entries[query]     = {'names'    : list(account),
+                              'username' : username,
+                              'password' : password,
+                              'notes'    : db.get_notes(account)}
+
+    print(json.dumps(entries, indent=2))
+
+
+def exec_command(db : deetsdb.Database, args : argparse.Namespace):
+
+    if len(args.cmd) == 0:
+        ui.printmsg('No command specified', ui.ERROR)
+        sys.exit(1)
+
+    # Each account is specified as "[PREFIX=]names" -
+    # the same account may be given more than once,
+    # with different prefixes
+    specs = []
+    for spec in args.accounts:
+        prefix, sep, query = spec.partition('=')
+        if sep == '':
+            prefix, query = '', spec
+        specs.append((prefix, query))
+
+    env      = dict(os.environ)
+    accounts = resolve_accounts(db, [query for _, query in specs])
+    prefixes = []
+    errors   = []
+
+    for prefix, query in specs:
+        account = accounts[query]
+        if prefix == '':
+            prefix = re.sub(r'[^A-Z0-9]', '_', '_'.join(account).upper())
+        if not prefix.isidentifier():
+            errors.append(f'Invalid environment variable prefix [{prefix}] '
+                          f'for account [{" ".join(account)}] - specify '
+                          'one with PREFIX=names')
+        prefixes.append((prefix, account))
+
+    if len(errors) > 0:
+        for error in errors:
+            ui.printmsg(error, ui.ERROR)
+        sys.exit(1)
+
+    for prefix, account in prefixes:
+        username, password = db[account]
+        notes              = db.get_notes(account)
+        env[f'{prefix}_USERNAME'] = username
+        env[f'{prefix}_PASSWORD'] = password
+        if notes is not None:
+            env[f'{prefix}_NOTES'] = notes
+
+    ui.get_stream().flush()
+    try:
+        os.execvpe(args.cmd[0], args.cmd, env)
+    except OSError as e:
+        ui.printmsg(f'Could not run {args.cmd[0]}: {e.strerror}', ui.ERROR)
+        sys.exit(127)
+
+
 def add_entry(db : deetsdb.Database, args : argparse.Namespace):
 
     names = args.names
@@ -112,8 +286,7 @@ def add_entry(db : deetsdb.Database, args : argparse.Namespace):
 
     if password == '':
         ui.printmsg('Using randomly generated password', ui.INFO)
-        password = encryption.generate_random_password(args.length,
-                                                       args.char_class)
+        password = passwords.generate(password_policy(args))
 
     db[account] = (username, password)
 
@@ -121,10 +294,7 @@ def add_entry(db : deetsdb.Database, args : argparse.Namespace):
     if notes != '':
         db.set_notes(account, notes)
 
-    clipboard.copy(password)
-
-    if not args.print:
-        password = 'copied to clipboard'
+    password = copy_password(password, args)
 
     ui.printmsg('New account added', ui.IMPORTANT)
     ui.printmsg('Account:  ', ui.INFO, ' '.join(account), ui.EMPHASIS)
@@ -171,8 +341,7 @@ def change_entry(db : deetsdb.Database, args : argparse.Namespace):
     if new_password == '':
         new_password = old_password
     elif new_password == 'r':
-        new_password = encryption.generate_random_password(args.length,
-                                                           args.char_class)
+        new_password = passwords.generate(password_policy(args))
 
     ui.printmsg('Notes [press enter to leave unchanged]', ui.PROMPT)
     ui.printmsg('      [press "d" to clear]: ',           ui.PROMPT)
@@ -196,10 +365,7 @@ def change_entry(db : deetsdb.Database, args : argparse.Namespace):
 
     db[new_account] = (new_username, new_password)
     db.set_notes(new_account, new_notes)
-    clipboard.copy(new_password)
-
-    if not args.print:
-        new_password = 'copied to clipboard'
+    new_password = copy_password(new_password, args)
 
     ui.printmsg('Account details changed', ui.INFO)
     ui.printmsg('Account:  ', ui.INFO, ' '.join(new_account), ui.EMPHASIS)
@@ -238,16 +404,324 @@ def change_master_password(db : deetsdb.Database, args : argparse.Namespace):
     db.password = password
     ui.printmsg('\nMaster password changed', ui.INFO)
 
+    # the vault must be unlocked
+    # with the new password
+    agent.lock(args.db)
+
+
+def require_password():
+    """Called by commands which need the master password when the database
+    was unlocked with a key file. Exits with an error.
+    """
+    ui.printmsg('This command requires the master password - the database '
+                'was unlocked with a key file', ui.ERROR)
+    sys.exit(1)
+
+
+def manage_keyfile(db : deetsdb.Database, args : argparse.Namespace):
+    """Add a key file which can be used to unlock the database instead of
+    the master password (creating it if it does not exist), or remove one.
+    Only the key slots of the database are changed (see ``deets.keys``).
+    """
+
+    # a new database does not have a data key
+    # until it is saved, but it is needed to
+    # create the key file slot
+    if db.key is None:
+        db.key = encryption.MasterKey.generate()
+
+    try:
+        if args.delete:
+            found = keys.find_slots(db.keyslots, args.path)
+        elif not op.exists(args.path):
+            keys.generate_keyfile(args.path)
+            found = []
+            ui.printmsg('Created key file [', ui.INFO,
+                        args.path,            ui.UNDERLINE,
+                        ']',                  ui.INFO)
+        else:
+            found = keys.find_slots(db.keyslots, args.path)
+    except OSError as e:
+        ui.printmsg(f'Could not access key file: {e}', ui.ERROR)
+        sys.exit(1)
+
+    if args.delete:
+        keyslots = [s for i, s in enumerate(db.keyslots) if i not in found]
+        if len(found) == 0:
+            ui.printmsg('[',                                      ui.ERROR,
+                        args.path,                                ui.UNDERLINE,
+                        '] is not a key file for this database', ui.ERROR)
+            sys.exit(1)
+        if len(keyslots) == 0 and db.password is None:
+            ui.printmsg('Cannot remove the only key file of a database '
+                        'without a master password', ui.ERROR)
+            sys.exit(1)
+        db.keyslots = keyslots
+        ui.printmsg('Key file [',  ui.INFO,
+                    args.path,     ui.UNDERLINE,
+                    '] removed',   ui.INFO)
+
+    elif len(found) > 0:
+        ui.printmsg('[',                                          ui.WARNING,
+                    args.path,                                    ui.UNDERLINE,
+                    '] is already a key file for this database', ui.WARNING)
+
+    else:
+        db.keyslots = db.keyslots + [keys.keyfile_slot(db.key, args.path)]
+        ui.printmsg('Key file [', ui.INFO,
+                    args.path,    ui.UNDERLINE,
+                    '] added - keep it safe, as anyone with a copy of it '
+                    'can unlock the database', ui.INFO)
+
+
+def calibrate_kdf(db : deetsdb.Database, args : argparse.Namespace):
+
+    if db.password is None:
+        require_password()
+
+    ui.printmsg('Benchmarking ',    ui.INFO,
+                args.algorithm,     ui.EMPHASIS,
+                ' (target: ',       ui.INFO,
+                f'{args.target} ms', ui.EMPHASIS,
+                ')',                ui.INFO)
+
+    kdf    = encryption.calibrate_kdf(args.algorithm, args.target / 1000)
+    params = ', '.join(f'{k}={v}' for k, v in kdf.items())
+    db.kdf = kdf
+
+    ui.printmsg('Key derivation parameters changed: ', ui.INFO,
+                params,                                ui.EMPHASIS)
+
+
+def set_compression(db : deetsdb.Database, args : argparse.Namespace):
+    """Change the method used to compress entries before they are
+    encrypted.
+    """
+    if args.method == 'none': db.compression = None
+    else:                     db.compression = args.method
+    ui.printmsg('Compression method changed: ', ui.INFO,
+                args.method,                    ui.EMPHASIS)
+
+
+def convert_database(db : deetsdb.Database, args : argparse.Namespace):
+    """Change the encoding of the database file. """
+    db.encoding = args.encoding
+    ui.printmsg('Database encoding changed: ', ui.INFO,
+                args.encoding,                 ui.EMPHASIS)
+
+
+def open_encrypted(db : deetsdb.Database, filename : str) -> io.TextIOWrapper:
+    """Open an encrypted export for reading, decrypting it as it is read.
+    The master password is tried first - if the file was exported from a
+    different database, the user is prompted for its password.
+    """
+    f = open(filename, 'rb')
+    try:
+        password = db.password
+        while True:
+            if password is not None:
+                try:
+                    reader = stream.DecryptingReader(f, password)
+                    break
+                except encryption.AuthenticationError:
+                    if password != db.password:
+                        ui.printmsg('Incorrect password', ui.ERROR)
+                    f.seek(0)
+            password = ui.prompt_password(
+                f'Enter password for {op.basename(filename)}: ',
+                ui.PROMPT)
+    except BaseException:
+        f.close()
+        raise
+    return io.TextIOWrapper(io.BufferedReader(reader), newline='')
+
+
+def import_entries(db : deetsdb.Database, args : argparse.Namespace):
+
+    ui.printmsg('Importing accounts from [', ui.INFO,
+                args.file,                   ui.UNDERLINE,
+                ']',                         ui.INFO)
+
+    try:
+        fmt = args.format or bulk.guess_format(args.file)
+        if stream.is_encrypted(args.file):
+            with open_encrypted(db, args.file) as f:
+                count = db.update(bulk.read_records(f, fmt),
+                                  replace=args.overwrite)
+        else:
+            with open(args.file, 'rt', newline='') as f:
+                count = db.update(bulk.read_records(f, fmt),
+                                  replace=args.overwrite)
+    except (OSError, ValueError) as e:
+        ui.printmsg('Import failed - database not modified: ', ui.ERROR,
+                    str(e),                                     ui.EMPHASIS)
+        sys.exit(1)
+
+    ui.printmsg(f'{count}', ui.EMPHASIS, ' accounts imported', ui.INFO)
+
+
+def export_entries(db : deetsdb.Database, args : argparse.Namespace):
+
+    try:
+        fmt = args.format or bulk.guess_format(args.file)
+    except ValueError as e:
+        ui.printmsg(str(e), ui.ERROR)
+        sys.exit(1)
+
+    records = ((acct, *db[acct], db.get_notes(acct))
+               for acct in sorted(db.keys()))
+
+    ui.printmsg('Exporting accounts to [', ui.INFO,
+                args.file,                 ui.UNDERLINE,
+                ']',                       ui.INFO)
+    if not args.encrypt:
+        ui.printmsg('Warning: exported passwords are not encrypted!',
+                    ui.WARNING)
+    elif db.password is None:
+        require_password()
+
+    # only readable by the current user - the mode
+    # passed to open is only applied to new files
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    fd    = os.open(args.file, flags, 0o600)
+    if stat.S_ISREG(os.fstat(fd).st_mode):
+        os.fchmod(fd, 0o600)
+    if args.encrypt:
+        # encrypted with the master password
+        # (and the database kdf), with a new salt
+        with open(fd, 'wb') as raw, \
+             stream.EncryptingWriter(raw, db.password, db.kdf) as enc, \
+             io.TextIOWrapper(enc, newline='') as f:
+            count = bulk.write_records(f, fmt, records)
+    else:
+        with open(fd, 'wt', newline='') as f:
+            count = bulk.write_records(f, fmt, records)
+
+    ui.printmsg(f'{count}', ui.EMPHASIS, ' accounts exported', ui.INFO)
+
+
+def shard_database(db : deetsdb.Database, args : argparse.Namespace):
+    """Save a copy of the database as a sharded vault directory. """
+
+    if op.exists(args.directory) and \
+       (not op.isdir(args.directory) or len(os.listdir(args.directory)) > 0):
+        ui.printmsg('[',                              ui.ERROR,
+                    args.directory,                   ui.UNDERLINE,
+                    '] already exists and is not an empty directory',
+                    ui.ERROR)
+        sys.exit(1)
+
+    nshards = args.shards or shards.DEFAULT_SHARDS
+    ui.printmsg('Saving sharded vault [', ui.INFO,
+                args.directory,           ui.UNDERLINE,
+                f'] ({nshards} shards)',  ui.INFO)
+
+    # Save a snapshot, so that the original
+    # database is not associated with the copy
+    snap          = db.snapshot()
+    snap.manifest = None
+    snap.stamp    = None
+    shards.save_database(snap, args.directory, nshards)
+
+    ui.printmsg('Use ', ui.INFO, f'deets --db {args.directory}', ui.EMPHASIS,
+                ' to open the sharded vault', ui.INFO)
+
+
+def generate_passwords(args : argparse.Namespace):
+    """Print ``--count`` randomly generated passwords, one per line. """
+    policy = password_policy(args)
+    print('\n'.join(passwords.generate_many(policy, args.count)))
+
+
+def serve_database(db : deetsdb.Database, args : argparse.Namespace):
+    """Serve the database to local applications until interrupted. """
+
+    # asyncio is slow to import, so the
+    # server is only imported when needed
+    import deets.server as server
+
+    path    = args.socket or server.socket_path()
+    clients = server.load_tokens(server.token_file(args.db))
+    if len(clients) == 0:
+        ui.printmsg('No clients have been registered - use ', ui.WARNING,
+                    'deets token <client>',                   ui.EMPHASIS,
+                    ' to create a client token',              ui.WARNING)
+
+    ui.printmsg('Serving credentials database [', ui.INFO,
+                path,                             ui.UNDERLINE,
+                ']',                              ui.INFO)
+    try:
+        server.serve(db, args.db, path)
+    except RuntimeError as e:
+        ui.printmsg(str(e), ui.ERROR)
+        sys.exit(1)
+
+
+def manage_token(args : argparse.Namespace):
+    """Create or revoke a client token for ``deets serve``. The new token is
+    printed to standard output - only its hash is stored.
+    """
+    import deets.server as server
+    if args.revoke:
+        if not server.revoke_client(args.db, args.client):
+            ui.printmsg('No token for client [', ui.ERROR,
+                        args.client,             ui.UNDERLINE,
+                        ']',                     ui.ERROR)
+            sys.exit(1)
+        ui.printmsg('Token revoked for client [', ui.INFO,
+                    args.client,                  ui.UNDERLINE,
+                    ']',                          ui.INFO)
+        return
+
+    token = server.add_client(args.db, args.client)
+    ui.printmsg('Token created for client [', ui.INFO,
+                args.client,                  ui.UNDERLINE,
+                ']',                          ui.INFO)
+    print(token)
+
+
+def run_agent(args : argparse.Namespace):
+    ui.printmsg('Starting deets agent [', ui.INFO,
+                agent.socket_path(),      ui.UNDERLINE,
+                ']',                      ui.INFO)
+    agent.serve()
+
+
+def lock_agent(args : argparse.Namespace):
+    agent.lock()
+    ui.printmsg('All credentials databases locked', ui.INFO)
+
+
+def unlock_agent(db : deetsdb.Database, args : argparse.Namespace):
+    """Cache the data key of the database in the agent (the master password
+    is not given to the agent).
+    """
+
+    # Version 1 databases do not have a data
+    # key - one is generated, and the database
+    # is converted when it is saved
+    if db.key is None:
+        db.key     = encryption.MasterKey.generate()
+        db.changed = True
+
+    agent.spawn()
+    agent.unlock(args.db, db.key, args.ttl)
+    ui.printmsg('Credentials database unlocked for ', ui.INFO,
+                f'{args.ttl:0.0f}',                   ui.EMPHASIS,
+                ' seconds',                           ui.INFO)
+
 
 def repl_loop(db : deetsdb.Database, args : argparse.Namespace):
 
     # so other commands don't bork
     args.names = []
+    args.json  = False
 
     ui.printmsg('Available commands:', ui.INFO, '"get", '
                 '"add", "change", "remove"', ui.EMPHASIS)
-    ui.printmsg('Type "q", "quit", or "exit" to exit. *DO NOT* use CTRL+C '
-                '- if you do, your changes will not be saved.', ui.INFO)
+    ui.printmsg('Type "q", "quit", or "exit" to exit. Changes are saved '
+                f'automatically after {autosave.DEFAULT_DELAY:0.0f} '
+                'seconds.', ui.INFO)
 
     dispatch = {
         'get'    : get_entry,
@@ -256,15 +730,30 @@ def repl_loop(db : deetsdb.Database, args : argparse.Namespace):
         'remove' : remove_entry,
     }
 
-    while True:
-        cmd = ui.prompt_input('Command: [add]: ', ui.PROMPT).lower()
-        if cmd in ('q', 'quit', 'exit'):
-            break
-        if cmd == '':
-            cmd = 'add'
-
-        if cmd not in dispatch:
-            ui.printmsg(f'Unknown command [{cmd}]', ui.WARNING)
-            continue
-
-        dispatch[cmd](db, args)
+    saver = autosave.AutoSaver(db, args.db)
+    clipboard.start_session()
+
+    try:
+        while True:
+            cmd = ui.prompt_input('Command: [add]: ', ui.PROMPT).lower()
+            if cmd in ('q', 'quit', 'exit'):
+                break
+            if cmd == '':
+                cmd = 'add'
+
+            if cmd not in dispatch:
+                ui.printmsg(f'Unknown command [{cmd}]', ui.WARNING)
+                continue
+
+            dispatch[cmd](db, args)
+            saver.notify()
+
+            if saver.error is not None:
+                ui.printmsg('Error saving credentials database: ',
+                            ui.ERROR, str(saver.error), ui.ERROR)
+
+    # Save any pending changes, including when we
+    # are interrupted (which raises SystemExit)
+    finally:
+        clipboard.end_session()
+        saver.close()
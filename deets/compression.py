@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""Compression of entries and logged changes before they are encrypted.
+
+Each entry is compressed separately, so that entries can still be decrypted
+independently of one another (see ``db.load_database``). Individual entries
+are too small (typically around 100 bytes) for general-purpose compression
+to be effective, as most of their redundancy is in the JSON structure which
+they all share (``"names"``, ``"username"``, etc). So entries are compressed
+with raw DEFLATE, primed with a preset dictionary (``ZDICT``) containing
+that structure.
+
+A compressed plaintext starts with a marker byte identifying the method,
+which can never be the first byte of an uncompressed (JSON) plaintext, so
+compressed and uncompressed records may be mixed within one file - e.g.
+entries which were not decrypted when compression was enabled are saved
+as-is. The compression method is also recorded in the database header
+(or vault manifest), so that it is used when the database is next saved.
+"""
+
+
+import zlib
+
+from typing import Union
+
+
+METHODS = ['zlib']
+"""Available compression methods. """
+
+
+ZDICT = (b'"op": "delete", "op": "notes", "op": "set", '
+         b'"notes": "", "username": "", "password": "{"names": ["')
+"""Preset dictionary for ``zlib`` compression, containing the strings which
+are common to all entries and logged changes. DEFLATE encodes references to
+the end of the dictionary most cheaply, so the most common strings are at
+the end. This must never be changed, as it is needed to decompress existing
+entries - a new method must be added instead.
+"""
+
+
+MARKERS = {'zlib' : b'\x01'}
+"""Marker byte at the start of plaintexts compressed with each method. """
+
+
+_compressor = None
+"""``zlib`` compressor primed with the ``ZDICT``, which is copied to
+compress each entry - see ``compress``.
+"""
+
+
+def check_method(method : Union[str, None]):
+    """Raises a ``ValueError`` if ``method`` is not ``None`` or one of the
+    ``METHODS``.
+    """
+    if method is not None and method not in METHODS:
+        raise ValueError(f'Unsupported compression method: {method}')
+
+
+def compress(data : bytes, method : Union[str, None]) -> bytes:
+    """Compress ``data`` with ``method`` (or return it unmodified if
+    ``method`` is ``None``). Data which would not be made smaller is not
+    compressed.
+    """
+    global _compressor
+    if method is None:
+        return data
+    check_method(method)
+
+    # Copying a primed compressor is faster than
+    # priming a new one for every entry. A small
+    # window is sufficient for entries.
+    if _compressor is None:
+        _compressor = zlib.compressobj(9, zlib.DEFLATED, -10, 2, zdict=ZDICT)
+    compressor = _compressor.copy()
+    compressed = compressor.compress(data) + compressor.flush()
+    if len(compressed) + 1 >= len(data):
+        return data
+    return MARKERS[method] + compressed
+
+
+def decompress(data : bytes) -> bytes:
+    """Decompress ``data``, which may have been compressed by ``compress``
+    with any method.
+    """
+    marker = data[:1]
+    if marker in (b'{', b'['):
+        return data
+    if marker != MARKERS['zlib']:
+        raise ValueError(f'Unsupported compression marker: {marker!r}')
+    decompressor = zlib.decompressobj(-15, zdict=ZDICT)
+    return decompressor.decompress(data[1:]) + decompressor.flush()
@@ -1,21 +1,71 @@
 #!/usr/bin/env python
 
 
-from collections import defaultdict
 from pathlib import Path
 import itertools as it
+import contextlib
+import sys
+import os.path   as op
+import base64    as b64
+import binascii
+import tempfile
+import struct
 import json
+import mmap
+import os
 
+from . import compression
 from . import encryption
+from . import index
+from . import keys
+from . import trace
 
-from typing import Union, List, Tuple, Sequence
+from typing import (Union, List, Tuple, Sequence, Dict, Any, Iterator,
+                    Iterable)
 
 pathtype = Union[str, Path]
+recordtype = Tuple[Sequence[str], str, str, Union[str, None]]
 
 
-def sanitise_key(names : Sequence[str]) -> Tuple[str, ...]:
-    names = [n.lower() for n in names]
-    return tuple(sorted(set(names)))
+class AccountKey(tuple):
+    """A sanitised account identifier - a sorted tuple of unique, lower-case
+    names. Created by ``sanitise_key``, which returns ``AccountKey`` objects
+    unmodified, so keys which have already been sanitised (e.g. those
+    returned by ``Database.lookup_keys``) are not sanitised again.
+    """
+    __slots__ = ()
+
+
+def sanitise_key(names : Sequence[str]) -> AccountKey:
+    """Return an ``AccountKey`` for the given names. Each name is interned,
+    so that names which are shared by many accounts are only stored once.
+    """
+    if type(names) is AccountKey:
+        return names
+    names = {sys.intern(n.lower()) for n in names}
+    return AccountKey(sorted(names))
+
+
+class Entry:
+    """Credentials and notes for one account. ``Entry`` objects are never
+    modified once created, so may be shared between ``Database`` snapshots.
+    """
+
+    __slots__ = ('username', 'password', 'notes')
+
+
+    def __init__(self,
+                 username : str,
+                 password : str,
+                 notes    : Union[str, None] = None):
+        self.username = username
+        self.password = password
+        self.notes    = notes
+
+
+    @property
+    def credentials(self) -> Tuple[str, str]:
+        return (self.username, self.password)
 
 
 class Database:
@@ -30,18 +80,44 @@ class Database:
     and another account may have ``('amazon', 'store')``.
 
     A ``Database`` object also stores a reference to the master password that
-    was used to decrypt it, and should be used to re-encrypt it when the
-    program exits. This is done by the ``load_database``and ``save_database``
-    functions, also defined in this module.
+    was used to decrypt it, and the data key with which its entries are
+    encrypted, along with the ``keyslots`` in which the data key is stored,
+    wrapped with keys derived from the master password or a key file (see
+    the ``keys`` module). Changing the master password only changes the key
+    slots - entries do not need to be re-encrypted.
+
+    Every change made to a ``Database`` is recorded in its ``journal``, so
+    that the changes can be appended to the database file, rather than the
+    entire file being re-written (see ``save_database``). The journal is
+    also used to merge the changes with those made to the file by other
+    processes since it was loaded (see ``rebase``).
+
+    Entries may be added in encrypted form via ``add_sealed``, along with a
+    blind index of their names (see ``encryption.MasterKey.blind``). Sealed
+    entries are only decrypted when they are accessed (e.g. via
+    ``lookup_keys``, or ``__getitem__``), so that looking up one account
+    does not require every account to be decrypted.
     """
 
 
     def __init__(self, password : str):
-        self.__password     = password
-        self.__entries      = {}
-        self.__notes        = {}
-        self.__nameResolver = defaultdict(set)
-        self.__changed      = False
+        self.__password      = password
+        self.__kdf           = dict(encryption.DEFAULT_KDF)
+        self.__key           = None
+        self.__keyslots      = []
+        self.__savedKeyslots = []
+        self.__entries       = {}
+        self.__index         = index.NameIndex()
+        self.__sealed        = {}
+        self.__sealedIds     = it.count()
+        self.__blindResolver = {}
+        self.__journal       = []
+        self.__logSize       = None
+        self.__manifest      = None
+        self.__stamp         = None
+        self.__compression   = None
+        self.__encoding      = 'json'
+        self.__changed       = False
 
 
     @property
@@ -51,10 +127,136 @@ class Database:
 
     @password.setter
     def password(self, password : str):
+        """Changing the password replaces the password key slot - the data
+        key, and hence the entries, are not changed.
+        """
+        self.__wrapPassword(password, self.__kdf)
+
+
+    @property
+    def kdf(self) -> Dict[str, Any]:
+        """Key derivation function parameters used to derive the key which
+        wraps the data key from the password.
+        """
+        return dict(self.__kdf)
+
+
+    @kdf.setter
+    def kdf(self, kdf : Dict[str, Any]):
+        self.__wrapPassword(self.__password, kdf)
+
+
+    def __wrapPassword(self, password : str, kdf : Dict[str, Any]):
+        """Replace the password key slot when the password or key derivation
+        function parameters are changed. If there is no data key (i.e. this
+        is a new database), the slot is created when the database is first
+        saved.
+        """
+        if self.__key is not None:
+            if password is None:
+                raise ValueError('The master password is required to '
+                                 'change the password key slot')
+            self.__keyslots = keys.replace_password(
+                self.__keyslots, self.__key, password, kdf)
         self.__password = password
+        self.__kdf      = dict(kdf)
         self.__changed  = True
 
 
+    @property
+    def compression(self) -> Union[str, None]:
+        """Method used to compress entries before they are encrypted (one of
+        ``compression.METHODS``), or ``None``.
+        """
+        return self.__compression
+
+
+    @compression.setter
+    def compression(self, method : Union[str, None]):
+        """Changing the compression method causes all entries to be
+        re-encrypted when the database is next saved.
+        """
+        compression.check_method(method)
+        if method == self.__compression:
+            return
+        self.__unseal(list(self.__sealed.keys()))
+        self.__compression = method
+        self.__logSize     = None
+        self.__changed     = True
+
+
+    @property
+    def encoding(self) -> str:
+        """Encoding of the database file - one of ``ENCODINGS`` (see
+        ``load_database``).
+        """
+        return self.__encoding
+
+
+    @encoding.setter
+    def encoding(self, encoding : str):
+        """Sealed entries are stored in the encoding of the file they were
+        loaded from, so changing the encoding causes all entries to be
+        decrypted, and re-encrypted when the database is next saved.
+        """
+        if encoding not in ENCODINGS:
+            raise ValueError(f'Unsupported encoding: {encoding}')
+        if encoding == self.__encoding:
+            return
+        self.__unseal(list(self.__sealed.keys()))
+        self.__encoding = encoding
+        self.__logSize  = None
+        self.__changed  = True
+
+
+    @property
+    def key(self) -> Union[encryption.MasterKey, None]:
+        """Data key with which entries are encrypted, or ``None`` if it has
+        not yet been generated (see ``save_database``).
+        """
+        return self.__key
+
+
+    @key.setter
+    def key(self, key : encryption.MasterKey):
+        # Keys from version 2 files are
+        # derived directly from the password
+        self.__key = key
+        if key.kdf is not None:
+            self.__kdf = key.kdf
+
+
+    @property
+    def keyslots(self) -> List[Dict[str, Any]]:
+        """Key slots containing wrapped copies of the data key (see the
+        ``keys`` module).
+        """
+        return list(self.__keyslots)
+
+
+    @keyslots.setter
+    def keyslots(self, keyslots : List[Dict[str, Any]]):
+        self.__keyslots = list(keyslots)
+        kdf             = keys.password_kdf(keyslots)
+        if kdf is not None:
+            self.__kdf = kdf
+        self.__changed = True
+
+
+    @property
+    def keys_changed(self) -> bool:
+        """``True`` if the ``keyslots`` have been changed since the database
+        was loaded or saved.
+        """
+        return self.__keyslots != self.__savedKeyslots
+
+
+    @keys_changed.setter
+    def keys_changed(self, changed : bool):
+        if not changed:
+            self.__savedKeyslots = list(self.__keyslots)
+
+
     @property
     def changed(self) -> bool:
         return self.__changed
@@ -62,15 +264,250 @@ class Database:
 
     @changed.setter
     def changed(self, val : bool):
+        """Setting ``changed`` to ``False`` also clears the ``journal``. """
         self.__changed = val
+        if not val:
+            self.__journal = []
+
+
+    @property
+    def journal(self) -> List[Dict[str, Any]]:
+        """Returns a list of all changes made since the database was loaded or
+        saved. Each change is a dictionary containing an ``"op"``
+        (``"set"``, ``"notes"`` or ``"delete"``), the account ``"names"``,
+        and the new ``"username"``, ``"password"``, or ``"notes"``.
+
+        Each change also contains the ``"base"`` state of the account
+        before the change - a ``(username, password, notes)`` tuple, or
+        ``None`` if the account did not exist. This is used to detect
+        conflicting changes (see ``save_database``), and is not saved.
+        """
+        return list(self.__journal)
+
+
+    @journal.setter
+    def journal(self, journal : List[Dict[str, Any]]):
+        """The journal may be replaced, e.g. to combine the journals of
+        successive snapshots which are saved together.
+        """
+        self.__journal = list(journal)
+
+
+    @property
+    def log_size(self) -> Union[int, None]:
+        """Number of changes which have been appended to the log of the
+        database file since its last snapshot, or ``None`` if the file does
+        not correspond to this ``Database``.
+        """
+        return self.__logSize
+
+
+    @log_size.setter
+    def log_size(self, val : Union[int, None]):
+        self.__logSize = val
+
+
+    @property
+    def stamp(self) -> Union[Tuple, None]:
+        """The ``file_stamp`` of the database file when the database was
+        loaded from (or last saved to) it, used to detect changes made by
+        other processes.
+        """
+        return self.__stamp
+
+
+    @stamp.setter
+    def stamp(self, stamp : Union[Tuple, None]):
+        self.__stamp = stamp
+
+
+    @property
+    def manifest(self) -> Union['shards.Manifest', None]:
+        """Manifest of the sharded vault directory that the database was
+        loaded from (or last saved to), or ``None`` if it is not stored in a
+        sharded vault (see the ``shards`` module).
+        """
+        return self.__manifest
+
+
+    @manifest.setter
+    def manifest(self, manifest : Union['shards.Manifest', None]):
+        self.__manifest = manifest
+
+
+    def add_sealed(self, index : Sequence[str], token : str):
+        """Add an encrypted entry to the database. The entry is not decrypted
+        until it is accessed.
+
+        :arg index: Blind index of the names of the account, i.e. the keyed
+                    hashes of each name, generated by
+                    ``encryption.MasterKey.blind``.
+        :arg token: The entry, sealed via ``seal_entry`` - either a ``str``
+                    or ``MappedToken`` (JSON encoding), or a ``memoryview``
+                    (binary encoding).
+        """
+        sid = next(self.__sealedIds)
+        self.__sealed[sid] = (tuple(index), token)
+
+        # Most names are unique to one account, so
+        # to save memory a name which is only used
+        # by one sealed entry maps to a single ID,
+        # rather than to a set of IDs.
+        for blind in index:
+            sids = self.__blindResolver.get(blind)
+            if   sids is None:          self.__blindResolver[blind] = sid
+            elif isinstance(sids, int): self.__blindResolver[blind] = {sids,
+                                                                       sid}
+            else:                       sids.add(sid)
+
+
+    def sealed(self) -> Tuple[Tuple[str, ...], str]:
+        """Yields ``(index, token)`` tuples for all entries which have not
+        been decrypted.
+        """
+        yield from self.__sealed.values()
+
+
+    @property
+    def num_sealed(self) -> int:
+        """Number of entries which have not been decrypted. """
+        return len(self.__sealed)
+
+
+    def __unseal(self, sids : Sequence[int]):
+        """Decrypt and insert the given sealed entries. """
+        if len(sids) == 0:
+            return
+        with trace.span('db.unseal', entries=len(sids)):
+            for sid in sids:
+                index, token = self.__sealed.pop(sid)
+                for blind in index:
+                    hits = self.__blindResolver[blind]
+                    if isinstance(hits, int): self.__blindResolver.pop(blind)
+                    else:                     hits.discard(sid)
+                names, credentials, notes = unseal_entry(self.key, token)
+                self.__insert(names, credentials, notes)
+
+
+    def __unseal_names(self, names : Sequence[str]):
+        """Decrypt all sealed entries which have all of the given names. """
+
+        if len(self.__sealed) == 0 or len(names) == 0:
+            return
+
+        sids = []
+        for name in names:
+            hits = self.__blindResolver.get(self.key.blind(name), set())
+            if isinstance(hits, int):
+                hits = {hits}
+            sids.append(hits)
+        self.__unseal(set.intersection(*sids))
+
+
+    def __insert(self,
+                 names       : Tuple[str, ...],
+                 credentials : Tuple[str, str],
+                 notes       : Union[str, None]):
+        """Insert an entry, without recording it in the journal. """
+        self.__entries[names] = Entry(*credentials, notes)
+        self.__index.add(names)
+
+
+    def unsealed(
+        self
+    ) -> Tuple[Tuple[str, ...], Tuple[str, str], Union[str, None]]:
+        """Yields ``(names, credentials, notes)`` for all entries which have
+        been decrypted (or were added in decrypted form). Unlike
+        ``get_notes``, this does not cause any sealed entries to be
+        decrypted.
+        """
+        for names, entry in self.__entries.items():
+            yield names, entry.credentials, entry.notes
+
+
+    def snapshot(self) -> 'Database':
+        """Returns a copy of this ``Database``, e.g. so that it can be saved
+        in a separate thread. Entries and notes are shared with the copy,
+        but all containers are copied.
+        """
+        snap = Database(self.__password)
+        snap.__assign(self)
+        snap.__compression = self.__compression
+        snap.__journal     = list(self.__journal)
+        snap.__changed     = self.__changed
+        return snap
+
+
+    def rebase(self, other : 'Database'):
+        """Replace the contents of this database with those of ``other``,
+        then re-apply all of the changes in the ``journal``. Used to merge
+        changes made by another process (loaded into ``other``) with those
+        made to this database.
+        """
+        # Key slots changed by both this database and
+        # other (to different values) conflict
+        keyslots = None
+        if self.keys_changed and other.__keyslots != self.__keyslots:
+            if other.__keyslots != self.__savedKeyslots:
+                raise ConflictError('The master password or key files were '
+                                    'changed by another process')
+            keyslots = self.__keyslots
+
+        journal = self.__journal
+        self.__assign(other)
+        if keyslots is not None:
+            self.keyslots = keyslots
+        self.__journal = []
+        for change in journal:
+            _apply_change(self, change)
+        self.__changed = len(self.__journal) > 0 or self.keys_changed
+
+
+    def __assign(self, other : 'Database'):
+        """Copy the contents of ``other`` (except for its password, journal,
+        and changed state) into this database. Entries and notes are shared,
+        but all containers are copied.
+        """
+        self.__kdf           = dict(other.__kdf)
+        self.__key           = other.__key
+        self.__keyslots      = list(other.__keyslots)
+        self.__savedKeyslots = list(other.__savedKeyslots)
+        self.__encoding      = other.__encoding
+        self.__entries       = dict(other.__entries)
+        self.__sealed        = dict(other.__sealed)
+        self.__sealedIds     = it.count(max(other.__sealed, default=-1) + 1)
+        self.__logSize       = other.__logSize
+        self.__manifest      = other.__manifest
+        self.__stamp         = other.__stamp
+        self.__index         = other.__index.copy()
+        self.__blindResolver = {}
+
+        for blind, sids in other.__blindResolver.items():
+            if not isinstance(sids, int):
+                sids = set(sids)
+            self.__blindResolver[blind] = sids
+
+
+    def state(
+        self,
+        names : Tuple[str, ...]
+    ) -> Union[Tuple[str, str, Union[str, None]], None]:
+        """Returns the ``(username, password, notes)`` for an account, or
+        ``None`` if it does not exist.
+        """
+        entry = self.__entries.get(self.__canonical(names))
+        if entry is None: return None
+        else:             return (entry.username, entry.password, entry.notes)
 
 
     def __iter__(self) -> Tuple[Tuple[str, ...], Tuple[str, str]]:
-        for names, credentials in self.__entries.items():
-            yield names, credentials
+        self.__unseal(list(self.__sealed.keys()))
+        for names, entry in self.__entries.items():
+            yield names, entry.credentials
 
 
     def keys(self) -> Sequence[Tuple[str, ...]]:
+        self.__unseal(list(self.__sealed.keys()))
         return self.__entries.keys()
 
 
@@ -79,47 +516,166 @@ class Database:
         contain all of the given names.
         """
         names = sanitise_key(names)
-        hits  = it.chain(*[self.__nameResolver[n] for n in names])
-        hits  = [h for h in hits if all(n in h    for n in names)]
-        hits  = sorted(set(hits))
-        return hits
+        self.__unseal_names(names)
+        return self.__index.lookup(names)
 
 
-    def get_notes(self, names : Tuple[str, ...]) -> Union[str, None]:
+    def resolve(self, *names : str) -> AccountKey:
+        """Returns the account which matches ``names``. An account whose
+        names are exactly ``names`` is preferred over accounts which have
+        additional names. Raises a ``LookupError`` if no account, or more
+        than one account, matches.
+        """
+        key  = sanitise_key(names)
+        keys = self.lookup_keys(*key)
+
+        if key in keys:
+            return key
+        if len(keys) == 1:
+            return keys[0]
+
+        if len(keys) == 0:
+            raise LookupError(f'No accounts match [{" ".join(key)}]')
+        keys = ', '.join(f'[{" ".join(k)}]' for k in keys)
+        raise LookupError(f'Multiple accounts match [{" ".join(key)}]: {keys}')
+
+
+    def lookup_any(self, *names : str) -> List[Tuple[str, ...]]:
+        """Returns all identifiers which contain any of the given names. """
         names = sanitise_key(names)
-        return self.__notes.get(names, None)
+        for name in names:
+            self.__unseal_names([name])
+        return self.__index.lookup_any(names)
 
 
-    def set_notes(self, names : Tuple[str, ...], notes : Union[str, None]):
+    def lookup_prefix(self, *prefixes : str) -> List[Tuple[str, ...]]:
+        """Returns all identifiers which, for each of the given prefixes,
+        contain a name starting with that prefix.
+
+        The names of sealed entries are hashed, so cannot be searched by
+        prefix - all sealed entries are decrypted before the search.
+        """
+        prefixes = sanitise_key(prefixes)
+        self.__unseal(list(self.__sealed.keys()))
+        return self.__index.lookup_prefix(prefixes)
+
+
+    def search(self,
+               *names : str,
+               limit  : int  = 10,
+               unseal : bool = False) -> List[Tuple[str, ...]]:
+        """Approximate search - returns up to ``limit`` identifiers which
+        contain names similar to all of the given names, most similar first.
+        See ``index.NameIndex.search``.
+
+        The names of sealed entries are hashed, so cannot be searched - only
+        entries which have been decrypted are searched, unless ``unseal`` is
+        ``True``, in which case all sealed entries are decrypted before the
+        search (as with ``lookup_prefix``).
+        """
         names = sanitise_key(names)
-        if notes is None:
-            self.__notes.pop(names, None)
-        else:
-            self.__notes[names] = notes
+        if unseal:
+            self.__unseal(list(self.__sealed.keys()))
+        return [key for _, key in self.__index.search(names, limit)]
+
+
+    def get_notes(self, names : Tuple[str, ...]) -> Union[str, None]:
+        names = self.__canonical(names)
+        entry = self.__entries.get(names, None)
+        if entry is None: return None
+        else:             return entry.notes
+
+
+    def set_notes(self, names : Tuple[str, ...], notes : Union[str, None]):
+        names = self.__canonical(names)
+        base  = self.state(names)
+        entry = self.__entries[names]
+        self.__entries[names] = Entry(entry.username, entry.password, notes)
+        self.__journal.append({'op'    : 'notes',
+                               'names' : names,
+                               'notes' : notes,
+                               'base'  : base})
         self.__changed = True
 
 
-    def __contains__(self, names : Tuple[str, ...]) -> bool:
+    def __canonical(self, names : Sequence[str]) -> AccountKey:
+        """Sanitise ``names``, and make sure that the entry for the resulting
+        key (if there is one) has been decrypted.
+        """
         names = sanitise_key(names)
-        return names in self.__entries
+        if names not in self.__entries:
+            self.__unseal_names(names)
+        return names
+
+
+    def __contains__(self, names : Tuple[str, ...]) -> bool:
+        return self.__canonical(names) in self.__entries
 
 
     def __setitem__(self,
                     names       : Tuple[str, ...],
                     credentials : Tuple[str, str]):
 
-        names = sanitise_key(names)
+        names = self.__canonical(names)
+        base  = self.state(names)
+        notes = self.get_notes(names)
 
-        self.__entries[names] = credentials
+        self.__entries[names] = Entry(*credentials, notes)
+        self.__index.add(names)
 
-        for name in names:
-            self.__nameResolver[name].add(names)
+        self.__journal.append({'op'       : 'set',
+                               'names'    : names,
+                               'username' : credentials[0],
+                               'password' : credentials[1],
+                               'base'     : base})
         self.__changed = True
 
 
+    def update(self,
+               records : Iterable[recordtype],
+               replace : bool = True) -> int:
+        """Add or replace many entries at once.
+
+        Each record is a ``(names, username, password, notes)`` tuple.
+        Records are consumed one at a time, so ``records`` may be a generator
+        which e.g. reads them from a file. New accounts are added to the name
+        index in a single batch after all records have been consumed (or if
+        an error occurs), which is much faster than adding them one by one.
+
+        :arg records: Iterable of records
+        :arg replace: If ``False``, records for accounts which already exist
+                      are ignored.
+        :returns:     The number of entries which were added or replaced.
+        """
+        added = []
+        count = 0
+        try:
+            for names, username, password, notes in records:
+                names = self.__canonical(names)
+                base  = self.state(names)
+                if base is not None and not replace:
+                    continue
+                if base is None:
+                    added.append(names)
+
+                self.__entries[names] = Entry(username, password, notes)
+                self.__journal.append({'op'       : 'set',
+                                       'names'    : names,
+                                       'username' : username,
+                                       'password' : password,
+                                       'notes'    : notes,
+                                       'base'     : base})
+                count += 1
+        finally:
+            self.__index.update(added)
+            if count > 0:
+                self.__changed = True
+
+        return count
+
+
     def __getitem__(self, names : Tuple[str, ...]) -> Tuple[str, str]:
-        names = sanitise_key(names)
-        return self.__entries[names]
+        return self.__entries[self.__canonical(names)].credentials
 
 
     def delete(self, names : Tuple[str, ...]):
@@ -127,86 +683,956 @@ class Database:
 
 
     def __delitem__(self, names : Tuple[str, ...]):
-        names = sanitise_key(names)
+        names = self.__canonical(names)
+        base  = self.state(names)
         self.__entries.pop(names)
-        for name in names:
-            self.__nameResolver[name].remove(names)
+        self.__index.remove(names)
+        self.__journal.append({'op'    : 'delete',
+                               'names' : names,
+                               'base'  : base})
         self.__changed = True
 
 
+VERSION = 3
+"""Current database file format version. Version 2 files, in which entries
+are encrypted with a key derived directly from the master password, rather
+than with a wrapped data key (see the ``keys`` module), can also be loaded.
+"""
+
+
+ENCODINGS = ['json', 'binary']
+"""Database file encodings - see ``load_database``. """
+
+
+MAGIC = b'\x89DEETS\r\n'
+"""Start of a binary-encoded database file. """
+
+
+RECORD = struct.Struct('<cI')
+"""Type and length of a record in a binary-encoded database file. """
+
+
+RECORD_HEADER = b'H'
+RECORD_BACKUP = b'B'
+RECORD_ENTRY  = b'E'
+RECORD_LOG    = b'L'
+"""Record types in a binary-encoded database file. """
+
+
+HEADER_BLOCK = 2048
+"""The header, and the backup copy of the header, of a database file are
+each padded to a multiple of this size, so that they can be re-written in
+place (see ``write_header``).
+"""
+
+
+BLIND_SIZE = 16
+"""Size of a keyed hash of a name (see ``encryption.MasterKey.blind``). """
+
+
+LOG_COMPACT_THRESHOLD = 1000
+"""Maximum number of changes which are appended to the log of a database
+file before it is compacted into a new snapshot.
+"""
+
+
+class ConflictError(Exception):
+    """Raised by ``save_database`` if the database file has been modified
+    by another process since it was loaded, and the modifications cannot be
+    merged with the changes to be saved. The conflicting accounts (if any)
+    are stored in the ``accounts`` attribute.
+    """
+
+    def __init__(self, message : str, accounts : List[AccountKey] = None):
+        if accounts is None:
+            accounts = []
+        super().__init__(message)
+        self.accounts = accounts
+
+
+def lock_file(filename : pathtype) -> str:
+    """Return the path of the lock file for a database file or sharded vault
+    directory.
+    """
+    if op.isdir(filename): return op.join(filename, '.lock')
+    else:                  return f'{filename}.lock'
+
+
+@contextlib.contextmanager
+def lock_database(filename : pathtype, exclusive : bool = False):
+    """Context manager which holds an advisory lock (via ``fcntl.flock``) on
+    the lock file for a database (see ``lock_file``), blocking until it can
+    be acquired. Any number of processes may hold a shared lock, which is
+    used while a database is read, but an exclusive lock, which is used
+    while a database is written, can only be held by one process.
+
+    Locks are only held while reading or writing, not for the lifetime of
+    a ``Database`` - changes made by other processes in the meantime are
+    merged when the database is saved (see ``save_database``).
+    """
+    import fcntl
+    fd = os.open(lock_file(filename), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        with trace.span('db.lock', exclusive=exclusive):
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        # closing the file releases the lock
+        os.close(fd)
+
+
+def file_stamp(filename : pathtype) -> Union[Tuple, None]:
+    """Returns a value which changes whenever a database file or sharded
+    vault directory is modified, or ``None`` if it does not exist.
+    """
+    def stat(fname):
+        st = os.stat(fname)
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    if op.isdir(filename):
+        from . import shards
+        if not op.exists(op.join(filename, shards.MANIFEST)):
+            return None
+        return tuple((f, *stat(op.join(filename, f)))
+                     for f in sorted(os.listdir(filename))
+                     if not f.startswith('.'))
+    if not op.exists(filename):
+        return None
+    return stat(filename)
+
+
 def load_database(filename : pathtype,
-                  password : str) -> Database:
+                  password : str,
+                  key      : encryption.MasterKey = None,
+                  keyfile  : str                  = None) -> Database:
     """Load and decrypt a credentials database from the specified file,
-    using the given master password.
+    using the given master password, or key file. If a data ``key`` is
+    provided, and it is the key that the database is encrypted with, it is
+    used instead of being unwrapped from the key slots.
+
+    A shared lock is held while the file is read (see ``lock_database``).
+
+    A database is stored as a text file, the first line of which is a
+    plain-text JSON header with the following structure::
 
-    A database is stored as a JSON file with the following structure::
         {
-            "salt"    : "<salt>",
-            "entries" : "<entries>"
+            "version" : 3,
+            "check"   : "<check>",
+            "keys"    : [<keyslot>, ...]
         }
 
-    where ``<salt>`` and ``<entries>`` are encrypted, and encded as base64
-    strings.
+    where each ``<keyslot>`` contains the data key with which the entries
+    are encrypted, wrapped with a key derived from the master password or a
+    key file, and ``<check>`` is a check value for the data key (see the
+    ``keys`` module). The header also contains ``"compression" :
+    "<method>"`` if entries are compressed before they are encrypted (see
+    the ``compression`` module). The second line contains a backup copy of
+    the header::
+
+        {"backup" : <header>}
+
+    Both lines are padded with spaces to the same length (a multiple of
+    ``HEADER_BLOCK``), so that the header can be re-written in place when
+    the key slots are changed (see ``write_header``). The header is
+    followed by one line for each entry, of the form::
+
+        {"index" : ["<name>", ...], "entry" : "<entry>"}
 
-    The ``<salt>`` is encrypted using the master password, and ``<entries>``
-    encrypted using the master password, salted with (the decrypted)
-    ``<salt>``.
+    where each ``<name>`` is a keyed hash of one of the names of the account
+    (see ``encryption.MasterKey.blind``), and ``<entry>`` is encrypted
+    using a sub-key of the master key (see ``encryption.MasterKey``), and
+    encoded as a base64 string. Entries are only decrypted when they are
+    accessed (see ``Database.add_sealed``).
 
-    When decrypted, ``<entries>`` has the following structure::
-        [
+    When decrypted, each ``<entry>`` has the following structure::
             {
                 "names"    : ["names", "which", "identify", "this", "account"],
                 "username" : "<username>",
                 "password" : "<password>",
                 "notes"    : "<notes>"
-            },
-            ...
-        ]
+            }
+
+    The ``"notes"`` field may or may not be present. All entries may
+    alternatively be stored in a single line, as a list of entries::
+
+        {"entries" : "<entries>"}
+
+    The entries may be followed by any number of lines of the form::
+
+        {"log" : "<change>"}
+
+    where each ``<change>`` is an entry from the ``Database.journal``,
+    JSON-encoded and encrypted using a sub-key of the master key. These
+    changes are applied, in order, to the entries.
+
+    Alternatively, a database may be stored in a binary encoding, which
+    does not base64-encode anything, and uses AES-256-GCM (see
+    ``encryption.MasterKey.seal``) rather than Fernet. A binary file starts
+    with ``MAGIC``, followed by a sequence of records, each of which starts
+    with a one-byte type, and the length of the rest of the record as a
+    four-byte little-endian integer (see ``RECORD``). The types are:
+
+     - ``RECORD_HEADER``: The first record - the JSON header, as above.
+     - ``RECORD_BACKUP``: The second record - the backup copy of the header.
+     - ``RECORD_ENTRY``:  A one-byte count of names, the keyed hash of
+                          each name (``BLIND_SIZE`` bytes each), and the
+                          encrypted entry.
+     - ``RECORD_LOG``:    An encrypted change.
+
+    Sealed entries in a binary file refer to the memory-mapped file via
+    ``memoryview`` slices, which are not copied until they are decrypted.
+
+    If ``filename`` is a directory, it is loaded as a sharded vault (see
+    the ``shards`` module).
+
+    Version 2 files have the same format, except that the header contains
+    the ``"kdf"`` parameters and ``"salt"`` with which the key that the
+    entries are encrypted with is derived directly from the master
+    password, rather than key slots, and there is no backup copy of the
+    header. Version 2 files are converted to the current version when their
+    key slots are changed, or they are compacted.
+
+    Version 1 files, which are also supported, are stored as a single JSON
+    object with the structure::
 
-    The ``"notes"`` field may or may not be present.
+        {
+            "salt"    : "<salt>",
+            "entries" : "<entries>"
+        }
+
+    where the ``<salt>`` is encrypted using the master password (with an
+    all-zeros salt), and ``<entries>`` encrypted using the master password,
+    salted with (the decrypted) ``<salt>``. Version 1 files are converted to
+    the current version when they are next saved.
+    """
+
+    with lock_database(filename):
+        stamp = file_stamp(filename)
+        db    = _read_database(filename, password, key, keyfile)
+    db.stamp = stamp
+    return db
+
+
+def _read_database(filename : pathtype,
+                   password : str,
+                   key      : encryption.MasterKey = None,
+                   keyfile  : str                  = None) -> Database:
+    """Used by ``load_database`` - loads a database without locking it. """
+
+    if op.isdir(filename):
+        from . import shards
+        return shards.load_database(filename, password, key, keyfile)
+
+    with trace.span('db.load'), open(filename, 'rb') as f:
+        encoding, header, backup, _ = read_header(f)
+        if header.get('version', 1) == 1:
+            if password is None:
+                raise encryption.AuthenticationError()
+            return _load_database_v1(header, password)
+
+        db             = Database(password)
+        db.key         = unlock_key(header, password, keyfile, key, backup)
+        db.encoding    = encoding
+        db.compression = header.get('compression')
+        if header['version'] == VERSION:
+            db.keyslots = header['keys']
+
+        with trace.span('db.read'):
+            logsize = read_records(db, f)
+
+    db.log_size     = logsize
+    db.changed      = False
+    db.keys_changed = False
+    return db
+
+
+def read_header(f) -> Tuple[str,
+                            Dict[str, Any],
+                            Union[Dict[str, Any], None],
+                            int]:
+    """Reads the header of the open database file ``f`` (see
+    ``load_database``), leaving ``f`` positioned after it. Returns:
+
+     - The encoding of the file
+     - The header
+     - The backup copy of the header, or ``None`` if the file does not
+       have one (or it cannot be read)
+     - The size of each copy of the header, or ``0`` if the file does not
+       have a backup copy.
+
+    If the header cannot be read (e.g. because writing it was interrupted),
+    the backup copy is returned as the header. A ``ValueError`` is raised
+    if neither can be read.
+    """
+    if f.read(len(MAGIC)) == MAGIC:
+        encoding = 'binary'
+        offset   = len(MAGIC)
+    else:
+        encoding = 'json'
+        offset   = 0
+        f.seek(0)
+
+    def read_block(rtype):
+        if encoding == 'json':
+            return f.readline()
+        btype, size = RECORD.unpack(f.read(RECORD.size))
+        if btype != rtype:
+            raise ValueError('invalid binary database')
+        return f.read(size)
+
+    def parse(block, backup):
+        try:
+            header = json.loads(block)
+            if backup:
+                header = header['backup']
+        except (ValueError, TypeError, KeyError):
+            return None
+        if not isinstance(header, dict):
+            return None
+        return header
+
+    block  = read_block(RECORD_HEADER)
+    size   = f.tell()
+    header = parse(block, False)
+
+    if header is not None and header.get('version', 1) < VERSION:
+        return encoding, header, None, 0
+
+    pos    = f.tell()
+    backup = parse(read_block(RECORD_BACKUP), True)
+    if f.tell() - pos != size:
+        backup = None
+    if header is None:
+        header = backup
+    if header is None:
+        raise ValueError('invalid database header')
+    if header['version'] != VERSION:
+        raise ValueError(f'unsupported database version: {header["version"]}')
+    return encoding, header, backup, size
+
+
+def header_blocks(
+        header   : Dict[str, Any],
+        encoding : str,
+        size     : int = None
+) -> Union[Tuple[bytes, bytes], None]:
+    """Returns the ``header``, and the backup copy of the header, of a
+    database file with the given ``encoding``, each padded to ``size``
+    bytes. If ``size`` is not provided, the smallest multiple of
+    ``HEADER_BLOCK`` that they fit in is used. Returns ``None`` if they do
+    not fit in ``size`` bytes.
+    """
+    main   = json.dumps(header).encode()
+    backup = json.dumps({'backup' : header}).encode()
+
+    if encoding == 'binary':
+        mextra = len(MAGIC) + RECORD.size
+        bextra = RECORD.size
+    else:
+        mextra = bextra = 1
+
+    needed = max(len(main) + mextra, len(backup) + bextra)
+    if size is None:
+        size = -(-needed // HEADER_BLOCK) * HEADER_BLOCK
+    elif needed > size:
+        return None
+
+    if encoding == 'binary':
+        main   = MAGIC + RECORD.pack(RECORD_HEADER, size - mextra) + \
+                 main.ljust(size - mextra)
+        backup = RECORD.pack(RECORD_BACKUP, size - bextra) + \
+                 backup.ljust(size - bextra)
+    else:
+        main   = main  .ljust(size - 1) + b'\n'
+        backup = backup.ljust(size - 1) + b'\n'
+    return main, backup
+
+
+def write_header(db : Database, filename : pathtype) -> bool:
+    """Re-writes the header of the database file ``filename`` in place,
+    after the key slots of ``db`` have been changed. The header is written
+    first, then its backup copy, and each is synced to disk before the
+    other is written, so that one of them is intact if writing is
+    interrupted.
+
+    Returns ``False``, without modifying the file, if the file is not
+    encrypted with the data key of ``db``, or does not have room for the new
+    header (e.g. it is a version 2 file), in which case it must be
+    re-written from scratch.
+    """
+    with open(filename, 'r+b') as f:
+        encoding, header, _, size = read_header(f)
+        if size     == 0           or \
+           encoding != db.encoding or \
+           header['check'] != db.key.check:
+            return False
+
+        blocks = header_blocks(file_header(db), encoding, size)
+        if blocks is None:
+            return False
+
+        for offset, block in zip((0, size), blocks):
+            f.seek(offset)
+            f.write(block)
+            f.flush()
+            os.fsync(f.fileno())
+    return True
+
+
+def file_header(db : Database) -> Dict[str, Any]:
+    """Returns the header to be saved to the file for ``db``. """
+    header = {'version' : VERSION,
+              'check'   : db.key.check,
+              'keys'    : complete_keyslots(db)}
+    if db.compression is not None:
+        header['compression'] = db.compression
+    return header
+
+
+def complete_keyslots(db : Database) -> List[Dict[str, Any]]:
+    """Returns the key slots of ``db``, after adding a password slot if it
+    does not have one (i.e. it is a new database, or was loaded from a
+    version 2 file), and its master password is known.
+    """
+    if db.password is not None and keys.password_kdf(db.keyslots) is None:
+        db.keyslots = db.keyslots + [keys.password_slot(db.key, db.password,
+                                                        db.kdf)]
+    return db.keyslots
+
+
+def unlock_key(header   : Dict[str, Any],
+               password : str,
+               keyfile  : str                  = None,
+               key      : encryption.MasterKey = None,
+               backup   : Dict[str, Any]       = None) -> encryption.MasterKey:
+    """Returns the data key for a database file header, or sharded vault
+    manifest. See ``keys.unlock``. The key slots in the ``backup`` copy of
+    the header are also tried, in case the header was not completely written.
+    """
+    if header['version'] == 2:
+        salt = b64.b64decode(header['salt'])
+        key  = reuse_key(key, salt, header['kdf'])
+        if key is None:
+            if password is None:
+                raise encryption.AuthenticationError()
+            key = encryption.MasterKey(password, salt, header['kdf'])
+        return key
+
+    keyslots = header['keys']
+    if backup is not None:
+        keyslots = keyslots + [s for s in backup['keys'] if s not in keyslots]
+    return keys.unlock(keyslots, header['check'], password, keyfile, key)
+
+
+def reuse_key(key  : Union[encryption.MasterKey, None],
+              salt : bytes,
+              kdf  : Dict[str, Any]) -> Union[encryption.MasterKey, None]:
+    """Returns ``key`` if it was derived using ``salt`` and ``kdf``,
+    otherwise ``None``.
+    """
+    if key is not None and key.salt == salt and key.kdf == kdf:
+        return key
+    return None
+
+
+def read_records(db : Database, f) -> int:
+    """Read the entries and logged changes from the remainder of the open
+    file ``f`` (see ``load_database``) into ``db``, which must have a master
+    key, and the ``Database.encoding`` of the file. Returns the number of
+    logged changes.
+    """
+    if db.encoding == 'binary':
+        return _read_binary_records(db, f)
+
+    key     = db.key
+    logsize = 0
+    for buf, start, end in _read_lines(f):
+
+        # Fast path for sealed entries - refer to the
+        # token within the mapped file rather than
+        # copying it.
+        sealed = _parse_sealed(buf, start, end)
+        if sealed is not None:
+            db.add_sealed(*sealed)
+            continue
+
+        record = json.loads(buf[start:end])
+        if 'entry' in record:
+            db.add_sealed(record['index'], record['entry'])
+        elif 'log' in record:
+            change = key.decrypt('log', record['log'].encode())
+            _apply_change(db, json.loads(compression.decompress(change)))
+            logsize += 1
+        elif 'entries' in record:
+            entries = key.decrypt('entries', record['entries'].encode())
+            _add_entries(db, json.loads(compression.decompress(entries)))
+    return logsize
+
+
+def _read_binary_records(db : Database, f) -> int:
+    """Used by ``read_records`` to read a binary-encoded file. """
+    key     = db.key
+    logsize = 0
+    pos     = f.tell()
+    if op.getsize(f.name) <= pos:
+        return logsize
+
+    buf  = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(buf)
+    b2a  = binascii.b2a_base64
+    for rtype, start, end in _binary_records(buf, pos):
+        if rtype == RECORD_ENTRY:
+            bstart = start + 1
+            bend   = bstart + buf[start] * BLIND_SIZE
+            index  = [b2a(buf[i:i + BLIND_SIZE], newline=False).decode()
+                      for i in range(bstart, bend, BLIND_SIZE)]
+            db.add_sealed(index, view[bend:end])
+        elif rtype == RECORD_LOG:
+            change = key.unseal('log', view[start:end])
+            _apply_change(db, json.loads(compression.decompress(change)))
+            logsize += 1
+    return logsize
+
+
+def _binary_records(buf : mmap.mmap,
+                    pos : int) -> Iterator[Tuple[bytes, int, int]]:
+    """Yields a ``(type, start, end)`` tuple for each record in a binary
+    file, from ``pos`` onwards, where ``start`` and ``end`` are the offsets
+    of the record body.
+    """
+    size = len(buf)
+    while pos + RECORD.size <= size:
+        rtype, length = RECORD.unpack_from(buf, pos)
+        start         = pos + RECORD.size
+        end           = start + length
+
+        # A partial record at the end of the file is
+        # the result of an interrupted append - ignore it
+        if end > size:
+            break
+        yield rtype, start, end
+        pos = end
+
+
+def _binary_end(f) -> int:
+    """Returns the offset of the end of the last complete record in the
+    open binary-encoded file (or shard file) ``f``.
+    """
+    size = f.seek(0, os.SEEK_END)
+    if size == 0:
+        return 0
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        if buf[:len(MAGIC)] == MAGIC: pos = len(MAGIC)
+        else:                         pos = 0
+        for _, _, pos in _binary_records(buf, pos):
+            pass
+    return pos
+
+
+def _binary_entry(index : Sequence[str],
+                  token : Union[bytes, memoryview]) -> bytes:
+    """Returns a binary-encoded entry record. """
+    if len(index) > 255:
+        raise ValueError('Accounts with more than 255 names cannot be saved '
+                         'in a binary-encoded database')
+    blinds = b''.join(b64.b64decode(i) for i in index)
+    length = 1 + len(blinds) + len(token)
+    return RECORD.pack(RECORD_ENTRY, length) + \
+        bytes([len(index)]) + blinds + token
+
+
+class MappedToken:
+    """Reference to an encrypted token within a memory-mapped database file.
+    Sealed entries are stored as ``MappedToken`` objects rather than as
+    copies of their tokens, to reduce memory usage for large databases.
+    """
+
+    __slots__ = ('buffer', 'start', 'stop')
+
+
+    def __init__(self, buffer : mmap.mmap, start : int, stop : int):
+        self.buffer = buffer
+        self.start  = start
+        self.stop   = stop
+
+
+    def __bytes__(self) -> bytes:
+        return self.buffer[self.start:self.stop]
+
+
+    def __str__(self) -> str:
+        return bytes(self).decode()
+
+
+def _read_lines(f) -> Iterator[Tuple[mmap.mmap, int, int]]:
+    """Memory-maps the remainder of the open file ``f``, and yields a
+    ``(buffer, start, end)`` tuple for each line in it.
+    """
+    pos = f.tell()
+    if op.getsize(f.name) <= pos:
+        return
+    buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    while pos < len(buf):
+        end = buf.find(b'\n', pos)
+
+        # A partial line at the end of the file is the
+        # result of an interrupted append - ignore it
+        if end == -1:
+            break
+        if end > pos:
+            yield buf, pos, end
+        pos = end + 1
+
+
+def _parse_sealed(
+        buf   : mmap.mmap,
+        start : int,
+        end   : int
+) -> Union[Tuple[List[str], MappedToken], None]:
+    """Parses a sealed entry line, as written by ``save_database``, without
+    using the ``json`` module. Returns the index and a ``MappedToken``, or
+    ``None`` if the line is not in the expected format (in which case it
+    should be parsed as JSON).
+    """
+    prefix = b'{"index": ['
+    marker = b'], "entry": "'
+
+    if buf[start:start + len(prefix)] != prefix or \
+       buf[end - 2:end]               != b'"}':
+        return None
+
+    istart = start + len(prefix)
+    iend   = buf.find(marker, istart, end)
+    if iend == -1:
+        return None
+
+    token = MappedToken(buf, iend + len(marker), end - 2)
+    index = buf[istart:iend].decode()
+
+    # blind names and tokens are base64,
+    # so can't contain escaped characters
+    if '\\' in index or buf.find(b'"', token.start, token.stop) != -1:
+        return None
+
+    if index == '': index = []
+    else:           index = index[1:-1].split('", "')
+    return index, token
+
+
+def seal_entry(key         : encryption.MasterKey,
+               names       : Tuple[str, ...],
+               credentials : Tuple[str, str],
+               notes       : Union[str, None],
+               method      : str = None,
+               encoding    : str = 'json') -> Tuple[List[str],
+                                                    Union[str, bytes]]:
+    """Encrypt an entry, returning its blind index and encrypted token. The
+    entry is compressed with ``method`` (see the ``compression`` module)
+    before it is encrypted. The token is a Fernet token (``str``) if
+    ``encoding`` is ``'json'``, or ``bytes`` if it is ``'binary'``.
     """
+    entry = {'names'    : names,
+             'username' : credentials[0],
+             'password' : credentials[1]}
+    if notes is not None:
+        entry['notes'] = notes
+    index = [key.blind(n) for n in names]
+    entry = compression.compress(json.dumps(entry).encode(), method)
+    if encoding == 'binary': token = key.seal('entry', entry)
+    else:                    token = key.encrypt('entry', entry).decode()
+    return index, token
+
+
+def unseal_entry(
+        key   : encryption.MasterKey,
+        token : str
+) -> Tuple[Tuple[str, ...], Tuple[str, str], Union[str, None]]:
+    """Decrypt an entry that was encrypted by ``seal_entry``, returning its
+    names, credentials, and notes. Binary-encoded entries are ``bytes`` or
+    ``memoryview`` objects, and JSON-encoded entries ``str`` or
+    ``MappedToken`` objects.
+    """
+    if isinstance(token, (bytes, memoryview)):
+        entry = key.unseal('entry', token)
+    else:
+        if isinstance(token, str): token = token.encode()
+        else:                      token = bytes(token)
+        entry = key.decrypt('entry', token)
+    entry = compression.decompress(entry)
+    entry = json.loads(entry)
+    names = sanitise_key(entry['names'])
+    return names, (entry['username'], entry['password']), entry.get('notes')
+
+
+def _apply_change(db : Database, change : Dict[str, Any]):
+    """Apply a change from a ``Database.journal`` to ``db``. """
+    op    = change['op']
+    names = change['names']
+
+    # changes made via Database.update
+    # also contain the notes for the entry
+    if op == 'set':
+        credentials = (change['username'], change['password'])
+        if 'notes' in change:
+            db.update([(names, *credentials, change['notes'])])
+        else:
+            db[names] = credentials
+    elif op == 'notes':  db.set_notes(names, change['notes'])
+    elif op == 'delete': db.delete(names)
+    else:                raise ValueError(f'Unknown change: {op}')
 
-    with open(filename, 'rt') as f:
-        text = json.load(f)
 
+def _load_database_v1(text : Dict[str, str], password : str) -> Database:
+    """Load a version 1 database - see ``load_database``. """
     salt    = encryption. decrypt(text['salt'].encode(), password.encode())
     entries = encryption.sdecrypt(text['entries'],       password, salt)
-    entries = json.loads(entries)
     db      = Database(password)
+    _add_entries(db, json.loads(entries))
+    db.changed = False
+    return db
 
-    for entry in entries:
-        db[tuple(entry['names'])] = (entry['username'], entry['password'])
 
-        if 'notes' in entry:
-            db.set_notes(entry['names'], entry['notes'])
+def _add_entries(db : Database, entries : List[Dict[str, Any]]):
+    """Add a list of decrypted entries to ``db``. """
+    db.update((e['names'], e['username'], e['password'], e.get('notes'))
+              for e in entries)
 
-    db.changed = False
 
-    return db
+def save_database(db       : Database,
+                  filename : pathtype) -> bool:
+    """Encrypts and saves the database to file, using its data key. A new
+    data key is generated, and wrapped with the ``Database.password``, if
+    ``db`` does not have one. An exclusive lock is held while the file is
+    written (see ``lock_database``).
+
+    If the file has been modified by another process since ``db`` was loaded
+    from it, it is re-loaded, and ``db`` is rebased onto it (see
+    ``Database.rebase``), so that the changes made by both processes are
+    saved. A ``ConflictError`` is raised, and nothing is saved, if any
+    account was changed by both processes (unless they made the same change),
+    if the key slots were changed by both processes, or if the file is
+    encrypted with a different data key.
+
+    If the file was loaded from (or last saved to) ``filename``, the changes
+    in the ``Database.journal`` are appended to the file. If the key slots
+    have been changed (e.g. the master password has been changed), the
+    header is re-written in place (see ``write_header``). Otherwise, or if
+    the number of appended changes would exceed ``LOG_COMPACT_THRESHOLD``,
+    the file is compacted, i.e. re-written from scratch.
+
+    If the database was loaded from a sharded vault, or ``filename`` is a
+    directory, it is saved as a sharded vault (see the ``shards`` module).
+
+    Returns ``True`` if ``db`` was merged with changes made by another
+    process, ``False`` otherwise.
+    """
 
+    with lock_database(filename, exclusive=True):
+        merged = file_stamp(filename) != db.stamp
+        if merged:
+            with trace.span('db.merge'):
+                _merge_database(db, filename)
 
-def save_database(db       : Database,
-                  filename : pathtype):
-    """Encrypts and saves the database to file, using the
-    ``Database.password``, and a randomly generated salt.
-    """
-
-    entries = []
-
-    for names, (u, p) in db:
-        notes = db.get_notes(names)
-        entries.append({
-            'names'    : names,
-            'username' : u,
-            'password' : p})
-        if notes is not None:
-            entries[-1]['notes'] = notes
-
-    entries = json.dumps(entries)
-    passwd  = db.password
-    salt    = encryption.generate_salt()
-    entries = encryption.sencrypt(entries, passwd, salt)
-    salt    = encryption. encrypt(salt,    passwd.encode()).decode()
-
-    with open(filename, 'wt') as f:
-        f.write(json.dumps({'salt' : salt, 'entries' : entries}))
+        if db.manifest is not None or op.isdir(filename):
+            from . import shards
+            shards.save_database(db, filename)
+        else:
+            _save_database(db, filename)
+        db.stamp = file_stamp(filename)
+    return merged
+
+
+def _merge_database(db : Database, filename : pathtype):
+    """Called by ``save_database`` when the database file has been modified
+    since ``db`` was loaded. Re-loads the file, and rebases ``db`` onto it.
+    """
+
+    # The accounts' state before and
+    # after the changes made to db
+    before = {}
+    after  = {}
+    for change in db.journal:
+        names = change['names']
+        before.setdefault(names, change['base'])
+        after[names] = db.state(names)
+
+    if db.stamp is None or db.key is None:
+        raise ConflictError(f'{filename} was created or modified by another '
+                            'process while the master password was being set')
+
+    # The data key is re-used if the file is
+    # still encrypted with it, even if the key
+    # slots have been changed by the other process
+    try:
+        theirs = _read_database(filename, db.password, db.key)
+    except encryption.AuthenticationError:
+        theirs = None
+    if theirs is None or theirs.key is not db.key:
+        raise ConflictError(f'{filename} was re-encrypted with a different '
+                            'key by another process')
+    if theirs.encoding != db.encoding:
+        raise ConflictError(f'The encoding of {filename} was changed by '
+                            'another process')
+
+    # Changes made by both processes conflict,
+    # unless they have the same outcome, in
+    # which case ours are not re-applied
+    same      = set()
+    conflicts = []
+    for names, base in before.items():
+        current = theirs.state(names)
+        if   current == after[names]: same.add(names)
+        elif current != base:         conflicts.append(names)
+
+    if len(conflicts) > 0:
+        raise ConflictError(f'Accounts in {filename} were changed by another '
+                            'process', conflicts)
+
+    stamp      = file_stamp(filename)
+    db.journal = [c for c in db.journal if c['names'] not in same]
+    db.rebase(theirs)
+    db.stamp   = stamp
+
+
+def _save_database(db : Database, filename : pathtype):
+    """Used by ``save_database`` - saves a database without locking it. """
+
+    journal = db.journal
+    append  = db.key      is not None and \
+              db.log_size is not None and \
+              db.log_size + len(journal) <= LOG_COMPACT_THRESHOLD
+
+    # The header only needs to be re-written if
+    # the key slots have changed - if there
+    # isn't room for it, the file is compacted
+    if append and db.keys_changed:
+        with trace.span('db.header'):
+            append = write_header(db, filename)
+
+    if append:
+        with trace.span('db.append', changes=len(journal)):
+            append_changes(db, filename, journal)
+        db.log_size += len(journal)
+    else:
+        with trace.span('db.snapshot'):
+            _write_snapshot(db, filename)
+        db.log_size = 0
+
+    db.changed      = False
+    db.keys_changed = False
+
+
+def append_changes(db       : Database,
+                    filename : pathtype,
+                    journal  : List[Dict[str, Any]]):
+    """Encrypts and appends a list of changes to a database file. """
+    binary = db.encoding == 'binary'
+    lines  = []
+    for change in journal:
+        change = {k : v for k, v in change.items() if k != 'base'}
+        change = compression.compress(json.dumps(change).encode(),
+                                      db.compression)
+        if binary:
+            change = db.key.seal('log', change)
+            lines.append(RECORD.pack(RECORD_LOG, len(change)) + change)
+        else:
+            change = db.key.encrypt('log', change).decode()
+            lines.append((json.dumps({'log' : change}) + '\n').encode())
+
+    with open(filename, 'r+b') as f:
+
+        # If a previous append was interrupted, the file
+        # will end with a partial line/record - discard it
+        end = f.seek(0, os.SEEK_END)
+        if binary:
+            pos = _binary_end(f)
+        else:
+            pos = end
+            while pos > 0:
+                f.seek(pos - 1)
+                if f.read(1) == b'\n':
+                    break
+                pos -= 1
+        if pos < end:
+            f.truncate(pos)
+        f.seek(pos)
+
+        f.write(b''.join(lines))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _write_snapshot(db       : Database,
+                    filename : pathtype):
+    """Encrypts and saves all entries in the database to file. A new data
+    key is generated if the database does not already have one (i.e. it is
+    a new database).
+
+    Entries which have not been decrypted are saved as-is.
+    """
+
+    if db.key is None:
+        db.key = encryption.MasterKey.generate()
+
+    key   = db.key
+    lines = list(header_blocks(file_header(db), db.encoding))
+
+    with trace.span('db.encrypt'):
+        lines.extend(entry_lines(key, db.unsealed(), db.sealed(),
+                                 db.compression, db.encoding))
+
+    with trace.span('db.write'):
+        write_file(filename, lines)
+
+
+def entry_lines(
+        key      : encryption.MasterKey,
+        unsealed : Iterable[Tuple[Tuple[str, ...],
+                                  Tuple[str, str],
+                                  Union[str, None]]],
+        sealed   : Iterable[Tuple[Tuple[str, ...], str]],
+        method   : str = None,
+        encoding : str = 'json'
+) -> Iterator[Union[str, bytes]]:
+    """Yields a line (or a ``bytes`` record, if ``encoding`` is
+    ``'binary'``) for each of the given entries - decrypted entries, as
+    returned by ``Database.unsealed``, are encrypted (and compressed with
+    ``method``), and sealed entries, as returned by ``Database.sealed``,
+    which must have the same encoding, are saved as-is.
+    """
+    if encoding == 'binary':
+        for names, credentials, notes in unsealed:
+            index, token = seal_entry(key, names, credentials, notes, method,
+                                      encoding)
+            yield _binary_entry(index, token)
+        for index, token in sealed:
+            yield _binary_entry(index, token)
+        return
+
+    for names, credentials, notes in unsealed:
+        index, token = seal_entry(key, names, credentials, notes, method)
+        yield json.dumps({'index' : index, 'entry' : token}) + '\n'
+    for index, token in sealed:
+        token = str(token)
+        yield json.dumps({'index' : index, 'entry' : token}) + '\n'
+
+
+def write_file(filename : pathtype, lines : Iterable[Union[str, bytes]]):
+    """Write ``lines`` (``str`` or ``bytes`` objects) to ``filename``.
+
+    The lines are written to a temporary file which is then renamed, so the
+    original file (which may be memory-mapped by sealed entries) is not
+    modified in place, and is never left partially written.
+    """
+    dirname   = op.dirname(op.abspath(filename))
+    fd, tmpfn = tempfile.mkstemp(dir=dirname, prefix='.deets')
+    try:
+        with open(fd, 'wb') as f:
+            f.write(b''.join(l.encode() if isinstance(l, str) else l
+                             for l in lines))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpfn, filename)
+    except Exception:
+        os.remove(tmpfn)
+        raise
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+"""Default settings, and other constants which are needed to parse the
+command-line arguments. ``deets.main`` imports this module at startup, before
+it knows which command is being run, so it must not import anything which is
+slow to import (e.g. ``cryptography``).
+"""
+
+
+import string
+
+
+DEFAULT_TTL = 900
+"""Default number of seconds for which an unlocked vault is cached by the
+deets agent.
+"""
+
+
+CLIPBOARD_CLEAR = 30
+"""Default number of seconds after which a password copied to the clipboard
+is cleared.
+"""
+
+
+KDF_ALGORITHMS = ['pbkdf2-sha256', 'scrypt']
+"""Names of the available key derivation functions, which are implemented
+in ``encryption.KDFS``.
+"""
+
+
+PASSWORD_CHARACTER_CLASSES = {
+    'uppercase'   : string.ascii_uppercase,
+    'lowercase'   : string.ascii_lowercase,
+    'numbers'     : string.digits,
+    'punctuation' : string.punctuation,
+}
+"""Character classes which randomly generated passwords can be drawn from.
+"""
@@ -3,62 +3,56 @@
 
 import           os
 import base64 as b64
-import           string
-import           secrets
+import           hmac
+import           time
 
-from typing import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from typing             import Sequence, Callable, Union, Dict, Any
 
+from cryptography.exceptions                   import InvalidTag
 from cryptography.fernet                       import Fernet, InvalidToken
 from cryptography.hazmat.primitives            import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf   import HKDF
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 
+from . import defaults
+from . import passwords
+from . import trace
 
-def generate_salt() -> bytes:
-    return os.urandom(16)
 
+DEFAULT_KDF = {'algorithm' : 'pbkdf2-sha256', 'iterations' : 390000}
+"""Key derivation function and parameters used for new databases. See the
+``KDFS`` dictionary for the available algorithms.
+"""
 
-PASSWORD_CHARACTER_CLASSES = {
-    'uppercase'   : string.ascii_uppercase,
-    'lowercase'   : string.ascii_lowercase,
-    'numbers'     : string.digits,
-    'punctuation' : string.punctuation,
-}
-PASSWORD_CLASS_TESTS  = {
-    'uppercase'   : str.isupper,
-    'lowercase'   : str.islower,
-    'numbers'     : str.isdigit,
-    'punctuation' : lambda c: c in string.punctuation
-}
 
+NONCE_SIZE = 12
+"""Size of the nonce used by ``MasterKey.seal``. """
 
-# TODO conform to different constraints selected by user
-#      (e.g. min/max length, allowable characters, etc)
-def generate_random_password(length  : int           = None,
-                             classes : Sequence[str] = None) -> str:
 
-    if length  is None: length  = 20
-    if classes is None: classes = ['uppercase', 'lowercase', 'numbers']
+SCRYPT_MAX_MEMORY = 2 ** 28
+"""Maximum total memory (in bytes) used by the scrypt lanes which are run at
+the same time (see ``_scrypt``). ``calibrate_kdf`` does not choose
+parameters which would need more than this for all lanes to run in parallel.
+"""
 
-    if len(classes) < 1 or \
-       any(c not in PASSWORD_CHARACTER_CLASSES for c in classes):
-        raise ValueError(f'{classes}')
 
-    chars = ''
-    tests = []
-    for cls in classes:
-        chars += PASSWORD_CHARACTER_CLASSES[cls]
-        tests.append(PASSWORD_CLASS_TESTS[  cls])
+def generate_salt() -> bytes:
+    return os.urandom(16)
+
 
-    chars = ''.join(chars)
+PASSWORD_CHARACTER_CLASSES = defaults.PASSWORD_CHARACTER_CLASSES
 
-    # Taken from the python secrets module documentation
-    while True:
-        password = ''.join(secrets.choice(chars) for i in range(length))
-        if any(c.islower() for c in password) and \
-           any(c.isupper() for c in password) and \
-           sum(c.isdigit() for c in password) >= 3:
-            break
-    return password
+
+def generate_random_password(length  : int           = None,
+                             classes : Sequence[str] = None) -> str:
+    """Generate a random password containing at least one character from
+    each of the given classes. See the ``passwords`` module for more control
+    over the generated passwords.
+    """
+    return passwords.generate(passwords.PasswordPolicy(length, classes))
 
 
 class AuthenticationError(Exception):
@@ -100,18 +94,337 @@ def sdecrypt(data     : str,
     return decrypt(data, password, salt).decode()
 
 
-# https://cryptography.io/en/latest/fernet/#using-passwords-with-fernet
-def _create_encrypter(password : bytes,
-                      salt     : bytes = None) -> Fernet:
+# Function which may be registered via set_key_deriver, to
+# provide keys without running the KDF in this process
+# (e.g. to skip the KDF when benchmarking).
+_key_deriver = None
+
+
+def set_key_deriver(
+        deriver : Union[Callable[[bytes, bytes, Dict[str, Any]],
+                                 Union[bytes, None]], None]):
+    """Register a function which will be used in place of the local KDF.
+
+    The function must accept a password, a salt, and a dictionary of KDF
+    parameters, and must return the derived key, or ``None``, in which
+    case the key is derived locally.  Pass ``None`` to clear the registered
+    function.
+    """
+    global _key_deriver
+    _key_deriver = deriver
+
+
+def derive_key(password : bytes,
+               salt     : bytes          = None,
+               kdf      : Dict[str, Any] = None) -> bytes:
+    """Derive a base64-encoded Fernet key from a password and salt. """
+
+    if salt is None: salt = b'\00' * 16
+    if kdf  is None: kdf  = DEFAULT_KDF
+
+    with trace.span('encryption.kdf', algorithm=kdf['algorithm']):
+        if _key_deriver is not None:
+            key = _key_deriver(password, salt, kdf)
+            if key is not None:
+                return key
+
+        params    = dict(kdf)
+        algorithm = params.pop('algorithm')
+        if algorithm not in KDFS:
+            raise ValueError(f'Unknown KDF: {algorithm}')
 
-    if salt is None:
-        salt = b'\00' * 16
+        return b64.urlsafe_b64encode(KDFS[algorithm](password, salt, **params))
 
+
+def _pbkdf2(password   : bytes,
+            salt       : bytes,
+            iterations : int) -> bytes:
+    """PBKDF2-HMAC-SHA256 key derivation. """
     kdf = PBKDF2HMAC(
         algorithm=hashes.SHA256(),
         length=32,
         salt=salt,
-        iterations=390000)
-    key = b64.urlsafe_b64encode(kdf.derive(password))
+        iterations=iterations)
+    return kdf.derive(password)
+
+
+def _scrypt(password : bytes,
+            salt     : bytes,
+            n        : int,
+            r        : int,
+            p        : int,
+            lanes    : int = 1) -> bytes:
+    """scrypt key derivation.
+
+    OpenSSL evaluates the scrypt ``p`` parameter serially, so to make use of
+    multiple cores, ``lanes`` independent scrypt derivations (each with its
+    own salt) are run in parallel threads, and their outputs combined with
+    HKDF. Each lane needs ``128 * r * n`` bytes of memory, so fewer lanes
+    are run at once if they would need more than ``SCRYPT_MAX_MEMORY``.
+    """
+
+    def lane(i):
+        lsalt = salt
+        if lanes > 1:
+            lsalt = salt + i.to_bytes(4, 'big')
+        return Scrypt(salt=lsalt, length=32, n=n, r=r, p=p).derive(password)
+
+    if lanes == 1:
+        return lane(0)
+
+    workers = max(1, min(lanes, SCRYPT_MAX_MEMORY // (128 * r * n)))
+    with ThreadPoolExecutor(workers) as pool:
+        keys = list(pool.map(lane, range(lanes)))
+
+    hkdf = HKDF(algorithm=hashes.SHA256(),
+                length=32,
+                salt=salt,
+                info=b'deets:scrypt-lanes')
+    return hkdf.derive(b''.join(keys))
+
+
+KDFS = {
+    'pbkdf2-sha256' : _pbkdf2,
+    'scrypt'        : _scrypt,
+}
+"""Available key derivation functions. Each function accepts a password,
+salt, and algorithm-specific parameters as keyword arguments.
+"""
+
+
+def calibrate_kdf(algorithm : str   = 'pbkdf2-sha256',
+                  target    : float = 0.25) -> Dict[str, Any]:
+    """Benchmark a key derivation function on this machine, and choose
+    parameters which will take approximately ``target`` seconds.
+
+    For scrypt, one lane is used for each available CPU, and the cost
+    parameter ``n`` is chosen as the largest power of two whose derivation
+    time does not exceed the target. Lanes are dropped as ``n`` grows, so
+    that the total memory used does not exceed ``SCRYPT_MAX_MEMORY`` (half
+    the lanes with twice the memory each take the same time, but are more
+    costly to attack).
+    """
+
+    def bench(**params):
+        start = time.perf_counter()
+        KDFS[algorithm](b'password', generate_salt(), **params)
+        return time.perf_counter() - start
+
+    if algorithm == 'pbkdf2-sha256':
+        iterations = 10000
+        elapsed    = bench(iterations=iterations)
+        iterations = int(iterations * target / elapsed)
+        iterations = max(10000, round(iterations, -3))
+        return {'algorithm' : algorithm, 'iterations' : iterations}
+
+    elif algorithm == 'scrypt':
+        params = {'n' : 2 ** 12, 'r' : 8, 'p' : 1,
+                  'lanes' : min(os.cpu_count() or 1, 8)}
+
+        def memory(n, lanes):
+            return 128 * params['r'] * n * lanes
+
+        # scrypt time (and memory) is linear in
+        # n - estimate from a cheap derivation
+        elapsed = bench(**params)
+        while params['n'] < 2 ** 20 and elapsed * 2 <= target:
+            if memory(params['n'] * 2, params['lanes']) > SCRYPT_MAX_MEMORY:
+                if params['lanes'] == 1:
+                    break
+                params['lanes'] //= 2
+            params['n'] *= 2
+            elapsed     *= 2
+
+        # verify that the estimate does not overshoot
+        while params['n'] > 2 ** 12 and bench(**params) > target * 1.5:
+            params['n'] //= 2
+
+        return {'algorithm' : algorithm, **params}
+
+    raise ValueError(f'Unknown KDF: {algorithm}')
+
+
+# https://cryptography.io/en/latest/fernet/#using-passwords-with-fernet
+def _create_encrypter(password : bytes,
+                      salt     : bytes = None) -> Fernet:
+    return Fernet(derive_key(password, salt))
+
+
+class MasterKey:
+    """A key derived from the master password, from which independent
+    sub-keys are expanded (via HKDF) for each purpose for which data is
+    encrypted. The expensive key derivation function is only run once, when
+    a ``MasterKey`` is created.
+
+    A ``MasterKey`` may also be created from random bytes, rather than from
+    a password (see ``generate``), e.g. to be used as a data key which is
+    stored wrapped by a password-derived key (see ``wrap``, and the ``keys``
+    module).
+    """
+
+
+    def __init__(self,
+                 password : str,
+                 salt     : bytes          = None,
+                 kdf      : Dict[str, Any] = None):
+        """Create a ``MasterKey``.
+
+        :arg password: Master password
+        :arg salt:     Salt - a new random salt is generated if not provided.
+        :arg kdf:      Key derivation function parameters - defaults to
+                       ``DEFAULT_KDF``.
+        """
+        if salt is None: salt = generate_salt()
+        if kdf  is None: kdf  = dict(DEFAULT_KDF)
+
+        key = b64.urlsafe_b64decode(derive_key(password.encode(), salt, kdf))
+        self.__setup(key, salt, kdf)
+
+
+    def __setup(self,
+                key  : bytes,
+                salt : Union[bytes, None],
+                kdf  : Union[Dict[str, Any], None]):
+        self.__salt     = salt
+        self.__kdf      = kdf
+        self.__key      = key
+        self.__fernets  = {}
+        self.__aeads    = {}
+        self.__blindKey = None
+
+
+    @classmethod
+    def from_bytes(cls,
+                   key  : bytes,
+                   salt : bytes          = None,
+                   kdf  : Dict[str, Any] = None) -> 'MasterKey':
+        """Create a ``MasterKey`` from 32 bytes of key material, without
+        running a key derivation function. The ``salt`` and ``kdf`` should
+        be given if the key was derived from a password (see ``to_bytes``).
+        """
+        if len(key) != 32:
+            raise ValueError('Master keys must be 32 bytes long')
+        self = cls.__new__(cls)
+        self.__setup(key, salt, kdf)
+        return self
+
+
+    def to_bytes(self) -> bytes:
+        """Return the key material, e.g. to be cached by the deets agent.
+        The key can be re-created with ``from_bytes``.
+        """
+        return self.__key
+
+
+    @classmethod
+    def generate(cls) -> 'MasterKey':
+        """Create a new random ``MasterKey``. """
+        return cls.from_bytes(os.urandom(32))
+
+
+    @property
+    def salt(self) -> Union[bytes, None]:
+        return self.__salt
+
+
+    @property
+    def kdf(self) -> Union[Dict[str, Any], None]:
+        if self.__kdf is None:
+            return None
+        return dict(self.__kdf)
+
+
+    @property
+    def check(self) -> str:
+        """A key check value - a short value derived from the key, encoded
+        as a base64 string, which can be used to identify it without
+        revealing anything about it.
+        """
+        return b64.b64encode(self.subkey('check')[:16]).decode()
+
+
+    def subkey(self, purpose : str) -> bytes:
+        """Expand a 32 byte sub-key for the given purpose. """
+        hkdf = HKDF(algorithm=hashes.SHA256(),
+                    length=32,
+                    salt=None,
+                    info=f'deets:{purpose}'.encode())
+        return hkdf.derive(self.__key)
+
+
+    def fernet(self, purpose : str) -> Fernet:
+        """Return a ``Fernet`` encrypter for the given purpose. """
+        fernet = self.__fernets.get(purpose)
+        if fernet is None:
+            key    = b64.urlsafe_b64encode(self.subkey(purpose))
+            fernet = Fernet(key)
+            self.__fernets[purpose] = fernet
+        return fernet
+
+
+    def blind(self, data : str) -> str:
+        """Return a keyed hash (a truncated HMAC-SHA256, using the
+        ``'index'`` sub-key) of ``data``, encoded as a base64 string. Used
+        to build indices which can be searched without being decrypted.
+        """
+        if self.__blindKey is None:
+            self.__blindKey = self.subkey('index')
+        digest = hmac.digest(self.__blindKey, data.encode(), 'sha256')
+        return b64.b64encode(digest[:16]).decode()
+
+
+    def encrypt(self, purpose : str, data : bytes) -> bytes:
+        """Encrypt a byte sequence with the sub-key for ``purpose``. """
+        return self.fernet(purpose).encrypt(data)
+
+
+    def decrypt(self, purpose : str, data : bytes) -> bytes:
+        """Decrypt a byte sequence with the sub-key for ``purpose``. """
+        try:
+            return self.fernet(purpose).decrypt(data)
+        except InvalidToken:
+            raise AuthenticationError()
+
+
+    def aead(self, purpose : str) -> AESGCM:
+        """Return an AES-256-GCM cipher for the given purpose. Its sub-key
+        is independent of the ``fernet`` sub-key for the same purpose.
+        """
+        aead = self.__aeads.get(purpose)
+        if aead is None:
+            aead = AESGCM(self.subkey(f'aead:{purpose}'))
+            self.__aeads[purpose] = aead
+        return aead
+
+
+    def seal(self, purpose : str, data : bytes) -> bytes:
+        """Encrypt a byte sequence with AES-256-GCM, using the sub-key for
+        ``purpose``. Returns the raw (unencoded) random 12 byte nonce,
+        followed by the ciphertext and 16 byte tag.
+        """
+        nonce = os.urandom(NONCE_SIZE)
+        return nonce + self.aead(purpose).encrypt(nonce, data, None)
+
+
+    def unseal(self, purpose : str, data : Union[bytes, memoryview]) -> bytes:
+        """Decrypt a byte sequence which was encrypted by ``seal``. ``data``
+        may be a ``memoryview``, which is not copied.
+        """
+        data = memoryview(data)
+        try:
+            return self.aead(purpose).decrypt(data[:NONCE_SIZE],
+                                              data[NONCE_SIZE:], None)
+        except InvalidTag:
+            raise AuthenticationError()
+
+
+    def wrap(self, key : 'MasterKey') -> bytes:
+        """Encrypt (wrap) another ``MasterKey`` with this one. """
+        return self.seal('keyslot', key.__key)
+
 
-    return Fernet(key)
+    def unwrap(self, wrapped : bytes) -> 'MasterKey':
+        """Decrypt a ``MasterKey`` which was wrapped with this one by
+        ``wrap``.
+        """
+        return MasterKey.from_bytes(self.unseal('keyslot', wrapped))
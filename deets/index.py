@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+"""Indices used by the ``Database`` to look up accounts by name. """
+
+
+import itertools as it
+import bisect
+import array
+
+from typing import List, Tuple, Sequence, Set, Union, Iterable
+
+
+Key = Tuple[str, ...]
+
+
+class NameIndex:
+    """Inverted index from names to the account keys (tuples of names) which
+    contain them.
+
+    Each key is assigned an integer ID, and each name has a posting list - a
+    sorted array of the IDs of all keys which contain that name (or, to save
+    memory, just the ID for names which are only used by one key). Queries for
+    multiple names are answered by intersecting posting lists, starting from
+    the shortest one. Sorted query results are cached until the index is
+    next modified.
+
+    Approximate searches are performed with a ``TrigramIndex`` of all names,
+    which is created on the first call to ``search``, and is updated as keys
+    are added and removed thereafter.
+    """
+
+
+    def __init__(self):
+        self.__ids      = {}
+        self.__keys     = []
+        self.__free     = []
+        self.__postings = {}
+        self.__vocab    = None
+        self.__trigrams = None
+        self.__cache    = {}
+
+
+    def __len__(self) -> int:
+        return len(self.__ids)
+
+
+    def __contains__(self, key : Key) -> bool:
+        return key in self.__ids
+
+
+    def copy(self) -> 'NameIndex':
+        """Return an independent copy of this index. """
+        idx = NameIndex()
+        idx.__ids      = dict(self.__ids)
+        idx.__keys     = list(self.__keys)
+        idx.__free     = list(self.__free)
+        idx.__postings = {n : p if isinstance(p, int) else array.array('I', p)
+                          for n, p in self.__postings.items()}
+        if self.__trigrams is not None:
+            idx.__trigrams = self.__trigrams.copy()
+        return idx
+
+
+    def add(self, key : Key):
+        """Add a key to the index. Has no effect if the key is already in
+        the index.
+        """
+        if key in self.__ids:
+            return
+
+        kid = self.__allocate(key)
+
+        for name in key:
+            postings = self.__postings.get(name)
+            if postings is None:
+                self.__postings[name] = kid
+                self.__vocab          = None
+                if self.__trigrams is not None:
+                    self.__trigrams.add(name)
+            elif isinstance(postings, int):
+                postings              = sorted((postings, kid))
+                self.__postings[name] = array.array('I', postings)
+            elif postings[-1] < kid:
+                postings.append(kid)
+            else:
+                postings.insert(bisect.bisect_left(postings, kid), kid)
+
+        self.__cache.clear()
+
+
+    def update(self, keys : Iterable[Key]):
+        """Add many keys to the index. Equivalent to calling ``add`` for each
+        key, but much faster for large numbers of keys, as each posting list
+        is only re-built once.
+        """
+        added = {}
+        for key in keys:
+            if key in self.__ids:
+                continue
+            kid = self.__allocate(key)
+            for name in key:
+                added.setdefault(name, []).append(kid)
+
+        for name, kids in added.items():
+            postings = self.__postings.get(name)
+
+            if postings is None:
+                self.__vocab = None
+                if self.__trigrams is not None:
+                    self.__trigrams.add(name)
+                if len(kids) == 1:
+                    self.__postings[name] = kids[0]
+                    continue
+                postings = ()
+            elif isinstance(postings, int):
+                postings = (postings,)
+
+            postings              = sorted(it.chain(postings, kids))
+            self.__postings[name] = array.array('I', postings)
+
+        self.__cache.clear()
+
+
+    def __allocate(self, key : Key) -> int:
+        """Assign an ID to a new key. """
+        if len(self.__free) > 0:
+            kid              = self.__free.pop()
+            self.__keys[kid] = key
+        else:
+            kid = len(self.__keys)
+            self.__keys.append(key)
+        self.__ids[key] = kid
+        return kid
+
+
+    def remove(self, key : Key):
+        """Remove a key from the index. """
+        kid              = self.__ids.pop(key)
+        self.__keys[kid] = None
+        self.__free.append(kid)
+
+        for name in key:
+            postings = self.__postings[name]
+            if isinstance(postings, int):
+                self.__postings.pop(name)
+                self.__vocab = None
+                if self.__trigrams is not None:
+                    self.__trigrams.remove(name)
+            else:
+                del postings[bisect.bisect_left(postings, kid)]
+                if len(postings) == 1:
+                    self.__postings[name] = postings[0]
+
+        self.__cache.clear()
+
+
+    def lookup(self, names : Sequence[str]) -> List[Key]:
+        """Return a sorted list of all keys which contain all of the given
+        names.
+        """
+        query = ('all', tuple(names))
+        hits  = self.__cache.get(query)
+
+        if hits is None:
+            postings = [self.__get_postings(n) for n in names]
+
+            if len(postings) == 0 or any(p is None for p in postings):
+                hits = []
+            else:
+                hits = self.__intersect(postings)
+                hits = sorted(self.__keys[kid] for kid in hits)
+
+            self.__cache[query] = hits
+
+        return list(hits)
+
+
+    def lookup_any(self, names : Sequence[str]) -> List[Key]:
+        """Return a sorted list of all keys which contain any of the given
+        names.
+        """
+        query = ('any', tuple(names))
+        hits  = self.__cache.get(query)
+
+        if hits is None:
+            kids = set()
+            for name in names:
+                kids.update(self.__get_postings(name) or ())
+            hits = sorted(self.__keys[kid] for kid in kids)
+            self.__cache[query] = hits
+
+        return list(hits)
+
+
+    def lookup_prefix(self, prefixes : Sequence[str]) -> List[Key]:
+        """Return a sorted list of all keys which, for each of the given
+        prefixes, contain a name which starts with that prefix.
+        """
+        query = ('prefix', tuple(prefixes))
+        hits  = self.__cache.get(query)
+
+        if hits is None:
+            if self.__vocab is None:
+                self.__vocab = sorted(self.__postings.keys())
+
+            kids = [self.__prefix_ids(p) for p in prefixes]
+            kids = sorted(kids, key=len)
+
+            if len(kids) == 0: hits = []
+            else:              hits = set.intersection(*kids)
+            hits = sorted(self.__keys[kid] for kid in hits)
+            self.__cache[query] = hits
+
+        return list(hits)
+
+
+    def search(self,
+               names     : Sequence[str],
+               limit     : int   = None,
+               threshold : float = 0.2) -> List[Tuple[float, Key]]:
+        """Approximate search. Returns up to ``limit`` ``(score, key)``
+        tuples, in decreasing order of score, for keys which contain, for
+        each of the given names, a name which is similar to it.
+
+        The similarity of two names is the Dice coefficient of their
+        trigrams (see ``TrigramIndex``), and the score of a key is the mean
+        similarity of its best match for each query name.
+        """
+        if self.__trigrams is None:
+            self.__trigrams = TrigramIndex()
+            for name in self.__postings.keys():
+                self.__trigrams.add(name)
+
+        if len(names) == 0:
+            return []
+
+        # best score for each query name, for each key
+        scores = None
+        for name in names:
+            nscores = {}
+            for match, score in self.__trigrams.search(name, threshold):
+                for kid in self.__get_postings(match):
+                    if score > nscores.get(kid, 0):
+                        nscores[kid] = score
+
+            if scores is None:
+                scores = nscores
+            else:
+                scores = {kid : scores[kid] + score
+                          for kid, score in nscores.items()
+                          if kid in scores}
+
+        hits = [(score / len(names), self.__keys[kid])
+                for kid, score in scores.items()]
+        hits = sorted(hits, key=lambda h: (-h[0], h[1]))
+
+        if limit is not None:
+            hits = hits[:limit]
+        return hits
+
+
+    def __get_postings(self, name : str) -> Union[Sequence[int], None]:
+        """Return the posting list for ``name``, or ``None`` if no keys
+        contain ``name``.
+        """
+        postings = self.__postings.get(name)
+        if isinstance(postings, int):
+            postings = (postings,)
+        return postings
+
+
+    def __prefix_ids(self, prefix : str) -> Set[int]:
+        """Return the IDs of all keys containing a name which starts with
+        ``prefix``.
+        """
+        vocab = self.__vocab
+        kids  = set()
+        start = bisect.bisect_left(vocab, prefix)
+        for i in range(start, len(vocab)):
+            if not vocab[i].startswith(prefix):
+                break
+            kids.update(self.__get_postings(vocab[i]))
+        return kids
+
+
+    @staticmethod
+    def __intersect(postings : List[array.array]) -> List[int]:
+        """Intersect a collection of sorted posting lists, starting with the
+        shortest. Membership in the longer lists is tested by binary search.
+        """
+        postings = sorted(postings, key=len)
+        hits     = postings[0]
+
+        for other in postings[1:]:
+            if len(hits) == 0:
+                break
+            nother = len(other)
+            found  = []
+            lo     = 0
+            for kid in hits:
+                lo = bisect.bisect_left(other, kid, lo)
+                if lo == nother:
+                    break
+                if other[lo] == kid:
+                    found.append(kid)
+            hits = found
+
+        return list(hits)
+
+
+
+class TrigramIndex:
+    """Index of names by their trigrams - all three-character substrings of
+    each name, padded with two leading spaces and one trailing space (so
+    that the start and end of names are weighted more heavily). Used for
+    approximate matching of misspelt names.
+    """
+
+
+    def __init__(self):
+        self.__trigrams = {}
+        self.__names    = {}
+
+
+    @staticmethod
+    def trigrams(name : str) -> Set[str]:
+        """Return the set of trigrams for ``name``. """
+        padded = f'  {name} '
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+    def copy(self) -> 'TrigramIndex':
+        """Return an independent copy of this index. """
+        idx = TrigramIndex()
+        idx.__names    = dict(self.__names)
+        idx.__trigrams = {t : set(n) for t, n in self.__trigrams.items()}
+        return idx
+
+
+    def add(self, name : str):
+        """Add a name to the index. """
+        trigrams           = self.trigrams(name)
+        self.__names[name] = len(trigrams)
+        for trigram in trigrams:
+            self.__trigrams.setdefault(trigram, set()).add(name)
+
+
+    def remove(self, name : str):
+        """Remove a name from the index. """
+        self.__names.pop(name)
+        for trigram in self.trigrams(name):
+            names = self.__trigrams[trigram]
+            names.discard(name)
+            if len(names) == 0:
+                self.__trigrams.pop(trigram)
+
+
+    def search(self,
+               name      : str,
+               threshold : float = 0.2) -> List[Tuple[str, float]]:
+        """Return ``(name, similarity)`` tuples for all indexed names whose
+        similarity to ``name`` is at least ``threshold``. Similarity is
+        measured by the Dice coefficient of the trigram sets of the two
+        names.
+        """
+        trigrams = self.trigrams(name)
+        common   = {}
+        for trigram in trigrams:
+            for match in self.__trigrams.get(trigram, ()):
+                common[match] = common.get(match, 0) + 1
+
+        hits = []
+        for match, ncommon in common.items():
+            score = 2 * ncommon / (len(trigrams) + self.__names[match])
+            if score >= threshold:
+                hits.append((match, score))
+        return hits
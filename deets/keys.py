@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""Envelope encryption of vaults.
+
+The entries in a vault are encrypted with a random *data key* (see
+``encryption.MasterKey.generate``), which is never stored in plain text.
+Instead, the vault header (or manifest) contains one or more *key slots*,
+each of which contains a copy of the data key, wrapped (encrypted) with a
+key-encryption key derived from one unlock method. There are two types of
+key slot::
+
+    {"type" : "password",
+     "kdf"  : {"algorithm" : "pbkdf2-sha256", "iterations" : N},
+     "salt" : "<salt>",
+     "key"  : "<key>"}
+
+    {"type" : "keyfile",
+     "key"  : "<key>"}
+
+where ``<key>`` is the wrapped data key (see ``encryption.MasterKey.wrap``)
+and ``<salt>`` a random salt, both encoded as base64 strings. The key-
+encryption key of a password slot is derived from the master password,
+with the ``"kdf"`` and ``"salt"``. The key-encryption key of a key file slot
+is derived from the contents of the key file (see ``keyfile_key``) - a key
+file contains enough entropy that a slow key derivation function is not
+needed.
+
+The header also contains a check value for the data key (see
+``encryption.MasterKey.check``), so a process which already has the data
+key can use it without unwrapping it (see ``unlock``).
+
+Changing the master password, or adding or removing a key file, only
+changes the key slots, so the entries do not need to be re-encrypted (see
+``db.save_database``).
+"""
+
+
+import base64 as b64
+import            hashlib
+import            hmac
+import            os
+
+from typing import Dict, Any, List, Union
+
+from . import encryption
+
+
+KEYFILE_SIZE = 32
+"""Number of random bytes in a key file created by ``generate_keyfile``. """
+
+
+def password_slot(key      : encryption.MasterKey,
+                  password : str,
+                  kdf      : Dict[str, Any] = None) -> Dict[str, Any]:
+    """Create a key slot containing ``key`` wrapped with a key derived from
+    ``password``, with a new random salt.
+    """
+    kek = encryption.MasterKey(password, kdf=kdf)
+    return {'type' : 'password',
+            'kdf'  : kek.kdf,
+            'salt' : b64.b64encode(kek.salt).decode(),
+            'key'  : b64.b64encode(kek.wrap(key)).decode()}
+
+
+def keyfile_slot(key     : encryption.MasterKey,
+                 keyfile : str) -> Dict[str, Any]:
+    """Create a key slot containing ``key`` wrapped with a key derived from
+    the contents of ``keyfile``.
+    """
+    kek = keyfile_key(keyfile)
+    return {'type' : 'keyfile',
+            'key'  : b64.b64encode(kek.wrap(key)).decode()}
+
+
+def generate_keyfile(keyfile : str):
+    """Create a new key file containing random data. The file is only
+    readable by the current user. Raises a ``FileExistsError`` if
+    ``keyfile`` already exists.
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+    fd    = os.open(keyfile, flags, 0o600)
+    with open(fd, 'wb') as f:
+        f.write(os.urandom(KEYFILE_SIZE))
+
+
+def keyfile_key(keyfile : str) -> encryption.MasterKey:
+    """Return the key-encryption key for a key file, which is a hash of its
+    contents. Any file may be used as a key file, as long as it is never
+    modified.
+    """
+    with open(keyfile, 'rb') as f:
+        digest = hashlib.sha256(f.read()).digest()
+    return encryption.MasterKey.from_bytes(digest)
+
+
+def unwrap(slot : Dict[str, Any],
+           kek  : encryption.MasterKey) -> encryption.MasterKey:
+    """Unwrap the data key in ``slot`` with ``kek``. Raises an
+    ``encryption.AuthenticationError`` if ``kek`` is incorrect.
+    """
+    return kek.unwrap(b64.b64decode(slot['key']))
+
+
+def unlock(keyslots : List[Dict[str, Any]],
+           check    : str,
+           password : str                  = None,
+           keyfile  : str                  = None,
+           key      : encryption.MasterKey = None) -> encryption.MasterKey:
+    """Unwrap the data key from one of ``keyslots``.
+
+    :arg keyslots: Key slots
+    :arg check:    Check value of the data key
+                   (``encryption.MasterKey.check``)
+    :arg password: Master password, used to unlock password slots.
+    :arg keyfile:  Path to a key file, used to unlock key file slots.
+    :arg key:      Data key, e.g. from a previous load - if its check value
+                   matches ``check``, it is returned without anything being
+                   unwrapped.
+    :returns:      The data key. Raises an ``encryption.AuthenticationError``
+                   if no slot can be unlocked.
+    """
+    if key is not None and hmac.compare_digest(key.check, check):
+        return key
+
+    for slot in keyslots:
+        if   slot['type'] == 'keyfile'  and keyfile  is not None:
+            kek = keyfile_key(keyfile)
+        elif slot['type'] == 'password' and password is not None:
+            salt = b64.b64decode(slot['salt'])
+            kek  = encryption.MasterKey(password, salt, slot['kdf'])
+        else:
+            continue
+
+        try:
+            key = unwrap(slot, kek)
+        except encryption.AuthenticationError:
+            continue
+        if hmac.compare_digest(key.check, check):
+            return key
+
+    raise encryption.AuthenticationError()
+
+
+def find_slots(keyslots : List[Dict[str, Any]],
+               keyfile  : str) -> List[int]:
+    """Return the indices of the slots in ``keyslots`` which can be unlocked
+    with ``keyfile``.
+    """
+    kek   = keyfile_key(keyfile)
+    found = []
+    for i, slot in enumerate(keyslots):
+        if slot['type'] != 'keyfile':
+            continue
+        try:
+            unwrap(slot, kek)
+            found.append(i)
+        except encryption.AuthenticationError:
+            pass
+    return found
+
+
+def replace_password(keyslots : List[Dict[str, Any]],
+                     key      : encryption.MasterKey,
+                     password : str,
+                     kdf      : Dict[str, Any] = None
+                     ) -> List[Dict[str, Any]]:
+    """Return a copy of ``keyslots`` in which all password slots are
+    replaced by one new slot for ``password``. Key file slots are retained.
+    """
+    keyslots = [s for s in keyslots if s['type'] != 'password']
+    return keyslots + [password_slot(key, password, kdf)]
+
+
+def password_kdf(keyslots : List[Dict[str, Any]]
+                 ) -> Union[Dict[str, Any], None]:
+    """Return the key derivation function parameters of the first password
+    slot in ``keyslots``, or ``None`` if there are no password slots.
+    """
+    for slot in keyslots:
+        if slot['type'] == 'password':
+            return dict(slot['kdf'])
+    return None
@@ -6,12 +6,12 @@ import sys
 import signal
 import argparse
 
-from pathlib import Path
+from typing import Tuple, Union
 
-import deets.commands   as commands
-import deets.encryption as encryption
-import deets.db         as deetsdb
-import deets.ui         as ui
+import deets.compression as compression
+import deets.defaults    as defaults
+import deets.trace       as trace
+import deets.ui          as ui
 
 
 def on_sigint(*a):
@@ -26,6 +26,43 @@ def main():
 
     signal.signal(signal.SIGINT, on_sigint)
 
+    args = parse_args()
+
+    # Keep standard output clean for
+    # machine-readable output
+    machine = args.command in ('exec', 'generate', 'token')
+    if machine or getattr(args, 'json', False):
+        ui.set_stream(sys.stderr)
+
+    if args.timings or args.trace is not None:
+        trace.enable()
+    if args.profile is not None:
+        profiler = trace.profile()
+
+    try:
+        with trace.span('main', command=args.command):
+            return run(args)
+    finally:
+        if args.profile is not None:
+            trace.write_profile(profiler, args.profile)
+        if args.timings:
+            trace.report()
+        if args.trace is not None:
+            trace.write_chrome_trace(args.trace)
+
+
+def run(args : argparse.Namespace):
+    """Run the command specified by ``args``. """
+
+    # These modules (and cryptography, which they
+    # use) are slow to import, so are only imported
+    # once we know that a command is being run,
+    # rather than e.g. just printing help.
+    import deets.agent      as agent
+    import deets.commands   as commands
+    import deets.encryption as encryption
+    import deets.db         as deetsdb
+
     dispatch = {
         'list'     : commands.list_entries,
         'add'      : commands.add_entry,
@@ -33,27 +70,90 @@ def main():
         'change'   : commands.change_entry,
         'remove'   : commands.remove_entry,
         'password' : commands.change_master_password,
-        'repl'     : commands.repl_loop
+        'repl'     : commands.repl_loop,
+        'unlock'   : commands.unlock_agent,
+        'import'   : commands.import_entries,
+        'export'   : commands.export_entries,
+        'exec'     : commands.exec_command,
+        'shard'    : commands.shard_database,
+        'serve'    : commands.serve_database,
+        'compress' : commands.set_compression,
+        'convert'  : commands.convert_database,
+        'keyfile'  : commands.manage_keyfile,
+
+        'kdf-calibrate' : commands.calibrate_kdf,
     }
 
-    args = parse_args()
+    # commands which do not use the database
+    nodb = {
+        'agent'    : commands.run_agent,
+        'lock'     : commands.lock_agent,
+        'generate' : commands.generate_passwords,
+        'token'    : commands.manage_token,
+    }
+
+    if args.command in nodb:
+        return nodb[args.command](args)
 
     ui.printmsg(f'\ndeets password manager [{__version__}]',
                 ui.EMPHASIS, ui.UNDERLINE)
     ui.printmsg('Press CTRL+C at any time to exit', ui.INFO)
 
     if op.exists(args.db):
-        passwd = ui.prompt_password('\nEnter master password: ', ui.PROMPT)
-        ui.printmsg('Loading credentials database [', ui.INFO,
-                    args.db,                          ui.UNDERLINE,
-                    ']\n',                            ui.INFO)
 
-        try:
-            db = deetsdb.load_database(args.db, passwd)
-        except encryption.AuthenticationError:
-            ui.printmsg('Authentication error - could not decrypt '
-                        'credentials database!', ui.ERROR)
-            sys.exit(1)
+        def load(passwd, key=None):
+            ui.printmsg('Loading credentials database [', ui.INFO,
+                        args.db,                          ui.UNDERLINE,
+                        ']\n',                            ui.INFO)
+            try:
+                return deetsdb.load_database(args.db, passwd, key,
+                                             args.keyfile)
+            except OSError as e:
+                ui.printmsg(f'Could not read {e.filename}: {e.strerror}',
+                            ui.ERROR)
+                sys.exit(1)
+
+        # use the key cached by the agent if
+        # available, unless we are unlocking,
+        # using a key file, or running a command
+        # which needs the master password
+        needpw = args.command in ('unlock', 'password', 'kdf-calibrate') or \
+                 getattr(args, 'encrypt', False)
+        db     = None
+        passwd = None
+        if args.keyfile is not None:
+            if args.command == 'unlock':
+                ui.printmsg('The agent can only be unlocked with the master '
+                            'password', ui.ERROR)
+                sys.exit(1)
+            ui.printmsg('Using key file [', ui.INFO,
+                        args.keyfile,       ui.UNDERLINE,
+                        ']',                ui.INFO)
+        elif not needpw:
+            with trace.span('agent.lookup'):
+                key = agent.lookup(args.db)
+            if key is not None:
+                ui.printmsg('Using key from deets agent', ui.INFO)
+                # the cached key is stale if the
+                # database has been re-encrypted
+                try:
+                    db = load(None, key)
+                except encryption.AuthenticationError:
+                    ui.printmsg('The key from the deets agent does not '
+                                'match the credentials database', ui.WARNING)
+                    agent.lock(args.db)
+
+        if db is None:
+            if args.keyfile is None:
+                with trace.span('ui.prompt'):
+                    passwd = ui.prompt_password('\nEnter master password: ',
+                                                ui.PROMPT)
+            try:
+                db = load(passwd)
+            except encryption.AuthenticationError:
+                ui.printmsg('Authentication error - could not decrypt '
+                            'credentials database!', ui.ERROR)
+                sys.exit(1)
     else:
         ui.printmsg('Creating new credentials database [', ui.INFO,
                     args.db,                               ui.UNDERLINE,
@@ -61,20 +161,38 @@ def main():
         db = deetsdb.Database('')
         commands.change_master_password(db, args)
 
-    dispatch[args.command](db, args)
+    with trace.span(f'command.{args.command}'):
+        dispatch[args.command](db, args)
 
     if db.changed:
         ui.printmsg('Saving credentials database [', ui.INFO,
                     args.db,                         ui.UNDERLINE,
                     ']\n',                           ui.INFO)
-        deetsdb.save_database(db, args.db)
+        try:
+            deetsdb.save_database(db, args.db)
+        except deetsdb.ConflictError as e:
+            ui.printmsg(f'{e} - changes not saved!', ui.ERROR)
+            for account in e.accounts:
+                ui.printmsg('  Conflicting account: [', ui.ERROR,
+                            ' '.join(account),          ui.IMPORTANT,
+                            ']',                        ui.ERROR)
+            sys.exit(1)
+
+
+def parse_length(value : str) -> Union[int, Tuple[int, int]]:
+    """Parse a password length - either ``"N"``, or a range ``"MIN-MAX"``.
+    """
+    minlen, sep, maxlen = value.partition('-')
+    if sep == '':
+        return int(value)
+    return int(minlen), int(maxlen)
 
 
 def parse_args(argv=None):
     if argv is None:
         argv = sys.argv[1:]
 
-    defaultdb = os.environ.get('DEETSDB', Path.home() / '.deets')
+    defaultdb = os.environ.get('DEETSDB', op.expanduser('~/.deets'))
 
     parser = argparse.ArgumentParser('deets',
                                      description='Manage confidential details')
@@ -83,6 +201,21 @@ def parse_args(argv=None):
     parser.add_argument('-s', '--show', action='store_true')
 
     parser.add_argument('-d', '--db', metavar='FILE', default=defaultdb)
+    parser.add_argument('-k', '--keyfile', metavar='FILE',
+                        default=os.environ.get('DEETSKEYFILE', None),
+                        help='Unlock the database with a key file instead '
+                             'of the master password (defaults to '
+                             '$DEETSKEYFILE)')
+    parser.add_argument('--timings', action='store_true',
+                        help='Print the time taken by each phase to '
+                             'standard error')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='Save the time taken by each phase to FILE as '
+                             'a Chrome trace (see chrome://tracing)')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Profile with cProfile, and save the profile '
+                             'data to FILE, or print the most expensive '
+                             'functions to standard error if FILE is "-"')
 
     helps = {
         'list'     : 'List all entries',
@@ -92,22 +225,102 @@ def parse_args(argv=None):
         'remove'   : 'Delete an entry',
         'password' : 'Change the master password',
         'repl'     : 'Run multiple commands via an interactive prompt',
+        'agent'    : 'Run the deets agent in the foreground',
+        'unlock'   : 'Cache the key of the database in the deets agent '
+                     '(starting it if necessary)',
+        'lock'     : 'Remove all keys from the deets agent',
+        'import'   : 'Import accounts from a CSV or JSON Lines file',
+        'export'   : 'Export all accounts to a CSV or JSON Lines file, '
+                     'optionally encrypted with the master password',
+        'generate' : 'Print randomly generated passwords',
+        'shard'    : 'Save a copy of the database as a sharded vault '
+                     'directory, which can be used in place of the database '
+                     'file (only the parts of it which contain changed '
+                     'accounts are re-written when it is saved)',
+        'compress' : 'Change the method used to compress entries before '
+                     'they are encrypted (all entries are re-encrypted)',
+        'convert'  : 'Change the encoding of the database file - "binary" '
+                     'files are smaller and faster to load, "json" files '
+                     'can be read by other tools (all entries are '
+                     're-encrypted)',
+        'keyfile'  : 'Add a key file which can be used (via --keyfile) to '
+                     'unlock the database instead of the master password, '
+                     'or remove one',
+        'serve'    : 'Serve account credentials to local applications, over '
+                     'a HTTP/JSON API on a Unix socket (see deets.server)',
+        'token'    : 'Create (and print) or revoke the token which a client '
+                     'uses to authenticate with "deets serve"',
+        'exec'     : 'Run a command with account credentials in its '
+                     'environment, e.g. "deets exec DB="postgres prod" -- '
+                     'CMD [ARGS]". Sets <PREFIX>_USERNAME, <PREFIX>_PASSWORD '
+                     'and <PREFIX>_NOTES for each account. The prefix '
+                     'defaults to the account names, in upper case.',
+
+        'kdf-calibrate' : 'Choose master key derivation parameters which '
+                          'take a target amount of time on this machine',
 
         'names'    : 'Entry name(s)',
         'username' : 'Username (defaults to $DEETSUSERNAME)',
-        'length'   : 'Password (defaults to $DEETSPASSWORDLENGTH)',
+        'length'   : 'Password length, or range of lengths, e.g. "16-24" '
+                     '(defaults to $DEETSPASSWORDLENGTH, or 20)',
         'class'    : 'Password character class (defaults to $DEETSPASSWORDCLASS). ' +
                      'Can be used multiple times. Available classes: ' +
-                     ','.join(encryption.PASSWORD_CHARACTER_CLASSES.keys()),
+                     ','.join(defaults.PASSWORD_CHARACTER_CLASSES.keys()),
+        'min'      : 'Minimum number of characters from a class, e.g. '
+                     '"numbers=3" (default: 1). Can be used multiple times.',
+        'max'      : 'Maximum number of characters from a class, e.g. '
+                     '"punctuation=2" (default: no limit). Can be used '
+                     'multiple times.',
+        'exclude'  : 'Characters which must not be used in generated '
+                     'passwords, e.g. "l1IO0"',
+        'count'    : 'Number of passwords to generate (default: 1)',
         'print'    : 'Print password to standard output instead of '
-                     'copying it to the system clipboard.'
+                     'copying it to the system clipboard.',
+        'clear'    : 'Restore the clipboard this many seconds after copying '
+                     'a password, 0 to disable (defaults to '
+                     f'$DEETSCLIPBOARDCLEAR, or {defaults.CLIPBOARD_CLEAR} '
+                     'seconds)',
+        'ttl'      : 'Number of seconds to cache the key for '
+                     '(defaults to $DEETSAGENTTTL, or '
+                     f'{defaults.DEFAULT_TTL} seconds)',
+        'target'    : 'Target key derivation time in milliseconds '
+                      '(default: 250)',
+        'algorithm' : 'Key derivation function (default: pbkdf2-sha256)',
+        'file'      : 'File to import from/export to',
+        'directory' : 'Directory to create the sharded vault in',
+        'shards'    : 'Number of shards (default: 16)',
+        'socket'    : 'Socket to listen on (defaults to $DEETSSERVE, or '
+                      '~/.deets-serve)',
+        'client'    : 'Client name',
+        'method'    : 'Compression method',
+        'encoding'  : 'Database file encoding',
+        'revoke'    : 'Revoke the client token instead of creating one',
+        'path'      : 'Key file (created if it does not exist)',
+        'delete'    : 'Remove the key file from the database instead of '
+                      'adding it (the file itself is not deleted)',
+        'format'    : 'File format (default: determined from the file '
+                      'suffix - .csv or .jsonl)',
+        'json'      : 'Print the account(s) to standard output as JSON, '
+                      'without prompting. Each name is a separate account '
+                      '- quote multiple names for one account, e.g. '
+                      '"aws prod". Fails if any name matches more than one '
+                      'account.',
+        'accounts'  : 'Accounts, each of the form "[PREFIX=]name[ name...]"',
+        'encrypt'   : 'Encrypt the exported file with the master password '
+                      '(encrypted files are detected automatically on '
+                      'import)',
+        'overwrite' : 'Replace existing accounts with imported ones '
+                      '(default: existing accounts are left unchanged)',
     }
     username     = os.environ.get('DEETSUSERNAME',       None)
     char_classes = os.environ.get('DEETSPASSWORDCLASS',  None)
     pwd_length   = os.environ.get('DEETSPASSWORDLENGTH', None)
+    agent_ttl    = os.environ.get('DEETSAGENTTTL',       defaults.DEFAULT_TTL)
+    clip_clear   = os.environ.get('DEETSCLIPBOARDCLEAR',
+                                  defaults.CLIPBOARD_CLEAR)
 
     if char_classes is not None: char_classes = char_classes.split()
-    if pwd_length   is not None: pwd_length   = int(pwd_length)
+    if pwd_length   is not None: pwd_length   = parse_length(pwd_length)
 
     configs = {
         'names'    : {'nargs'   : '*'},
@@ -115,30 +328,95 @@ def parse_args(argv=None):
         'random'   : {'action'  : 'store_true'},
         'username' : {'default' : username},
         'length'   : {'default' : pwd_length,
+                      'type'    : parse_length},
+        'min'      : {'action'  : 'append',
+                      'metavar' : 'CLASS=N'},
+        'max'      : {'action'  : 'append',
+                      'metavar' : 'CLASS=N'},
+        'exclude'  : {'metavar' : 'CHARS'},
+        'count'    : {'default' : 1,
                       'type'    : int},
         'class'    : {'action'  : 'append',
                       'default' : char_classes,
-                      'dest'    : 'char_class'}
+                      'dest'    : 'char_class'},
+        'ttl'      : {'default' : float(agent_ttl),
+                      'type'    : float},
+        'clear'    : {'default' : float(clip_clear),
+                      'type'    : float},
+        'target'    : {'default' : 250,
+                       'type'    : float},
+        'algorithm' : {'default' : 'pbkdf2-sha256',
+                       'choices' : defaults.KDF_ALGORITHMS},
+        'file'      : {},
+        'directory' : {},
+        'shards'    : {'type'    : int},
+        'socket'    : {'metavar' : 'PATH'},
+        'client'    : {},
+        'method'    : {'choices' : ['none'] + compression.METHODS},
+        'encoding'  : {'choices' : ['json', 'binary']},
+        'revoke'    : {'action'  : 'store_true'},
+        'path'      : {'metavar' : 'FILE'},
+        'delete'    : {'action'  : 'store_true'},
+        'format'    : {'choices' : ['csv', 'jsonl']},
+        'overwrite' : {'action'  : 'store_true'},
+        'encrypt'   : {'action'  : 'store_true'},
+        'json'      : {'action'  : 'store_true'},
+        'accounts'  : {'nargs'   : '+'},
     }
 
     options = {
         'list'     : [('names',), ('-p', '--print')],
-        'get'      : [('names',), ('-p', '--print')],
+        'get'      : [('names',),
+                      ('-p', '--print'),
+                      ('-j', '--json'),
+                      ('-x', '--clear')],
         'add'      : [('names',),
                       ('-p', '--print'),
+                      ('-x', '--clear'),
                       ('-u', '--username'),
                       ('-l', '--length'),
-                      ('-c', '--class')],
+                      ('-c', '--class'),
+                      ('--min',),
+                      ('--max',),
+                      ('-e', '--exclude')],
         'change'   : [('names',),
                       ('-p', '--print'),
+                      ('-x', '--clear'),
                       ('-l', '--length'),
-                      ('-c', '--class')],
+                      ('-c', '--class'),
+                      ('--min',),
+                      ('--max',),
+                      ('-e', '--exclude')],
         'remove'   : [('names',)],
         'password' : [],
         'repl'     : [('-p', '--print'),
+                      ('-x', '--clear'),
                       ('-u', '--username'),
                       ('-l', '--length'),
-                      ('-c', '--class')],
+                      ('-c', '--class'),
+                      ('--min',),
+                      ('--max',),
+                      ('-e', '--exclude')],
+        'agent'    : [],
+        'unlock'   : [('-t', '--ttl')],
+        'lock'     : [],
+        'import'   : [('file',), ('-f', '--format'), ('-o', '--overwrite')],
+        'export'   : [('file',), ('-f', '--format'), ('-E', '--encrypt')],
+        'exec'     : [('accounts',)],
+        'shard'    : [('directory',), ('-n', '--shards')],
+        'serve'    : [('-S', '--socket')],
+        'compress' : [('method',)],
+        'convert'  : [('encoding',)],
+        'keyfile'  : [('path',), ('-D', '--delete')],
+        'token'    : [('client',), ('-r', '--revoke')],
+        'generate' : [('-n', '--count'),
+                      ('-l', '--length'),
+                      ('-c', '--class'),
+                      ('--min',),
+                      ('--max',),
+                      ('-e', '--exclude')],
+
+        'kdf-calibrate' : [('-t', '--target'), ('-a', '--algorithm')],
     }
 
     subparsers = parser.add_subparsers(title='Commands', dest='command')
@@ -152,7 +430,14 @@ def parse_args(argv=None):
             help   = helps[  name]
             subp.add_argument(*flags, help=help, **kwargs)
 
-    args = parser.parse_args(argv)
+    # Everything after "--" is the command for "exec"
+    cmd = []
+    if '--' in argv and 'exec' in argv[:argv.index('--')]:
+        idx       = argv.index('--')
+        argv, cmd = argv[:idx], argv[idx + 1:]
+
+    args     = parser.parse_args(argv)
+    args.cmd = cmd
 
     if args.command is None:
         parser.print_help()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+"""Random password generation.
+
+Passwords are generated according to a ``PasswordPolicy``, which specifies
+the allowed length(s), the character classes to draw from, the minimum
+and maximum number of characters from each class, and any characters to
+exclude. A valid password is constructed directly, rather than by
+generating random passwords until one happens to satisfy the policy:
+
+ 1. The length is chosen uniformly from the allowed range.
+ 2. The minimum number of characters is drawn from each class.
+ 3. The remaining characters are drawn from all characters of the classes
+    which have not yet reached their maximum.
+ 4. The characters are shuffled.
+
+All random numbers are derived from ``secrets.token_bytes``, which is called
+for blocks of bytes rather than once per character.
+"""
+
+
+import secrets
+
+from typing import Dict, List, Sequence, Tuple, Union
+
+from . import defaults
+
+
+DEFAULT_LENGTH = 20
+"""Default password length. """
+
+
+DEFAULT_CLASSES = ['uppercase', 'lowercase', 'numbers']
+"""Default character classes. """
+
+
+class PasswordPolicy:
+    """Constraints on generated passwords.
+
+    :arg length:   Password length - either a single length, or a
+                   ``(min, max)`` tuple.
+    :arg classes:  Names of character classes to use (see
+                   ``defaults.PASSWORD_CHARACTER_CLASSES``).
+    :arg minimums: Minimum number of characters from each class. Defaults
+                   to one for every class.
+    :arg maximums: Maximum number of characters from each class. Defaults to
+                   no maximum.
+    :arg exclude:  Characters which must not be used (e.g. ambiguous
+                   characters such as ``"l1O0"``).
+
+    Raises a ``ValueError`` if no passwords can satisfy the constraints.
+    """
+
+
+    def __init__(self,
+                 length   : Union[int, Tuple[int, int]] = None,
+                 classes  : Sequence[str]               = None,
+                 minimums : Dict[str, int]              = None,
+                 maximums : Dict[str, int]              = None,
+                 exclude  : str                         = None):
+
+        if length   is None: length   = DEFAULT_LENGTH
+        if classes  is None: classes  = DEFAULT_CLASSES
+        if minimums is None: minimums = {}
+        if maximums is None: maximums = {}
+        if exclude  is None: exclude  = ''
+        if isinstance(length, int):
+            length = (length, length)
+
+        classes  = list(dict.fromkeys(classes))
+        unknown  = [c for c in classes
+                    if c not in defaults.PASSWORD_CHARACTER_CLASSES]
+        unused   = [c for c in list(minimums) + list(maximums)
+                    if c not in classes]
+        if len(classes) == 0:
+            raise ValueError('At least one character class is required')
+        if len(unknown) > 0:
+            raise ValueError(f'Unknown character class(es): '
+                             f'{", ".join(unknown)}')
+        if len(unused) > 0:
+            raise ValueError(f'Character class(es) not selected: '
+                             f'{", ".join(unused)}')
+
+        self.minlength, self.maxlength = length
+        self.classes  = classes
+        self.charsets = {}
+        self.minimums = {}
+        self.maximums = {}
+
+        for cls in classes:
+            chars = [c for c in defaults.PASSWORD_CHARACTER_CLASSES[cls]
+                     if c not in exclude]
+            self.charsets[cls] = ''.join(chars)
+            self.minimums[cls] = minimums.get(cls, 1)
+            self.maximums[cls] = maximums.get(cls, self.maxlength)
+
+        self.__validate()
+
+        # (class, character) pairs from which
+        # passwords are filled, when no class
+        # has reached its maximum
+        self.pool = self.fill_pool({})
+
+
+    def fill_pool(self, counts : Dict[str, int]) -> List[Tuple[str, str]]:
+        """Return ``(class, character)`` pairs for all characters of those
+        classes whose count in ``counts`` is below their maximum.
+        """
+        return [(cls, ch)
+                for cls in self.classes
+                if counts.get(cls, 0) < self.maximums[cls]
+                for ch  in self.charsets[cls]]
+
+
+    def __validate(self):
+        """Raises a ``ValueError`` if the policy cannot be satisfied. """
+        if self.minlength < 1 or self.minlength > self.maxlength:
+            raise ValueError(f'Invalid length range: '
+                             f'{self.minlength}-{self.maxlength}')
+
+        for cls in self.classes:
+            if len(self.charsets[cls]) == 0 and self.maximums[cls] > 0:
+                self.maximums[cls] = 0
+            if self.minimums[cls] > self.maximums[cls]:
+                raise ValueError(f'Cannot include {self.minimums[cls]} '
+                                 f'{cls} characters (maximum: '
+                                 f'{self.maximums[cls]})')
+
+        minimum = sum(self.minimums.values())
+        maximum = sum(self.maximums.values())
+        if minimum > self.maxlength:
+            raise ValueError(f'Minimum character counts ({minimum}) exceed '
+                             f'the maximum length ({self.maxlength})')
+        if maximum < self.minlength:
+            raise ValueError(f'Maximum character counts ({maximum}) are '
+                             f'less than the minimum length '
+                             f'({self.minlength})')
+
+
+class RandomSource:
+    """Source of uniformly distributed random integers, drawn from blocks of
+    bytes returned by ``secrets.token_bytes``.
+    """
+
+
+    def __init__(self, blocksize : int = 1024):
+        self.__blocksize = blocksize
+        self.__buffer    = b''
+        self.__pos       = 0
+
+
+    def __refill(self, n : int):
+        """Make sure that at least ``n`` unused bytes are buffered. """
+        if self.__pos + n > len(self.__buffer):
+            self.__buffer = secrets.token_bytes(max(n, self.__blocksize))
+            self.__pos    = 0
+
+
+    def below(self, n : int) -> int:
+        """Return a random integer in the range ``[0, n)``. """
+        if n <= 1:
+            return 0
+        nbytes = (n.bit_length() + 7) // 8
+        span   = 256 ** nbytes
+
+        # Values above the largest multiple of n are
+        # discarded so that the result is not biased.
+        # At most half of all values are discarded.
+        limit = span - span % n
+        while True:
+            self.__refill(nbytes)
+            pos         = self.__pos
+            self.__pos += nbytes
+            if nbytes == 1:
+                value = self.__buffer[pos]
+            else:
+                value = int.from_bytes(self.__buffer[pos:pos + nbytes],
+                                       'little')
+            if value < limit:
+                return value % n
+
+
+    def shuffle(self, values : List):
+        """Shuffle ``values`` in place (Fisher-Yates). """
+        for i in range(len(values) - 1, 0, -1):
+            j                    = self.below(i + 1)
+            values[i], values[j] = values[j], values[i]
+
+
+def generate(policy : PasswordPolicy,
+             source : RandomSource = None) -> str:
+    """Generate a password which satisfies ``policy``. """
+
+    if source is None:
+        source = RandomSource()
+
+    # Only choose a length for which the
+    # class maximums can be satisfied
+    maxlength = min(policy.maxlength, sum(policy.maximums.values()))
+    length    = policy.minlength + source.below(
+        maxlength - policy.minlength + 1)
+
+    chars  = []
+    counts = {}
+    for cls in policy.classes:
+        charset     = policy.charsets[cls]
+        counts[cls] = policy.minimums[cls]
+        for _ in range(policy.minimums[cls]):
+            chars.append(charset[source.below(len(charset))])
+
+    # Fill the remainder from the classes which have
+    # not reached their maximum - the pool is only
+    # re-built when a class reaches its maximum.
+    pool = policy.pool
+    if any(counts[c] >= policy.maximums[c] for c in policy.classes):
+        pool = policy.fill_pool(counts)
+    while len(chars) < length:
+        cls, ch = pool[source.below(len(pool))]
+        chars.append(ch)
+        counts[cls] += 1
+        if counts[cls] >= policy.maximums[cls]:
+            pool = policy.fill_pool(counts)
+
+    source.shuffle(chars)
+    return ''.join(chars)
+
+
+def generate_many(policy : PasswordPolicy, count : int) -> List[str]:
+    """Generate ``count`` passwords which satisfy ``policy``, sharing one
+    ``RandomSource``.
+    """
+    source = RandomSource(blocksize=65536)
+    return [generate(policy, source) for _ in range(count)]
+
+
+def parse_counts(specs : Sequence[str]) -> Dict[str, int]:
+    """Parse a list of ``"class=count"`` strings, as passed to the
+    ``--min`` and ``--max`` options.
+    """
+    counts = {}
+    for spec in specs or []:
+        cls, sep, count = spec.partition('=')
+        if sep == '' or not count.strip().isdigit():
+            raise ValueError(f'Invalid class count (expected '
+                             f'class=count): {spec}')
+        counts[cls.strip()] = int(count)
+    return counts
@@ -0,0 +1,597 @@
+#!/usr/bin/env python
+"""A daemon which serves account credentials to local applications, so that
+they do not need to run ``deets get`` (and derive the master key) for every
+secret that they need.
+
+The vault is unlocked once, when the server is started (``deets serve``).
+The server then answers HTTP/1.1 requests with JSON responses, on a Unix
+domain socket (``$DEETSSERVE``, or ``~/.deets-serve`` by default) which is
+only accessible by the current user. It is built on ``asyncio``, so that
+many concurrent clients can be served by a single thread. Anything which
+may block (decrypting entries, and locking and reading the vault) is done
+in a separate worker thread, which is the only thread that accesses the
+vault, so that the event loop is never blocked. Connections may be kept
+alive for multiple requests. For example::
+
+    curl --unix-socket ~/.deets-serve \\
+         -H "Authorization: Bearer $TOKEN" \\
+         "http://localhost/v1/accounts/aws%20prod"
+
+The following endpoints are available:
+
+ - ``GET /v1/health``:          Returns ``{"status" : "ok"}``. No
+                                authentication is required.
+ - ``GET /v1/accounts/<names>``: Returns the ``"names"``, ``"username"``,
+                                ``"password"`` and ``"notes"`` of the
+                                account matching ``<names>`` (one or more
+                                space-separated names), as with
+                                ``deets get --json``. Returns 404 if no
+                                account matches, or 409 if more than one
+                                account matches.
+ - ``GET /v1/accounts?names=<names>``: Returns ``{"accounts" : [...]}``, the
+                                names of all accounts matching ``<names>``
+                                (or of all accounts, if ``<names>`` is
+                                omitted).
+
+Every other request must have an ``Authorization: Bearer <token>`` header,
+containing a token created for the client with ``deets token <client>``.
+Only hashes of tokens are stored, in a file alongside the vault (see
+``token_file``). Tokens may be created and revoked while the server is
+running.
+
+Responses for individual accounts are cached, keyed by the canonical (see
+``db.sanitise_key``) names in the request. The server polls the vault for
+changes made by other processes. Changes which were appended to the vault
+(see ``db.save_database``) are read and applied incrementally, and only the
+cached responses which are affected by them are discarded. Otherwise (e.g.
+if the vault has been compacted) it is re-loaded in full.
+"""
+
+
+import os.path      as op
+import urllib.parse as urlparse
+import                 os
+import                 json
+import                 socket
+import                 asyncio
+import                 hashlib
+import                 secrets
+
+from concurrent.futures import ThreadPoolExecutor
+from typing             import Dict, Tuple, List, Union, Set, Any
+
+from . import db as deetsdb
+from . import encryption
+from . import trace
+from . import ui
+
+
+DEFAULT_POLL = 1.0
+"""Default number of seconds between checks for changes to the vault. """
+
+
+MAX_HEADER_SIZE = 65536
+"""Maximum size of a request line and headers. """
+
+
+MAX_BODY_SIZE = 1024
+"""Maximum size of a request body. Bodies are not used, so requests with
+larger bodies are rejected before they are read, or authenticated.
+"""
+
+
+STATUS = {
+    200 : 'OK',
+    400 : 'Bad Request',
+    401 : 'Unauthorized',
+    404 : 'Not Found',
+    405 : 'Method Not Allowed',
+    409 : 'Conflict',
+    413 : 'Payload Too Large',
+}
+"""Reason phrases for the HTTP status codes returned by the server. """
+
+
+def socket_path() -> str:
+    """Return the path to the server socket. """
+    return os.environ.get('DEETSSERVE', op.expanduser('~/.deets-serve'))
+
+
+def token_file(vault : str) -> str:
+    """Return the path to the file which contains the hashed client tokens
+    for ``vault``.
+    """
+    return f'{op.abspath(vault).rstrip(os.sep)}.tokens'
+
+
+def hash_token(token : str) -> str:
+    """Return the hash of a client token, as stored in the token file. """
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def load_tokens(filename : str) -> Dict[str, str]:
+    """Load a token file, returning a dictionary of ``{client : hash}``
+    mappings.
+    """
+    if not op.exists(filename):
+        return {}
+    with open(filename, 'rt') as f:
+        return json.load(f)
+
+
+def save_tokens(filename : str, tokens : Dict[str, str]):
+    """Save a token file, which is only accessible by the current user. """
+    deetsdb.write_file(filename, [json.dumps(tokens, indent=4) + '\n'])
+    os.chmod(filename, 0o600)
+
+
+def add_client(vault : str, client : str) -> str:
+    """Create a new token for ``client``, replacing any existing token.
+    Returns the token - only its hash is stored.
+    """
+    filename       = token_file(vault)
+    token          = secrets.token_urlsafe(32)
+    tokens         = load_tokens(filename)
+    tokens[client] = hash_token(token)
+    save_tokens(filename, tokens)
+    return token
+
+
+def revoke_client(vault : str, client : str) -> bool:
+    """Revoke the token for ``client``. Returns ``False`` if ``client`` does
+    not have a token.
+    """
+    filename = token_file(vault)
+    tokens   = load_tokens(filename)
+    if tokens.pop(client, None) is None:
+        return False
+    save_tokens(filename, tokens)
+    return True
+
+
+class SecretServer:
+    """Serves the accounts in a ``Database``. ``handle`` is called for each
+    client connection, and ``watch`` polls the vault and token files for
+    changes. The database is only accessed by the worker thread (see
+    ``call``), and ``close`` must be called to stop it.
+    """
+
+
+    def __init__(self,
+                 db    : deetsdb.Database,
+                 vault : str,
+                 poll  : float = None):
+        if poll is None:
+            poll = DEFAULT_POLL
+
+        self.db     = db
+        self.vault  = vault
+        self.poll   = poll
+        self.cache  = {}
+        self.tokens = {}
+        self.__tokenStamp = None
+        self.__worker     = ThreadPoolExecutor(1)
+        self.load_tokens()
+
+
+    def close(self):
+        """Stop the worker thread. """
+        self.__worker.shutdown()
+
+
+    async def call(self, func, *args):
+        """Call ``func(*args)`` in the worker thread, and return its result.
+        The ``Database`` is not thread-safe, so it must only be accessed via
+        this method.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.__worker, func, *args)
+
+
+    def load_tokens(self):
+        """(Re-)load the token file if it has changed. """
+        filename = token_file(self.vault)
+        stamp    = deetsdb.file_stamp(filename)
+        if stamp == self.__tokenStamp:
+            return
+        tokens             = load_tokens(filename)
+        self.tokens        = {h : c for c, h in tokens.items()}
+        self.__tokenStamp  = stamp
+
+
+    async def handle(self,
+                     reader : asyncio.StreamReader,
+                     writer : asyncio.StreamWriter):
+        """Handle all requests from one client connection. """
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError,
+                        asyncio.LimitOverrunError,
+                        ConnectionError):
+                    break
+
+                try:
+                    method, target, version, headers = parse_request(head)
+                    length = int(headers.get('content-length', 0))
+                    if length < 0:
+                        raise ValueError(f'Invalid length: {length}')
+                except ValueError:
+                    writer.write(response(400, {'error' : 'bad request'},
+                                          False))
+                    break
+
+                # Request bodies are not used, so
+                # large ones are not even read
+                if length > MAX_BODY_SIZE:
+                    body = {'error' : 'request body too large'}
+                    writer.write(response(413, body, False))
+                    break
+                if length > 0:
+                    try:
+                        await reader.readexactly(length)
+                    except asyncio.IncompleteReadError:
+                        break
+
+                keepalive = version == 'HTTP/1.1' and \
+                            headers.get('connection', '').lower() != 'close'
+                status, body = await self.respond(method, target, headers)
+                writer.write(response(status, body, keepalive))
+                await writer.drain()
+                if not keepalive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+    async def respond(
+            self,
+            method  : str,
+            target  : str,
+            headers : Dict[str, str]
+    ) -> Tuple[int, Union[bytes, Dict]]:
+        """Generate a response to a request. Returns the status code, and
+        either a dictionary, or a JSON-encoded body. Cached responses are
+        returned immediately - anything else is generated by the worker
+        thread.
+        """
+        url = urlparse.urlsplit(target)
+
+        if method != 'GET':
+            return 405, {'error' : 'only GET requests are supported'}
+        if url.path == '/v1/health':
+            return 200, {'status' : 'ok'}
+
+        scheme, _, token = headers.get('authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or \
+           hash_token(token.strip()) not in self.tokens:
+            return 401, {'error' : 'a valid client token is required'}
+
+        if url.path == '/v1/accounts':
+            query = urlparse.parse_qs(url.query).get('names', [''])[0]
+            return await self.call(self.accounts, query.split())
+
+        prefix = '/v1/accounts/'
+        if url.path.startswith(prefix):
+            names  = urlparse.unquote(url.path[len(prefix):]).split()
+            query  = deetsdb.sanitise_key(names)
+            cached = self.cache.get(query)
+            if cached is not None:
+                return 200, cached[1]
+            return await self.call(self.account, query)
+
+        return 404, {'error' : f'unknown endpoint: {url.path}'}
+
+
+    def accounts(self, query : List[str]) -> Tuple[int, Dict]:
+        """Generate a response containing the names of all accounts which
+        match ``query``, or of all accounts.
+        """
+        if len(query) == 0: keys = self.db.keys()
+        else:               keys = self.db.lookup_keys(*query)
+        return 200, {'accounts' : [list(k) for k in sorted(keys)]}
+
+
+    def account(self, query : deetsdb.AccountKey
+                ) -> Tuple[int, Union[bytes, Dict]]:
+        """Generate a response containing the account which matches
+        ``query`` (see ``db.sanitise_key``).
+        """
+        cached = self.cache.get(query)
+        if cached is not None:
+            return 200, cached[1]
+
+        db = self.db
+        try:
+            key = db.resolve(*query)
+        except LookupError as e:
+            if len(db.lookup_keys(*query)) == 0: status = 404
+            else:                                status = 409
+            return status, {'error' : str(e)}
+
+        username, password, notes = db.state(key)
+        body = json.dumps({'names'    : list(key),
+                           'username' : username,
+                           'password' : password,
+                           'notes'    : notes}).encode()
+        self.cache[query] = (key, body)
+        return 200, body
+
+
+    def invalidate(self, accounts : Set[deetsdb.AccountKey]):
+        """Discard cached responses which may be affected by changes to
+        ``accounts`` - responses for those accounts, and for requests which
+        now match them (e.g. a request for ``aws`` which matched the
+        ``aws prod`` account is ambiguous if an ``aws dev`` account has been
+        added).
+        """
+        names = [set(a) for a in accounts]
+        for query, (key, _) in list(self.cache.items()):
+            if key in accounts or any(n.issuperset(query) for n in names):
+                self.cache.pop(query)
+
+
+    async def watch(self):
+        """Poll for changes to the vault and token files, forever. """
+        while True:
+            await asyncio.sleep(self.poll)
+            try:
+                self.load_tokens()
+                await self.reload()
+            except Exception as e:
+                ui.printmsg(f'Error reloading {self.vault}: {e}', ui.ERROR)
+
+
+    async def reload(self):
+        """Apply any changes which have been made to the vault. """
+
+        db    = self.db
+        stamp = deetsdb.file_stamp(self.vault)
+        if stamp == db.stamp or stamp is None:
+            return
+
+        stamp = await self.call(self.reload_appended)
+        if stamp is None:
+            return
+
+        # A full reload is performed in a separate
+        # thread from the worker, so that requests
+        # can be served from the old database
+        # until the new one has been loaded.
+        #
+        # The data key is re-used, so changes to the
+        # key slots (e.g. the master password) do not
+        # matter. If the vault has been re-encrypted
+        # with a key derived from a different password
+        # (or a version 2 vault's password has been
+        # changed), the new entries cannot be decrypted.
+        def load():
+            new = deetsdb.load_database(self.vault, db.password, db.key)
+            if new.key is not db.key:
+                for index, token in new.sealed():
+                    deetsdb.unseal_entry(new.key, token)
+                    break
+            return new
+
+        loop = asyncio.get_running_loop()
+        try:
+            with trace.span('server.reload'):
+                new = await loop.run_in_executor(None, load)
+        except encryption.AuthenticationError:
+            ui.printmsg(f'The master password of {self.vault} has been '
+                        'changed - restart the server to load it',
+                        ui.ERROR)
+            await self.call(setattr, db, 'stamp', stamp)
+            return
+
+        await self.call(self.replace, new)
+
+
+    def reload_appended(self) -> Union[Tuple, None]:
+        """Called in the worker thread by ``reload``. Applies changes which
+        have been appended to the vault. Returns ``None`` if this was
+        successful, or the vault's ``db.file_stamp`` if it needs to be
+        re-loaded in full.
+        """
+        db = self.db
+        with trace.span('server.reload'), \
+             deetsdb.lock_database(self.vault):
+            stamp    = deetsdb.file_stamp(self.vault)
+            appended = appended_files(self.vault, db.stamp, stamp)
+            if appended is not None:
+                try:
+                    changed = read_appended(db, appended)
+                    db.stamp = stamp
+                    self.invalidate(changed)
+                    return None
+
+                # e.g. an interrupted append -
+                # fall back to a full reload
+                except Exception:
+                    pass
+        return stamp
+
+
+    def replace(self, db : deetsdb.Database):
+        """Called in the worker thread by ``reload``. Replaces the database
+        after it has been re-loaded in full.
+        """
+        self.db    = db
+        self.cache = {}
+
+
+def appended_files(
+        vault    : str,
+        oldstamp : Union[Tuple, None],
+        newstamp : Union[Tuple, None]
+) -> Union[List[Tuple[str, int]], None]:
+    """Compares two ``db.file_stamp`` values for ``vault``. If the only
+    changes between them are that data has been appended to the vault file
+    (or to any of the shard files of a sharded vault), returns a list of
+    ``(filename, offset)`` tuples, containing the offset of the appended
+    data in each file. Otherwise returns ``None``.
+    """
+    if oldstamp is None or newstamp is None:
+        return None
+
+    if not op.isdir(vault):
+        oldstamp = [(op.basename(vault), *oldstamp)]
+        newstamp = [(op.basename(vault), *newstamp)]
+        vault    = op.dirname(vault)
+
+    if [s[:2] for s in oldstamp] != [s[:2] for s in newstamp]:
+        return None
+
+    appended = []
+    for (name, _, oldsize, _), (_, _, newsize, _) in zip(oldstamp, newstamp):
+        if newsize < oldsize:
+            return None
+        if newsize > oldsize:
+            appended.append((op.join(vault, name), oldsize))
+    return appended
+
+
+def read_appended(db       : deetsdb.Database,
+                  appended : List[Tuple[str, int]]) -> Set[deetsdb.AccountKey]:
+    """Read changes which have been appended to the vault files (as
+    returned by ``appended_files``) into ``db``. Returns the accounts which
+    have been changed.
+    """
+    for filename, offset in appended:
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            deetsdb.read_records(db, f)
+    changed    = {change['names'] for change in db.journal}
+    db.changed = False
+    return changed
+
+
+def parse_request(head : bytes) -> Tuple[str, str, str, Dict[str, str]]:
+    """Parse a HTTP request line and headers. Returns the method, target,
+    HTTP version, and headers (with lower-case names). Raises a
+    ``ValueError`` if the request is malformed.
+    """
+    lines = head.decode('latin-1').split('\r\n')
+    method, target, version = lines[0].split(' ')
+    headers = {}
+    for line in lines[1:]:
+        if line == '':
+            continue
+        name, sep, value = line.partition(':')
+        if sep == '':
+            raise ValueError(f'Invalid header: {line}')
+        headers[name.strip().lower()] = value.strip()
+    return method, target, version, headers
+
+
+def response(status    : int,
+             body      : Union[bytes, Dict[str, Any]],
+             keepalive : bool) -> bytes:
+    """Generate a HTTP response. """
+    if not isinstance(body, bytes):
+        body = json.dumps(body).encode()
+    if keepalive: connection = 'keep-alive'
+    else:         connection = 'close'
+    head = (f'HTTP/1.1 {status} {STATUS[status]}\r\n'
+            'Content-Type: application/json\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            f'Connection: {connection}\r\n'
+            '\r\n')
+    return head.encode() + body
+
+
+def raise_file_limit():
+    """Raise the limit on the number of open files to its maximum, so that
+    many clients can be connected at once.
+    """
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def remove_stale_socket(path : str):
+    """Remove a socket file left behind by a server which is no longer
+    running. Raises a ``RuntimeError`` if a server is running.
+    """
+    if not op.exists(path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            os.remove(path)
+            return
+    raise RuntimeError(f'A server is already running at {path}')
+
+
+async def start(server : SecretServer, path : str) -> asyncio.AbstractServer:
+    """Start listening for connections on ``path``. """
+    remove_stale_socket(path)
+    umask = os.umask(0o177)
+    try:
+        return await asyncio.start_unix_server(
+            server.handle, path, limit=MAX_HEADER_SIZE, backlog=4096)
+    finally:
+        os.umask(umask)
+
+
+def serve(db    : deetsdb.Database,
+          vault : str,
+          path  : str   = None,
+          poll  : float = None):
+    """Serve the accounts in ``db``, which was loaded from ``vault``, on the
+    socket ``path``, until interrupted.
+    """
+    if path is None:
+        path = socket_path()
+
+    async def run():
+        server   = SecretServer(db, vault, poll)
+        listener = await start(server, path)
+        watcher  = asyncio.create_task(server.watch())
+        try:
+            async with listener:
+                await listener.serve_forever()
+        finally:
+            watcher.cancel()
+            server.close()
+            if op.exists(path):
+                os.remove(path)
+
+    raise_file_limit()
+    asyncio.run(run())
+
+
+def fetch(names : str,
+          token : str,
+          path  : str = None) -> Dict[str, Any]:
+    """Client for ``deets serve`` - retrieve the account matching ``names``
+    (a string containing one or more space-separated names). Raises a
+    ``LookupError`` if the request fails.
+    """
+    if path is None:
+        path = socket_path()
+    target  = '/v1/accounts/' + urlparse.quote(names)
+    request = (f'GET {target} HTTP/1.1\r\n'
+               'Host: localhost\r\n'
+               f'Authorization: Bearer {token}\r\n'
+               'Connection: close\r\n'
+               '\r\n')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(request.encode())
+        with sock.makefile('rb') as f:
+            data = f.read()
+    head, _, body = data.partition(b'\r\n\r\n')
+    status        = int(head.split(b' ', 2)[1])
+    body          = json.loads(body)
+    if status != 200:
+        raise LookupError(body.get('error', f'HTTP status {status}'))
+    return body
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+"""Sharded vaults.
+
+A sharded vault is a directory containing a plain-text ``manifest`` file,
+and a number of shard files. Each account is stored in exactly one shard,
+chosen by the keyed hash of the first of its (sorted) names (see
+``encryption.MasterKey.blind``), so that shards can be rewritten
+independently of one another, and the assignment of accounts to shards does
+not reveal anything about their names.
+
+The manifest has the following structure::
+
+    {
+        "version" : 3,
+        "check"   : "<check>",
+        "keys"    : [<keyslot>, ...],
+        "shards"  : [{"file" : "<file>", "start" : <start>}, ...]
+    }
+
+where the ``"check"`` and ``"keys"`` are the check value and key slots of
+the data key, as in the header of a database file (see
+``db.load_database``). Version 2 manifests contain the ``"kdf"`` and
+``"salt"`` of a key derived directly from the master password instead. The
+manifest also contains ``"compression" : "<method>"`` if entries are
+compressed before they are encrypted (see the ``compression`` module), and
+``"encoding" : "binary"`` if the shard files are binary-encoded.
+
+The first 32 bits of the keyed hash of an account's first name (as an
+unsigned big-endian integer) determine its shard - each shard holds the
+accounts whose hashes lie between its ``"start"`` and that of the next
+shard. Each shard file has the same format as the body (everything after the
+header) of a database file - see ``db.load_database``.
+
+Entries are only decrypted when they are accessed, as with a single-file
+database. When a sharded vault is saved, the changes in the
+``Database.journal`` are appended to the logs of the shards containing the
+accounts that were changed; shards whose logs grow beyond
+``db.LOG_COMPACT_THRESHOLD`` are compacted. Shards which have not changed
+are not written to. Only the manifest is rewritten when the key slots are
+changed (e.g. when the master password is changed). All shards, and the
+manifest, are rewritten when the compression method or encoding is changed.
+"""
+
+
+import os.path as op
+import base64  as b64
+import bisect
+import json
+import os
+import secrets
+
+from typing import Dict, Any, List, Sequence
+
+from . import db as deetsdb
+from . import encryption
+from . import trace
+
+
+MANIFEST = 'manifest'
+"""Name of the manifest file within a vault directory. """
+
+
+DEFAULT_SHARDS = 16
+"""Default number of shards in a new vault. """
+
+
+class Manifest:
+    """Layout of a sharded vault. A ``Manifest`` is shared between a
+    ``Database`` and its snapshots, and is updated in place when the vault is
+    saved.
+    """
+
+
+    def __init__(self,
+                 keyslots    : List[Dict[str, Any]],
+                 check       : str,
+                 starts      : Sequence[int],
+                 files       : Sequence[str],
+                 compression : str = None,
+                 encoding    : str = 'json'):
+        self.keyslots    = list(keyslots)
+        self.check       = check
+        self.starts      = list(starts)
+        self.files       = list(files)
+        self.compression = compression
+        self.encoding    = encoding
+        self.log_sizes   = [0] * len(files)
+        """Number of changes appended to the log of each shard since it was
+        last compacted.
+        """
+
+
+    def replace(self, manifest : 'Manifest'):
+        """Replace the contents of this manifest with those of another. """
+        self.keyslots    = list(manifest.keyslots)
+        self.check       = manifest.check
+        self.starts      = list(manifest.starts)
+        self.files       = list(manifest.files)
+        self.compression = manifest.compression
+        self.encoding    = manifest.encoding
+        self.log_sizes   = list(manifest.log_sizes)
+
+
+    @property
+    def nshards(self) -> int:
+        return len(self.files)
+
+
+    def route(self, blind : str) -> int:
+        """Return the index of the shard for an account, given the keyed
+        hash of its first name.
+        """
+        value = int.from_bytes(b64.b64decode(blind)[:4], 'big')
+        return bisect.bisect_right(self.starts, value) - 1
+
+
+    def shard(self, key : encryption.MasterKey, names : Sequence[str]) -> int:
+        """Return the index of the shard for the account ``names``. """
+        return self.route(key.blind(deetsdb.sanitise_key(names)[0]))
+
+
+    def dump(self) -> Dict[str, Any]:
+        """Return the manifest as a dictionary to be saved. """
+        manifest = {'version' : deetsdb.VERSION,
+                    'check'   : self.check,
+                    'keys'    : self.keyslots,
+                    'shards'  : [{'file' : f, 'start' : s}
+                                 for f, s in zip(self.files, self.starts)]}
+        if self.compression is not None:
+            manifest['compression'] = self.compression
+        if self.encoding != 'json':
+            manifest['encoding'] = self.encoding
+        return manifest
+
+
+    @classmethod
+    def parse(cls,
+              manifest : Dict[str, Any],
+              key      : encryption.MasterKey) -> 'Manifest':
+        """Create a ``Manifest`` from a dictionary created by ``dump``.
+        ``key`` is the data key, which is used to generate a check value
+        for version 2 manifests.
+        """
+        shards = manifest['shards']
+        return cls(manifest.get('keys', []),
+                   manifest.get('check', key.check),
+                   [s['start'] for s in shards],
+                   [s['file']  for s in shards],
+                   manifest.get('compression'),
+                   manifest.get('encoding', 'json'))
+
+
+def boundaries(nshards : int) -> List[int]:
+    """Return the start of each of ``nshards`` equally sized shards. """
+    return [(i << 32) // nshards for i in range(nshards)]
+
+
+def load_database(dirname  : deetsdb.pathtype,
+                  password : str,
+                  key      : encryption.MasterKey = None,
+                  keyfile  : str                  = None) -> deetsdb.Database:
+    """Load a sharded vault from ``dirname``. See ``db.load_database``. """
+
+    with trace.span('shards.load'):
+        with open(op.join(dirname, MANIFEST), 'rt') as f:
+            manifest = json.load(f)
+
+        if manifest['version'] not in (2, deetsdb.VERSION):
+            raise ValueError(f'{dirname}: unsupported database '
+                             f'version: {manifest["version"]}')
+
+        key      = deetsdb.unlock_key(manifest, password, keyfile, key)
+        manifest = Manifest.parse(manifest, key)
+
+        db             = deetsdb.Database(password)
+        db.key         = key
+        db.keyslots    = manifest.keyslots
+        db.encoding    = manifest.encoding
+        db.compression = manifest.compression
+
+        with trace.span('db.read', shards=manifest.nshards):
+            for i, filename in enumerate(manifest.files):
+                with open(op.join(dirname, filename), 'rb') as f:
+                    manifest.log_sizes[i] = deetsdb.read_records(db, f)
+
+    db.manifest     = manifest
+    db.changed      = False
+    db.keys_changed = False
+    return db
+
+
+def save_database(db      : deetsdb.Database,
+                  dirname : deetsdb.pathtype,
+                  nshards : int = None):
+    """Save ``db`` as a sharded vault in ``dirname``.
+
+    If ``db`` was loaded from (or last saved to) ``dirname``, only the
+    shards which contain changed accounts are written to, and the manifest
+    is only written if the key slots have changed. Otherwise all shards are
+    written - ``nshards`` may be used to specify the number of shards for a
+    new vault (default: ``DEFAULT_SHARDS``).
+    """
+
+    manifest = db.manifest
+    if db.key is None                         or \
+       manifest is None                       or \
+       manifest.check       != db.key.check   or \
+       manifest.compression != db.compression or \
+       manifest.encoding    != db.encoding:
+        with trace.span('shards.snapshot'):
+            _write_vault(db, dirname, nshards)
+        db.changed      = False
+        db.keys_changed = False
+        return
+
+    if db.keys_changed:
+        with trace.span('shards.manifest'):
+            manifest.keyslots = deetsdb.complete_keyslots(db)
+            deetsdb.write_file(op.join(dirname, MANIFEST),
+                               [json.dumps(manifest.dump(), indent=4) + '\n'])
+
+    journals = {}
+    for change in db.journal:
+        shard = manifest.shard(db.key, change['names'])
+        journals.setdefault(shard, []).append(change)
+
+    for shard, journal in journals.items():
+        filename = op.join(dirname, manifest.files[shard])
+        logsize  = manifest.log_sizes[shard] + len(journal)
+        if logsize <= deetsdb.LOG_COMPACT_THRESHOLD:
+            with trace.span('db.append', shard=shard, changes=len(journal)):
+                deetsdb.append_changes(db, filename, journal)
+            manifest.log_sizes[shard] = logsize
+        else:
+            with trace.span('shards.compact', shard=shard):
+                _write_shard(db, filename, manifest, shard)
+            manifest.log_sizes[shard] = 0
+
+    db.changed      = False
+    db.keys_changed = False
+
+
+def _shard_lines(db       : deetsdb.Database,
+                 manifest : Manifest) -> List[List[str]]:
+    """Encrypt all entries in ``db``, returning the lines for each shard. """
+    key      = db.key
+    unsealed = [[] for _ in range(manifest.nshards)]
+    sealed   = [[] for _ in range(manifest.nshards)]
+
+    # The index of a sealed entry contains the
+    # keyed hashes of its names, in order
+    for entry in db.unsealed():
+        unsealed[manifest.route(key.blind(entry[0][0]))].append(entry)
+    for entry in db.sealed():
+        sealed[manifest.route(entry[0][0])].append(entry)
+
+    return [list(deetsdb.entry_lines(key, u, s, db.compression, db.encoding))
+            for u, s in zip(unsealed, sealed)]
+
+
+def _write_shard(db       : deetsdb.Database,
+                 filename : deetsdb.pathtype,
+                 manifest : Manifest,
+                 shard    : int):
+    """Compact one shard, re-writing all of the entries in it. """
+    key      = db.key
+    unsealed = (e for e in db.unsealed()
+                if manifest.route(key.blind(e[0][0])) == shard)
+    sealed   = (e for e in db.sealed()
+                if manifest.route(e[0][0]) == shard)
+    deetsdb.write_file(filename, deetsdb.entry_lines(key, unsealed, sealed,
+                                                     db.compression,
+                                                     db.encoding))
+
+
+def _write_vault(db      : deetsdb.Database,
+                 dirname : deetsdb.pathtype,
+                 nshards : int = None):
+    """Write all shards and the manifest. The shards are written to new
+    files, which are only referred to once the new manifest has been
+    written, so the vault is never left in an inconsistent state. The
+    previous shard files are then deleted.
+    """
+
+    if db.key is None:
+        db.key = encryption.MasterKey.generate()
+
+    key      = db.key
+    manifest = db.manifest
+
+    if   nshards  is not None: starts = boundaries(nshards)
+    elif manifest is not None: starts = manifest.starts
+    else:                      starts = boundaries(DEFAULT_SHARDS)
+
+    suffix = secrets.token_hex(4)
+    files  = [f'shard-{i:03d}-{suffix}' for i in range(len(starts))]
+    layout = Manifest(deetsdb.complete_keyslots(db), key.check, starts, files,
+                      db.compression, db.encoding)
+
+    os.makedirs(dirname, exist_ok=True)
+
+    with trace.span('db.encrypt'):
+        lines = _shard_lines(db, layout)
+    with trace.span('db.write', shards=layout.nshards):
+        for filename, shardlines in zip(files, lines):
+            deetsdb.write_file(op.join(dirname, filename), shardlines)
+        deetsdb.write_file(op.join(dirname, MANIFEST),
+                           [json.dumps(layout.dump(), indent=4) + '\n'])
+
+    for filename in os.listdir(dirname):
+        if filename.startswith('shard-') and filename not in files:
+            os.remove(op.join(dirname, filename))
+
+    # Update the manifest in place, as
+    # it may be shared with snapshots
+    if manifest is None: db.manifest = layout
+    else:                manifest.replace(layout)
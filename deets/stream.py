@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+"""Chunked authenticated encryption of streams of data, used for encrypted
+exports (see the ``import`` and ``export`` commands).
+
+Data is encrypted in fixed-size segments, each with its own AES-256-GCM tag,
+using the STREAM construction (Hoang, Reyhanitabar, Rogaway and Vizár,
+2015), so that it can be encrypted and decrypted incrementally, and memory
+usage is bounded by the segment size rather than by the size of the data.
+The nonce of each segment is made up of a random 7 byte prefix (one per
+stream), a 4 byte big-endian segment counter, and a 1 byte flag which is
+set only for the final segment::
+
+    | prefix (7) | counter (4) | final (1) |
+
+so segments cannot be re-ordered or dropped, and a stream which has been
+truncated (at a segment boundary or otherwise) is detected, as it does not
+end with a final segment. The final segment contains fewer than
+``chunk_size`` bytes (possibly none).
+
+An encrypted stream has the following structure::
+
+    | MAGIC | header length (4) | header | prefix (7) | segments ... |
+
+where the header is a JSON object containing the ``"kdf"`` and ``"salt"``
+used to derive the key from a password (see ``encryption.MasterKey``), the
+``"chunk_size"``, and a ``"check"`` value derived from the key, so that an
+incorrect password can be distinguished from a corrupt stream. The header
+is authenticated along with every segment.
+"""
+
+
+import base64 as b64
+import            hmac
+import            io
+import            json
+import            os
+import            struct
+
+from typing import Dict, Any, BinaryIO, Iterator
+
+from . import encryption
+
+
+MAGIC = b'\x89DEETSS\n'
+"""Start of an encrypted stream. """
+
+
+CHUNK_SIZE = 65536
+"""Default number of plaintext bytes in each segment. """
+
+
+TAG_SIZE = 16
+"""Size of the authentication tag appended to each segment. """
+
+
+PREFIX_SIZE = 7
+"""Size of the random nonce prefix of a stream. """
+
+
+MAX_SEGMENTS = 2 ** 32
+"""Maximum number of segments in a stream (limited by the counter). """
+
+
+HEADER_SIZE = struct.Struct('<I')
+"""Length of the header of an encrypted stream. """
+
+
+def nonce(prefix : bytes, counter : int, final : bool) -> bytes:
+    """Return the nonce for one segment of a stream. """
+    if counter >= MAX_SEGMENTS:
+        raise ValueError('Stream is too long')
+    return prefix + counter.to_bytes(4, 'big') + (b'\x01' if final
+                                                  else b'\x00')
+
+
+def key_check(key : encryption.MasterKey) -> str:
+    """Return the key check value stored in the header of a stream. """
+    return b64.b64encode(key.subkey('stream:check')[:16]).decode()
+
+
+def is_encrypted(filename : str) -> bool:
+    """Return ``True`` if ``filename`` contains an encrypted stream. """
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class EncryptingWriter(io.RawIOBase):
+    """File-like object which encrypts everything written to it, and writes
+    the encrypted stream to another file. ``close`` must be called to write
+    the final segment - until then, the stream will not be readable.
+    """
+
+
+    def __init__(self,
+                 f          : BinaryIO,
+                 password   : str,
+                 kdf        : Dict[str, Any] = None,
+                 chunk_size : int            = None):
+        """Create an ``EncryptingWriter``.
+
+        :arg f:          File to write the encrypted stream to. It is not
+                         closed by ``close``.
+        :arg password:   Password to derive the key from, with a new random
+                         salt.
+        :arg kdf:        Key derivation function parameters (see
+                         ``encryption.MasterKey``).
+        :arg chunk_size: Segment size - defaults to ``CHUNK_SIZE``.
+        """
+        super().__init__()
+        if chunk_size is None:
+            chunk_size = CHUNK_SIZE
+
+        key    = encryption.MasterKey(password, kdf=kdf)
+        header = json.dumps({'kdf'        : key.kdf,
+                             'salt'       : b64.b64encode(key.salt).decode(),
+                             'chunk_size' : chunk_size,
+                             'check'      : key_check(key)}).encode()
+
+        self.__f         = f
+        self.__aead      = key.aead('stream')
+        self.__header    = header
+        self.__prefix    = os.urandom(PREFIX_SIZE)
+        self.__chunkSize = chunk_size
+        self.__buffer    = bytearray()
+        self.__counter   = 0
+
+        f.write(MAGIC + HEADER_SIZE.pack(len(header)) + header + self.__prefix)
+
+
+    def writable(self) -> bool:
+        return True
+
+
+    def write(self, data : bytes) -> int:
+        """Buffer ``data``, and encrypt and write all complete segments. """
+        self.__buffer += data
+        size = self.__chunkSize
+        pos  = 0
+
+        # The buffer is only ever encrypted when it
+        # contains *more* than one segment, as the
+        # final segment must be smaller than a full
+        # segment, and be encrypted by close
+        while len(self.__buffer) - pos > size:
+            self.__segment(memoryview(self.__buffer)[pos:pos + size], False)
+            pos += size
+        del self.__buffer[:pos]
+        return len(data)
+
+
+    def close(self):
+        """Encrypt and write the final segment. """
+        if self.closed:
+            return
+        # A full buffer is written as one full segment,
+        # followed by an empty final segment
+        if len(self.__buffer) == self.__chunkSize:
+            self.__segment(memoryview(self.__buffer), False)
+            self.__buffer = bytearray()
+        self.__segment(self.__buffer, True)
+        self.__f.flush()
+        super().close()
+
+
+    def __segment(self, data : bytes, final : bool):
+        """Encrypt and write one segment. """
+        n = nonce(self.__prefix, self.__counter, final)
+        self.__f.write(self.__aead.encrypt(n, bytes(data), self.__header))
+        self.__counter += 1
+
+
+def decrypt_segments(f : BinaryIO, password : str) -> Iterator[bytes]:
+    """Decrypt an encrypted stream, read from ``f``, returning an iterator
+    which yields the plaintext of each segment as it is decrypted. Raises
+    an ``encryption.AuthenticationError`` if ``password`` is incorrect (this
+    is checked immediately), and a ``ValueError`` if ``f`` is not an
+    encrypted stream, or (while iterating) if it has been modified or
+    truncated.
+    """
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not an encrypted stream')
+
+    try:
+        size,  = HEADER_SIZE.unpack(f.read(HEADER_SIZE.size))
+        header = f.read(size)
+        params = json.loads(header)
+        prefix = f.read(PREFIX_SIZE)
+        salt   = b64.b64decode(params['salt'])
+        kdf    = params['kdf']
+        check  = params['check']
+        full   = int(params['chunk_size']) + TAG_SIZE
+    except (struct.error, ValueError, KeyError, TypeError):
+        raise ValueError('Invalid encrypted stream header')
+    if len(prefix) != PREFIX_SIZE:
+        raise ValueError('Invalid encrypted stream header')
+
+    key = encryption.MasterKey(password, salt, kdf)
+    if not hmac.compare_digest(key_check(key), check):
+        raise encryption.AuthenticationError()
+    aead = key.aead('stream')
+
+    # A segment shorter than a full segment is the
+    # final one. A stream which ends after a full
+    # segment has been truncated, and the empty
+    # read will fail to authenticate as the final
+    # segment.
+    def segments():
+        counter = 0
+        while True:
+            segment = f.read(full)
+            final   = len(segment) < full
+            try:
+                yield aead.decrypt(nonce(prefix, counter, final),
+                                   segment, header)
+            except encryption.InvalidTag:
+                raise ValueError('Encrypted stream is corrupt or truncated')
+            if final:
+                return
+            counter += 1
+
+    return segments()
+
+
+class DecryptingReader(io.RawIOBase):
+    """Read-only file-like object which decrypts an encrypted stream,
+    holding at most one segment in memory. Can be wrapped in a
+    ``io.TextIOWrapper`` to parse the plaintext as it is decrypted.
+    """
+
+
+    def __init__(self, f : BinaryIO, password : str):
+        super().__init__()
+        self.__segments = decrypt_segments(f, password)
+        self.__buffer   = b''
+        self.__pos      = 0
+
+
+    def readable(self) -> bool:
+        return True
+
+
+    def readinto(self, b) -> int:
+        while self.__pos >= len(self.__buffer):
+            segment = next(self.__segments, None)
+            if segment is None:
+                return 0
+            self.__buffer = segment
+            self.__pos    = 0
+        n        = min(len(b), len(self.__buffer) - self.__pos)
+        b[:n]    = self.__buffer[self.__pos:self.__pos + n]
+        self.__pos += n
+        return n
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""Lightweight tracing of how long each phase of a ``deets`` invocation
+takes, enabled with the ``--timings`` option. Code is instrumented with
+``span``::
+
+    with trace.span('db.load', entries=n):
+        ...
+
+Spans may be nested. When tracing is disabled (the default), ``span``
+returns a shared no-op context manager, so instrumentation costs next to
+nothing - spans should still only be placed around whole phases, not
+inside per-entry loops.
+
+Recorded spans can be printed as an indented tree (``report``), or saved as
+a Chrome trace JSON file (``write_chrome_trace``), which can be opened in
+``chrome://tracing`` or https://ui.perfetto.dev. ``profile`` and
+``write_profile`` provide an opt-in ``cProfile`` hook.
+"""
+
+
+import contextlib
+import threading
+import time
+import sys
+import os
+
+from typing import Dict, Any, List, TextIO
+
+
+ENABLED = False
+"""Whether spans are being recorded. Use ``enable`` to change. """
+
+
+class Span:
+    """A completed span. Times are in seconds, relative to when tracing was
+    enabled.
+    """
+
+    __slots__ = ('name', 'start', 'duration', 'depth', 'thread', 'args')
+
+
+    def __init__(self, name, start, duration, depth, thread, args):
+        self.name     = name
+        self.start    = start
+        self.duration = duration
+        self.depth    = depth
+        self.thread   = thread
+        self.args     = args
+
+
+_spans  = []
+_origin = 0
+_local  = threading.local()
+_null   = contextlib.nullcontext()
+
+
+def enable(enabled : bool = True):
+    """Start (or stop) recording spans. Starting discards any previously
+    recorded spans.
+    """
+    global ENABLED, _origin, _spans
+    if enabled and not ENABLED:
+        _spans  = []
+        _origin = time.perf_counter()
+    ENABLED = enabled
+
+
+def spans() -> List[Span]:
+    """Return all recorded spans, in order of their start time. """
+    return sorted(_spans, key=lambda s: (s.start, s.depth))
+
+
+def span(name : str, **args):
+    """Return a context manager which records the time taken by the code
+    that it encloses. Any keyword arguments are saved with the span.
+    """
+    if not ENABLED:
+        return _null
+    return _record(name, args)
+
+
+@contextlib.contextmanager
+def _record(name : str, args : Dict[str, Any]):
+    depth        = getattr(_local, 'depth', 0)
+    _local.depth = depth + 1
+    start        = time.perf_counter()
+    try:
+        yield
+    finally:
+        end          = time.perf_counter()
+        _local.depth = depth
+        _spans.append(Span(name, start - _origin, end - start, depth,
+                           threading.get_ident(), args))
+
+
+def report(stream : TextIO = None):
+    """Print all recorded spans as an indented tree (to standard error by
+    default).
+    """
+    if stream is None:
+        stream = sys.stderr
+
+    recorded = spans()
+    if len(recorded) == 0:
+        return
+
+    main   = threading.main_thread().ident
+    labels = []
+    for s in recorded:
+        label = '  ' * s.depth + s.name
+        if s.thread != main:
+            label += f' [thread {s.thread}]'
+        if s.args:
+            label += ' (' + ', '.join(f'{k}={v}'
+                                      for k, v in s.args.items()) + ')'
+        labels.append(label)
+
+    width = max(len(l) for l in labels)
+    print('\nTimings:', file=stream)
+    for label, s in zip(labels, recorded):
+        print(f'{label:<{width}}  {s.duration * 1000:10.2f} ms', file=stream)
+    stream.flush()
+
+
+def write_chrome_trace(filename : str):
+    """Save all recorded spans to ``filename`` in Chrome trace event format.
+    """
+    import json
+    pid    = os.getpid()
+    events = []
+    for s in spans():
+        events.append({'name' : s.name,
+                       'cat'  : s.name.split('.')[0],
+                       'ph'   : 'X',
+                       'ts'   : s.start    * 1e6,
+                       'dur'  : s.duration * 1e6,
+                       'pid'  : pid,
+                       'tid'  : s.thread,
+                       'args' : {k : str(v) for k, v in s.args.items()}})
+    with open(filename, 'wt') as f:
+        json.dump({'traceEvents' : events, 'displayTimeUnit' : 'ms'}, f)
+
+
+def profile():
+    """Create and start a ``cProfile.Profile``. Pass it to
+    ``write_profile`` when done.
+    """
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def write_profile(profiler, filename : str = None, limit : int = 30):
+    """Stop ``profiler``. Its statistics are saved to ``filename``
+    (for use with ``pstats`` or e.g. ``snakeviz``), or, if ``filename`` is
+    ``None`` or ``'-'``, the ``limit`` most expensive functions are printed
+    to standard error.
+    """
+    import pstats
+    profiler.disable()
+    if filename in (None, '-'):
+        stats = pstats.Stats(profiler, stream=sys.stderr)
+        stats.sort_stats('cumulative').print_stats(limit)
+    else:
+        profiler.dump_stats(filename)
@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 
+import os
 import sys
-import readline
 import getpass
 
+from . import trace
+
 
 # List of modifiers which can be used to change how
 # a message is printed by the printmsg function.
@@ -29,50 +31,102 @@ ANSICODES = {
 }
 
 
-def printmsg(*args, **kwargs):
+# Stream that messages and prompts are printed
+# to - standard output if None. See set_stream.
+STREAM = None
+
+
+def set_stream(stream):
+    """Print all subsequent messages and prompts to ``stream`` (e.g.
+    ``sys.stderr``, so that they do not get mixed up with machine-readable
+    output). Pass ``None`` to print to standard output.
+    """
+    global STREAM
+    STREAM = stream
+
+
+def get_stream():
+    """Return the stream that messages and prompts are printed to. """
+    if STREAM is None: return sys.stdout
+    else:              return STREAM
+
+
+def use_colour(stream) -> bool:
+    """Return ``True`` if ANSI codes should be used when printing to
+    ``stream``, i.e. if it is a terminal, and ``$NO_COLOR`` is not set.
+    """
+    if 'NO_COLOR' in os.environ:
+        return False
+    return isatty(stream)
+
+
+def isatty(stream) -> bool:
+    """Return ``True`` if ``stream`` is a terminal. """
+    try:
+        return stream.isatty()
+    except (AttributeError, ValueError):
+        return False
+
+
+def printmsg(*args, end='\n'):
     """Prints a sequence of strings according to the ANSI codes provided in
     msgtypes. Expects positional arguments to be of the form::
 
         printable, ANSICODE, printable, ANSICODE, ...
 
-    :arg msgtypes: Message types to control formatting
+    The message is written to the stream in a single call. ANSI codes are
+    omitted if the stream is not a terminal (see ``use_colour``).
+
+    :arg end: String to print after the message (default: newline)
     """
 
-    args     = list(args)
-    blockids = [i for i in range(len(args)) if (args[i] not in ANSICODES)]
+    stream = get_stream()
+    colour = use_colour(stream)
+    parts  = []
 
-    for i, idx in enumerate(blockids):
-        if i == len(blockids) - 1:
-            slc = slice(idx + 1, None)
+    # ANSI codes for a printable follow it
+    for arg in args:
+        if arg in ANSICODES:
+            if colour:
+                parts.insert(-1, ANSICODES[arg])
         else:
-            slc = slice(idx + 1, blockids[i + 1])
+            if colour and len(parts) > 0:
+                parts.append(ANSICODES[RESET])
+            parts.append(str(arg))
 
-        msg      = args[idx]
-        msgcodes = args[slc]
-        msgcodes = [ANSICODES[c] for c in msgcodes]
-        msgcodes = ''.join(msgcodes)
+    if colour and len(parts) > 0:
+        parts.append(ANSICODES[RESET])
+    if end is None:
+        end = '\n'
 
-        print(f'{msgcodes}{msg}{ANSICODES[RESET]}', end='')
+    stream.write(''.join(parts) + end)
+    stream.flush()
 
-    print(**kwargs)
-    sys.stdout.flush()
+
+def _enable_line_editing():
+    """Imports ``readline``, which enables line editing in ``input``. It is
+    only imported when needed, as it is relatively slow to import.
+    """
+    import readline
 
 
 def prompt_password(prompt='', *msgtypes, show=False):
+    _enable_line_editing()
     printmsg(prompt, *msgtypes, end='')
     if show: response = input().strip()
     else:    response = getpass.getpass(prompt='').strip()
     if response == '':
-        print()
+        print(file=get_stream())
     return response
 
 
 def prompt_input(prompt='', *msgtypes, default=None):
+    _enable_line_editing()
     printmsg(prompt, *msgtypes, end='')
     response = input('').strip()
 
     if response == '':
-        print()
+        print(file=get_stream())
 
     if (default is not None) and (response == ''): return default
     else:                                          return response
@@ -93,43 +147,146 @@ def prompt_select(prompt, choices, labels=None):
     return choices[select]
 
 
-def print_columns(titles, columns):
+def print_columns(titles, columns, pager=True):
     """Convenience function which pretty-prints a collection of columns in a
     tabular format.
 
+    If the output stream is a terminal, rows are truncated to the terminal
+    width, and if there are more rows than fit in the terminal, the table is
+    displayed via ``$PAGER`` (``less`` by default). Otherwise, the table is
+    printed without any ANSI codes.
+
     :arg titles:  A list of titles, one for each column.
 
     :arg columns: A list of columns, where each column is a list of strings.
+
+    :arg pager:   Set to ``False`` to never use a pager.
     """
+    with trace.span('ui.render', rows=len(columns[0])):
+
+        stream = get_stream()
+        width  = None
+        height = None
+
+        if isatty(stream):
+            try:
+                width, height = os.get_terminal_size(stream.fileno())
+            except (OSError, ValueError):
+                pass
+
+        lines = format_columns(titles, columns, use_colour(stream), width)
+
+        if pager and height is not None and len(lines) >= height:
+            if page(lines):
+                return
 
-    cols  = []
+        # Write in large chunks, rather than
+        # making one write call per row
+        for i in range(0, len(lines), WRITE_CHUNK):
+            stream.write(''.join(lines[i:i + WRITE_CHUNK]))
+        stream.flush()
 
-    for t, c in zip(titles, columns):
-        cols.append([t] + list(map(str, c)))
 
-    columns = cols
-    colLens = []
+WRITE_CHUNK = 4096
+"""Number of rows that ``print_columns`` writes at a time. """
 
-    for col in columns:
-        maxLen = max([len(r) for r in col])
-        colLens.append(maxLen)
 
-    fmtStrs = ['{{:<{}s}}'.format(l) for l   in colLens]
-    titles  = [col[0]                for col in columns]
-    rowsep  = ['-' * l               for l   in colLens]
-    columns = [col[1:]               for col in columns]
+def format_columns(titles, columns, colour=False, width=None):
+    """Format a table for ``print_columns``. Returns a list of lines, each
+    ending with a newline.
 
-    def printrow(vals, *msgtypes):
-        for i, (val, fmtStr) in enumerate(zip(vals, fmtStrs)):
-            printmsg(fmtStr.format(val), *msgtypes, end='')
-            if i < len(vals) - 1:
-                printmsg(' | ', INFO, end='')
-        print()
+    :arg titles:  A list of titles, one for each column.
+    :arg columns: A list of columns, where each column is a list of strings.
+    :arg colour:  Include ANSI codes
+    :arg width:   Maximum line width. If the table is too wide, columns are
+                  truncated, starting from the rightmost one.
+    """
+
+    titles  = [str(t) for t in titles]
+    columns = [[str(v) for v in col] for col in columns]
+    widths  = [max(len(t), max(map(len, col), default=0))
+               for t, col in zip(titles, columns)]
+
+    if width is not None:
+        fitted  = _fit_widths(widths, [len(t) for t in titles], width)
+        columns = [col if fw == w else [_truncate(v, fw) for v in col]
+                   for col, w, fw in zip(columns, widths, fitted)]
+        titles  = [_truncate(t, fw) for t, fw in zip(titles, fitted)]
+        widths  = fitted
+
+    if colour:
+        reset = ANSICODES[RESET]
+        sep   = f'{reset}{ANSICODES[INFO]} | {reset}'
+        codes = [ANSICODES[c] for c in (EMPHASIS, INFO, IMPORTANT)]
+    else:
+        reset = ''
+        sep   = ' | '
+        codes = ['', '', '']
+
+    titlecode, sepcode, rowcode = codes
+    fmt = (sep + rowcode).join(f'{{:<{w}}}' for w in widths)
+    fmt = f'{rowcode}{fmt}{reset}\n'
+
+    lines = [
+        titlecode + (sep + titlecode).join(
+            t.ljust(w) for t, w in zip(titles, widths)) + reset + '\n',
+        sepcode + (sep + sepcode).join('-' * w for w in widths) + reset + '\n'
+    ]
+    lines.extend(fmt.format(*row) for row in zip(*columns))
+    return lines
+
+
+def _fit_widths(widths, minwidths, width):
+    """Reduce column widths so that a table fits within ``width``
+    characters, starting from the rightmost column. Columns are not made
+    narrower than their titles.
+    """
+    widths = list(widths)
+    excess = sum(widths) + 3 * (len(widths) - 1) - width
+    for i in reversed(range(len(widths))):
+        if excess <= 0:
+            break
+        shrink     = min(excess, max(widths[i] - minwidths[i], 0))
+        widths[i] -= shrink
+        excess    -= shrink
+    return widths
+
+
+def _truncate(value, width):
+    """Truncate ``value`` to ``width`` characters, ending it with an
+    ellipsis if it was truncated.
+    """
+    if len(value) <= width: return value
+    if width < 1:           return ''
+    return value[:width - 1] + '\u2026'
 
-    printrow(titles, EMPHASIS)
-    printrow(rowsep, INFO)
 
-    nrows = len(columns[0])
-    for i in range(nrows):
-        row = [col[i] for col in columns]
-        printrow(row, IMPORTANT)
+def page(lines) -> bool:
+    """Display ``lines`` via ``$PAGER``. Returns ``False`` if the pager could
+    not be run.
+    """
+    import shlex
+    import subprocess as sp
+
+    pager = os.environ.get('PAGER') or 'less'
+    env   = dict(os.environ)
+    env.setdefault('LESS', 'FRX')
+
+    try:
+        proc = sp.Popen(shlex.split(pager), stdin=sp.PIPE, env=env,
+                        text=True)
+    except (OSError, ValueError):
+        return False
+
+    # BrokenPipeError means that the user quit the pager
+    try:
+        for i in range(0, len(lines), WRITE_CHUNK):
+            proc.stdin.write(''.join(lines[i:i + WRITE_CHUNK]))
+    except BrokenPipeError:
+        pass
+    try:
+        proc.stdin.close()
+    except BrokenPipeError:
+        pass
+    proc.wait()
+    return True
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""Tests for copying to the clipboard, and restoring it afterwards. """
+
+
+import os
+import time
+
+import pytest
+
+import deets.clipboard as clipboard
+
+
+class RestoredBackend(clipboard.FakeBackend):
+    """Fake backend which, like the command backends, is restored by a
+    background process outside of a session.
+    """
+    inprocess = False
+
+
+@pytest.fixture(autouse=True)
+def reset():
+    """Reset the module state after each test, and cancel any timer. """
+    yield
+    if clipboard._timer is not None:
+        clipboard._timer.cancel()
+    clipboard.set_backend(None)
+    clipboard._timer   = None
+    clipboard._pending = None
+    clipboard._session = False
+
+
+@pytest.fixture
+def spawned(monkeypatch):
+    """Record calls to ``_spawn_restore``, rather than starting processes. """
+    calls = []
+    def spawn(backend, text, previous, delay, copy=False):
+        calls.append((backend, text, previous, delay, copy))
+        return True
+    monkeypatch.setattr(clipboard, '_spawn_restore', spawn)
+    return calls
+
+
+def wait_for(condition, timeout=10):
+    """Wait until ``condition()`` is true. """
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_copy():
+    backend = clipboard.FakeBackend()
+    clipboard.set_backend(backend)
+    assert clipboard.copy('secret')
+    assert backend.contents  == 'secret'
+    assert clipboard._pending is None
+
+
+def test_no_backend(monkeypatch):
+    monkeypatch.setenv('DEETSCLIPBOARD', 'none')
+    assert not clipboard.copy('secret', 1)
+
+
+def test_restore():
+    backend          = clipboard.FakeBackend()
+    backend.contents = 'old'
+    clipboard.set_backend(backend)
+
+    assert clipboard.copy('secret', 0.05)
+    assert backend.contents == 'secret'
+    assert clipboard._pending[1:3] == ('secret', 'old')
+
+    wait_for(lambda: clipboard._pending is None)
+    assert backend.contents == 'old'
+    assert backend.history  == ['secret', 'old']
+
+
+def test_restore_clears():
+    backend = clipboard.FakeBackend()
+    clipboard.set_backend(backend)
+    clipboard.copy('secret', 0.05)
+    wait_for(lambda: clipboard._pending is None)
+    assert backend.contents is None
+
+
+def test_restore_not_if_changed():
+    backend          = clipboard.FakeBackend()
+    backend.contents = 'old'
+    clipboard.set_backend(backend)
+    clipboard.copy('secret', 0.05)
+    backend.copy('other')
+    wait_for(lambda: clipboard._pending is None)
+    assert backend.contents == 'other'
+
+
+def test_replace_pending_restore():
+    backend          = clipboard.FakeBackend()
+    backend.contents = 'old'
+    clipboard.set_backend(backend)
+
+    clipboard.copy('first', 60)
+    first = clipboard._timer
+    clipboard.copy('second', 0.05)
+    assert first.finished.is_set()
+
+    # the contents before the first copy are restored
+    assert clipboard._pending[1:3] == ('second', 'old')
+    wait_for(lambda: clipboard._pending is None)
+    assert backend.contents == 'old'
+    assert backend.history  == ['first', 'second', 'old']
+
+
+def test_spawn_outside_session(spawned):
+    backend = RestoredBackend()
+    clipboard.set_backend(backend)
+    assert clipboard.copy('secret', 30)
+
+    # the background process copies
+    assert backend.contents is None
+    assert spawned            == [(backend, 'secret', None, 30, True)]
+    assert clipboard._pending is None
+
+
+def test_end_session_hands_over(spawned):
+    backend          = RestoredBackend()
+    backend.contents = 'old'
+    clipboard.set_backend(backend)
+
+    clipboard.start_session()
+    clipboard.copy('secret', 30)
+    timer = clipboard._timer
+    assert backend.contents == 'secret'
+    assert spawned          == []
+
+    clipboard.end_session()
+    assert timer.finished.is_set()
+    assert clipboard._pending is None
+    assert len(spawned) == 1
+
+    handed, text, previous, delay, copy = spawned[0]
+    assert (handed, text, previous, copy) == (backend, 'secret', 'old', False)
+    assert 0 < delay <= 30
+    assert backend.contents == 'secret'
+
+
+def test_end_session_expired(spawned):
+    backend          = RestoredBackend()
+    backend.contents = 'old'
+    clipboard.set_backend(backend)
+
+    clipboard.start_session()
+    clipboard.copy('secret', 30)
+    _, text, previous, _ = clipboard._pending
+    clipboard._pending   = (backend, text, previous, time.monotonic() - 1)
+
+    # restored immediately
+    clipboard.end_session()
+    assert spawned          == []
+    assert backend.contents == 'old'
+
+
+def test_end_session_inprocess():
+    backend = clipboard.FakeBackend()
+    clipboard.set_backend(backend)
+
+    clipboard.start_session()
+    clipboard.copy('secret', 60)
+    pending = clipboard._pending
+    clipboard.end_session()
+
+    # in-process backends are still restored by the timer
+    assert clipboard._pending is pending
+    assert clipboard._timer.is_alive()
+
+
+FAKE_XSEL = """#!/bin/sh
+case "$2" in
+  --input)  cat > "$FAKECLIPBOARD" ;;
+  --output) cat "$FAKECLIPBOARD" 2> /dev/null ;;
+  --clear)  rm -f "$FAKECLIPBOARD" ;;
+esac
+"""
+
+
+def test_background_restore(tmp_path, monkeypatch):
+    contents = tmp_path / 'clipboard'
+    xsel     = tmp_path / 'xsel'
+    xsel.write_text(FAKE_XSEL)
+    xsel.chmod(0o755)
+    contents.write_text('old')
+    monkeypatch.setenv('PATH', f'{tmp_path}{os.pathsep}{os.environ["PATH"]}')
+    monkeypatch.setenv('DISPLAY', ':0')
+    monkeypatch.setenv('FAKECLIPBOARD', str(contents))
+    clipboard.set_backend(clipboard.XselBackend())
+
+    # the clipboard is set before copy returns
+    assert clipboard.copy('secret', 0.5)
+    assert contents.read_text() == 'secret'
+    wait_for(lambda: contents.read_text() == 'old')
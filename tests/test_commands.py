@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""Tests for the ``deets exec`` command. """
+
+
+import argparse
+
+import pytest
+
+import deets.commands as commands
+import deets.db       as deetsdb
+
+
+@pytest.fixture
+def db():
+    db = deetsdb.Database('password')
+    db[('aws', 'prod')] = ('produser', 'prodpass')
+    db[('1password',)]  = ('user1',    'pass1')
+    db.set_notes(deetsdb.sanitise_key(('aws', 'prod')), 'notes')
+    return db
+
+
+@pytest.fixture
+def execvpe(monkeypatch):
+    """Record the environment passed to ``os.execvpe``. """
+    calls = []
+    monkeypatch.setattr(commands.os, 'execvpe',
+                        lambda cmd, args, env: calls.append(env))
+    return calls
+
+
+def run(db, *accounts):
+    args = argparse.Namespace(accounts=list(accounts), cmd=['true'])
+    commands.exec_command(db, args)
+
+
+def test_exec(db, execvpe):
+    run(db, 'aws')
+    env = execvpe[0]
+    assert env['AWS_PROD_USERNAME'] == 'produser'
+    assert env['AWS_PROD_PASSWORD'] == 'prodpass'
+    assert env['AWS_PROD_NOTES']    == 'notes'
+
+
+def test_exec_same_account_twice(db, execvpe):
+    run(db, 'A=aws', 'B=aws')
+    env = execvpe[0]
+    assert env['A_PASSWORD'] == 'prodpass'
+    assert env['B_PASSWORD'] == 'prodpass'
+
+
+def test_exec_explicit_prefix(db, execvpe):
+    run(db, 'PW=1password')
+    assert execvpe[0]['PW_PASSWORD'] == 'pass1'
+
+
+@pytest.mark.parametrize('spec', ['1password', '1A=aws', 'A-B=aws'])
+def test_exec_invalid_prefix(db, execvpe, spec):
+    with pytest.raises(SystemExit):
+        run(db, spec)
+    assert execvpe == []
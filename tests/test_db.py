@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+"""Tests for loading and saving databases - locking, merging concurrent
+changes, migration of old files, compaction, and the file encodings.
+"""
+
+
+import os
+import os.path  as op
+import            argparse
+import            fcntl
+import            json
+
+import pytest
+
+import deets.benchmark  as benchmark
+import deets.encryption as encryption
+import deets.db         as deetsdb
+
+
+PASSWORD = 'password'
+
+
+@pytest.fixture(autouse=True)
+def cheap_kdf(monkeypatch):
+    """Use a fast KDF, so that tests don't spend all their time in it. """
+    monkeypatch.setattr(encryption, 'DEFAULT_KDF',
+                        {'algorithm' : 'pbkdf2-sha256', 'iterations' : 1000})
+
+
+def create(path        : str,
+           accounts    : int  = 3,
+           encoding    : str  = 'json',
+           compression : str  = None,
+           sharded     : bool = False) -> deetsdb.Database:
+    """Create and save a database at ``path`` containing some accounts. """
+    db             = deetsdb.Database(PASSWORD)
+    db.encoding    = encoding
+    db.compression = compression
+    for i in range(accounts):
+        db[(f'account{i}', 'shared')] = (f'user{i}', f'pass{i}')
+    db.set_notes(deetsdb.sanitise_key(('account0', 'shared')), 'some notes')
+    if sharded:
+        os.mkdir(path)
+    deetsdb.save_database(db, path)
+    return db
+
+
+def contents(db : deetsdb.Database):
+    """Return all accounts in ``db``, including their notes. """
+    return {names : (creds, db.get_notes(names)) for names, creds in db}
+
+
+def test_lock_database(tmp_path):
+    path = str(tmp_path / 'db')
+    create(path)
+
+    def try_lock(mode):
+        fd = os.open(deetsdb.lock_file(path), os.O_RDWR)
+        try:
+            fcntl.flock(fd, mode | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+        finally:
+            os.close(fd)
+
+    with deetsdb.lock_database(path):
+        assert     try_lock(fcntl.LOCK_SH)
+        assert not try_lock(fcntl.LOCK_EX)
+    with deetsdb.lock_database(path, exclusive=True):
+        assert not try_lock(fcntl.LOCK_SH)
+    assert try_lock(fcntl.LOCK_EX)
+
+
+@pytest.mark.parametrize('sharded', [False, True])
+def test_merge(tmp_path, sharded):
+    path = str(tmp_path / 'db')
+    create(path, sharded=sharded)
+
+    ours   = deetsdb.load_database(path, PASSWORD)
+    theirs = deetsdb.load_database(path, PASSWORD)
+
+    theirs[('theirs',)] = ('them', 'theirpass')
+    del theirs[('account1', 'shared')]
+    assert not deetsdb.save_database(theirs, path)
+
+    # the same change made by both is not a conflict
+    ours[('ours',)] = ('us', 'ourpass')
+    del ours[('account1', 'shared')]
+    assert deetsdb.save_database(ours, path)
+
+    db = deetsdb.load_database(path, PASSWORD)
+    assert db[('ours',)]   == ('us',   'ourpass')
+    assert db[('theirs',)] == ('them', 'theirpass')
+    assert ('account1', 'shared') not in db
+    assert contents(db) == contents(ours)
+
+
+def test_merge_conflict(tmp_path):
+    path = str(tmp_path / 'db')
+    create(path)
+
+    ours   = deetsdb.load_database(path, PASSWORD)
+    theirs = deetsdb.load_database(path, PASSWORD)
+
+    theirs[('account0', 'shared')] = ('user0', 'theirpass')
+    deetsdb.save_database(theirs, path)
+
+    ours[('account0', 'shared')] = ('user0', 'ourpass')
+    ours[('ours',)]              = ('us',    'ourpass')
+    with pytest.raises(deetsdb.ConflictError) as e:
+        deetsdb.save_database(ours, path)
+    assert e.value.accounts == [deetsdb.sanitise_key(('account0', 'shared'))]
+
+    # nothing was saved
+    db = deetsdb.load_database(path, PASSWORD)
+    assert db[('account0', 'shared')] == ('user0', 'theirpass')
+    assert ('ours',) not in db
+
+
+def test_merge_conflicting_password_change(tmp_path):
+    path = str(tmp_path / 'db')
+    create(path)
+
+    ours   = deetsdb.load_database(path, PASSWORD)
+    theirs = deetsdb.load_database(path, PASSWORD)
+
+    theirs.password = 'theirs'
+    deetsdb.save_database(theirs, path)
+
+    ours.password = 'ours'
+    with pytest.raises(deetsdb.ConflictError):
+        deetsdb.save_database(ours, path)
+
+
+def test_migrate_v1(tmp_path):
+    path    = str(tmp_path / 'db')
+    salt    = encryption.generate_salt()
+    entries = [{'names'    : ['account0', 'shared'],
+                'username' : 'user0',
+                'password' : 'pass0',
+                'notes'    : 'some notes'},
+               {'names'    : ['account1'],
+                'username' : 'user1',
+                'password' : 'pass1'}]
+    with open(path, 'wt') as f:
+        json.dump({
+            'salt'    : encryption.encrypt(salt, PASSWORD.encode()).decode(),
+            'entries' : encryption.sencrypt(json.dumps(entries), PASSWORD,
+                                            salt)}, f)
+
+    db       = deetsdb.load_database(path, PASSWORD)
+    expected = contents(db)
+    assert db[('account0', 'shared')]           == ('user0', 'pass0')
+    assert db.get_notes(('account0', 'shared')) == 'some notes'
+    assert db[('account1',)]                    == ('user1', 'pass1')
+    assert not db.changed
+
+    with pytest.raises(encryption.AuthenticationError):
+        deetsdb.load_database(path, 'wrong')
+
+    deetsdb.save_database(db, path)
+    with open(path, 'rb') as f:
+        _, header, backup, _ = deetsdb.read_header(f)
+    assert header['version'] == deetsdb.VERSION
+    assert backup            == header
+
+    db = deetsdb.load_database(path, PASSWORD)
+    assert contents(db) == expected
+
+
+def test_compaction(tmp_path, monkeypatch):
+    monkeypatch.setattr(deetsdb, 'LOG_COMPACT_THRESHOLD', 3)
+    path = str(tmp_path / 'db')
+    create(path)
+    size = op.getsize(path)
+
+    db = deetsdb.load_database(path, PASSWORD)
+    assert db.log_size == 0
+
+    # changes are appended to the file
+    # until there are too many of them
+    for i in range(3):
+        db[('account0', 'shared')] = ('user0', f'newpass{i}')
+        deetsdb.save_database(db, path)
+        assert db.log_size == i + 1
+        assert op.getsize(path) > size
+        assert deetsdb.load_database(path, PASSWORD).log_size == i + 1
+
+    db[('account0', 'shared')] = ('user0', 'final')
+    deetsdb.save_database(db, path)
+    assert db.log_size == 0
+
+    loaded = deetsdb.load_database(path, PASSWORD)
+    assert loaded.log_size == 0
+    assert contents(loaded) == contents(db)
+    assert loaded[('account0', 'shared')] == ('user0', 'final')
+
+
+@pytest.mark.parametrize('encoding',    deetsdb.ENCODINGS)
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+@pytest.mark.parametrize('sharded',     [False, True])
+def test_roundtrip(tmp_path, encoding, compression, sharded):
+    path     = str(tmp_path / 'db')
+    expected = contents(create(path, 50, encoding, compression, sharded))
+
+    db = deetsdb.load_database(path, PASSWORD)
+    assert db.encoding    == encoding
+    assert db.compression == compression
+    assert contents(db)   == expected
+
+    # appended changes
+    db[('new',)] = ('newuser', 'newpass')
+    del db[('account1', 'shared')]
+    deetsdb.save_database(db, path)
+    expected = contents(db)
+    assert contents(deetsdb.load_database(path, PASSWORD)) == expected
+
+    # changing the password only re-writes the key slots
+    db.password = 'new'
+    deetsdb.save_database(db, path)
+    with pytest.raises(encryption.AuthenticationError):
+        deetsdb.load_database(path, PASSWORD)
+    assert contents(deetsdb.load_database(path, 'new')) == expected
+
+
+@pytest.mark.parametrize('encoding', deetsdb.ENCODINGS)
+@pytest.mark.parametrize('sharded',  [False, True])
+def test_stress(encoding, sharded):
+    args = argparse.Namespace(processes=4, readers=1, count=10,
+                              encoding=encoding, sharded=sharded)
+    assert benchmark.stress(args)
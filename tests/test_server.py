@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""Tests for the handling of requests by the ``deets serve`` server. """
+
+
+import asyncio
+
+import pytest
+
+import deets.db     as deetsdb
+import deets.server as server
+
+
+class Writer:
+    """Stands in for an ``asyncio.StreamWriter``. """
+
+    def __init__(self):
+        self.data   = b''
+        self.closed = False
+
+    def write(self, data : bytes):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def srv(tmp_path):
+    srv = server.SecretServer(deetsdb.Database('password'),
+                              str(tmp_path / 'vault'))
+    yield srv
+    srv.close()
+
+
+def handle(srv : server.SecretServer, request : bytes, eof : bool = True):
+    """Pass ``request`` to ``srv.handle``, and return what it wrote. Fails
+    if the request is not handled within a few seconds (e.g. because the
+    server is waiting for more data).
+    """
+    async def run():
+        reader = asyncio.StreamReader(limit=server.MAX_HEADER_SIZE)
+        writer = Writer()
+        reader.feed_data(request)
+        if eof:
+            reader.feed_eof()
+        await asyncio.wait_for(srv.handle(reader, writer), 5)
+        assert writer.closed
+        return writer.data
+    return asyncio.run(run())
+
+
+def test_health(srv):
+    data = handle(srv, b'GET /v1/health HTTP/1.1\r\n'
+                       b'Connection: close\r\n\r\n')
+    assert data.startswith(b'HTTP/1.1 200 OK\r\n')
+    assert data.endswith(b'{"status": "ok"}')
+
+
+def test_small_body_ignored(srv):
+    data = handle(srv, b'GET /v1/health HTTP/1.1\r\n'
+                       b'Content-Length: 5\r\n\r\nhello'
+                       b'GET /v1/health HTTP/1.1\r\n\r\n')
+    assert data.count(b'HTTP/1.1 200 OK\r\n') == 2
+
+
+def test_unauthorized(srv):
+    data = handle(srv, b'GET /v1/accounts/aws HTTP/1.1\r\n\r\n')
+    assert data.startswith(b'HTTP/1.1 401 Unauthorized\r\n')
+
+
+def test_body_too_large(srv):
+    # the body is rejected without waiting for it
+    length = server.MAX_BODY_SIZE + 1
+    data   = handle(srv, b'GET /v1/accounts/aws HTTP/1.1\r\n'
+                         b'Content-Length: %d\r\n\r\n' % length,
+                    eof=False)
+    assert data.startswith(b'HTTP/1.1 413 Payload Too Large\r\n')
+
+
+def test_incomplete_body(srv):
+    data = handle(srv, b'GET /v1/health HTTP/1.1\r\n'
+                       b'Content-Length: 100\r\n\r\nabc')
+    assert data == b''
+
+
+def test_bad_request(srv):
+    data = handle(srv, b'GET /v1/health HTTP/1.1\r\n'
+                       b'Content-Length: -1\r\n\r\n')
+    assert data.startswith(b'HTTP/1.1 400 Bad Request\r\n')
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+"""Check that ``deets`` does not import anything it doesn't need at startup
+(see ``deets.benchmark startup`` for the corresponding timing check).
+"""
+
+
+import os.path    as op
+import subprocess as sp
+import                 sys
+
+import pytest
+
+
+HEAVY_MODULES = ['cryptography', 'json', 'readline', 'socket', 'subprocess',
+                 'asyncio', 'secrets', 'hashlib', 'deets.commands',
+                 'deets.encryption', 'deets.db', 'deets.agent',
+                 'deets.clipboard', 'deets.server', 'deets.shards']
+"""Modules which must only be imported once a command is executed. """
+
+
+def imported_modules(*args):
+    """Run ``python -X importtime -m deets.main <args>``, and return the
+    names of all modules that were imported.
+    """
+    pkgdir = op.dirname(op.dirname(op.abspath(__file__)))
+    result = sp.run([sys.executable, '-X', 'importtime', '-m', 'deets.main']
+                    + list(args),
+                    cwd=pkgdir, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+    # "import time: <self us> | <cumulative us> | <indent><module>"
+    modules = []
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:'):
+            modules.append(line.split('|')[2].strip())
+    return modules
+
+
+@pytest.mark.parametrize('args', [['--help'], ['--version'],
+                                  ['get', '--help']])
+def test_no_heavy_imports(args):
+    modules = imported_modules(*args)
+    assert 'deets.ui' in modules
+    heavy   = [m for m in modules
+               if any(m == h or m.startswith(f'{h}.') for h in HEAVY_MODULES)]
+    assert heavy == []